@@ -0,0 +1,87 @@
+import perlin_noise
+import generate_terrain
+import erosion
+import particle
+import tracemalloc
+import argparse
+import os
+import time
+
+# Octaves of generate_big_ranges, with fixed z offsets
+BIG_RANGES_OCTAVES = [(3, 1,  -1, 1.0),
+                      (8, 5,   2, 2.0),
+                      (2, 15,  5, 3.0),
+                      (5, 20, -1, 4.0)]
+
+def timed(function):
+    """ Seconds function() takes, on the monotonic performance counter """
+    start_time = time.perf_counter()
+    function()
+    return time.perf_counter() - start_time
+
+def benchmark_tiled_noise(dim, max_workers, tile_size):
+    """ Time tiled noise generation for a dim x dim map from 1 to max_workers processes """
+    noise = perlin_noise.PerlinNoise(0)
+    baseline = None
+    for workers in range(1, max_workers + 1):
+        elapsed_time = timed(lambda: noise.tiled_layered_noise_map(dim, dim, BIG_RANGES_OCTAVES, tile_size=tile_size,
+                                                                   workers=workers))
+        if baseline is None:
+            baseline = elapsed_time
+        print(f"Noise {dim}x{dim}, {workers} worker(s): {elapsed_time:.3f}s, speedup {baseline/elapsed_time:.2f}x")
+
+def benchmark_tiled_erosion(dim, droplets, max_workers, tile_size):
+    """ Time serial erosion of a dim x dim big ranges map against tiled erosion from 1 to max_workers processes """
+    height_map = generate_terrain.generate_big_ranges(dim, dim, seed=0)
+    # Both erosion functions work in place
+    serial = height_map.copy()
+    serial_time = timed(lambda: erosion.erode(serial, droplets, seed=0))
+    serial_change = abs(serial - height_map).mean()
+    print(f"Erosion {dim}x{dim}, {droplets} droplets, serial: {serial_time:.3f}s, mean change {serial_change:.5f}")
+    for workers in range(1, max_workers + 1):
+        tiled = height_map.copy()
+        elapsed_time = timed(lambda: erosion.tiled_erode(tiled, droplets, tile_size=tile_size, halo=tile_size // 8,
+                                                         workers=workers, seed=0))
+        print(f"Erosion {dim}x{dim}, {workers} worker(s): {elapsed_time:.3f}s, speedup {serial_time/elapsed_time:.2f}x, "
+              f"mean change {abs(tiled - height_map).mean():.5f}")
+
+def benchmark_particle_access(count):
+    """
+    Read and scale the heat of count thermal particles as slotted objects, as ParticlePool views and as the pool's
+    columns, and compare the memory of the objects with the columns
+    """
+    pool = particle.ParticlePool(particle.DiscreteThermalParticle, count, position_x=range(count), position_y=range(count))
+    tracemalloc.start()
+    objects = pool.to_particles()
+    object_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    column_bytes = sum(column.nbytes for column in pool.columns.values())
+
+    def scale_objects(particles):
+        for thermal_particle in particles:
+            thermal_particle.heat_energy *= 0.95
+    def scale_columns():
+        pool.columns["heat_energy"] *= 0.95
+    print(f"{count} particles: objects {object_bytes/count:.0f} bytes each, pool columns {column_bytes/count:.0f} bytes each")
+    print(f"  objects: read {timed(lambda: sum(p.heat_energy for p in objects)):.4f}s, "
+          f"scale {timed(lambda: scale_objects(objects)):.4f}s")
+    print(f"  views:   read {timed(lambda: sum(p.heat_energy for p in pool)):.4f}s, "
+          f"scale {timed(lambda: scale_objects(pool)):.4f}s")
+    print(f"  columns: read {timed(lambda: pool.columns['heat_energy'].sum()):.4f}s, scale {timed(scale_columns):.4f}s")
+    print(f"  to_particles and back: {timed(lambda: pool.write_particles(pool.to_particles())):.4f}s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dim", type=int, default=4096)
+    parser.add_argument("--max_workers", type=int, default=os.cpu_count())
+    parser.add_argument("--tile_size", type=int, default=512)
+    parser.add_argument("--erosion_dim", type=int, default=1024)
+    parser.add_argument("--erosion_droplets", type=int, default=100000)
+    parser.add_argument("--particles", type=int, default=100000)
+
+    args = parser.parse_args()
+    benchmark_tiled_noise(args.dim, args.max_workers, args.tile_size)
+    if args.erosion_droplets > 0:
+        benchmark_tiled_erosion(args.erosion_dim, args.erosion_droplets, args.max_workers, args.tile_size)
+    if args.particles > 0:
+        benchmark_particle_access(args.particles)
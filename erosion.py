@@ -1,4 +1,6 @@
 from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 import unittest 
 import particle
@@ -8,17 +10,19 @@ import particle
 
 DEPOSITION_CONSTANT = 0.3
 EVAPORATION_RATE = 0.005
+DROPLET_VOLUME = 1.0
+DROPLET_DENSITY = 1.0
 
-@dataclass
+@dataclass(slots=True)
 class ErosionParticle(particle.Particle):
     # partical volume
-    volume = 1.0
+    volume: float = DROPLET_VOLUME
     
     # Volume of sediment 
-    sediment = 0.0
+    sediment: float = 0.0
 
     # Particle density
-    density = 1.0
+    density: float = DROPLET_DENSITY
 
     def step_sediment(self, dt = 1):
         """ Calculate the sediment picked up or dropped """
@@ -36,11 +40,252 @@ class ErosionParticle(particle.Particle):
         # Reurn how much sediment was removed on the map at the given position
         return (self.position_x, self.position_y, sediment)
     
-    def step_particle(self, heightmap, dt = 1):
-        self.step_dynamics(heightmap, dt)
+    def step_particle(self, heightmap, dt = 1, gradient = None):
+        self.step_dynamics(heightmap, dt, gradient=gradient)
         return self.step_sediment(dt)
     
 
+MIN_VOLUME = 0.01
+# Scales the carrying capacity (volume * speed) of erode's droplets, which otherwise carve far too deep
+EROSION_CAPACITY = 0.05
+# With Particle.normal_force's sign convention a positive force pushes droplets downhill
+GRAVITY = 9.8
+
+class ErosionBatch():
+    """
+    A batch of erosion droplets stored as arrays and advanced in lockstep.
+    Each step follows ErosionParticle.step_particle (Particle.step_dynamics then step_sediment) for every live droplet;
+    the sediment picked up or dropped is taken from or added to the height map with bilinear weights around the point
+    the droplet left. Droplets whose volume falls below min_volume drop their remaining sediment and retire.
+    force defaults to GRAVITY, which runs droplets downhill; step_particle's default of -9.8 runs them uphill.
+    """
+    def __init__(self, position_x, position_y, friction = particle.FRICTION, volume = DROPLET_VOLUME,
+                 density = DROPLET_DENSITY, capacity = 1.0, limit_to_drop = False, gradient = None):
+        self.position_x = np.asarray(position_x, dtype=np.float64)
+        self.position_y = np.asarray(position_y, dtype=np.float64)
+        count = len(self.position_x)
+        self.velocity_x = np.zeros(count)
+        self.velocity_y = np.zeros(count)
+        self.volume = np.full(count, float(volume))
+        self.sediment = np.zeros(count)
+        self.density = density
+        self.friction = friction
+        self.capacity = capacity
+        self.limit_to_drop = limit_to_drop
+        self.gradient = gradient
+        self.alive = np.ones(count, dtype=bool)
+
+    def normal_force(self, height_map, live, force):
+        """
+        Vectorized Particle.normal_force for the live droplets, sampled bilinearly from the gradient field when there is
+        one and from the height map otherwise, with the same result
+        """
+        mg = self.density * self.volume[live] * force
+        if self.gradient is not None:
+            slope_x, slope_y = self.gradient.sample(self.position_x[live], self.position_y[live])
+        else:
+            slope_x, slope_y = particle.sample_slope(height_map, self.position_x[live], self.position_y[live])
+        return mg * slope_x, mg * slope_y
+
+    def step(self, height_map, dt = 1, force = GRAVITY, min_volume = MIN_VOLUME):
+        """ Advance every live droplet one step, eroding and depositing on height_map in place """
+        live = np.nonzero(self.alive)[0]
+        map_width, map_height = height_map.shape
+        normal_x, normal_y = self.normal_force(height_map, live, force)
+        volume = self.volume[live]
+
+        # Particle.step_dynamics
+        velocity_x = (self.velocity_x[live] + normal_x/(volume * self.density)*dt) * (1 - self.friction*dt)
+        velocity_y = (self.velocity_y[live] + normal_y/(volume * self.density)*dt) * (1 - self.friction*dt)
+        position_x = self.position_x[live] + velocity_x*dt
+        position_y = self.position_y[live] + velocity_y*dt
+
+        velocity_x[(position_x <= 0) | (position_x >= map_width - 1)] = 0
+        velocity_y[(position_y <= 0) | (position_y >= map_height - 1)] = 0
+        position_x = np.clip(position_x, 0, map_width - 1)
+        position_y = np.clip(position_y, 0, map_height - 1)
+
+        # ErosionParticle.step_sediment
+        eq_constant = self.capacity * volume * np.sqrt(velocity_x**2 + velocity_y**2)
+        sediment = dt*DEPOSITION_CONSTANT*(eq_constant - self.sediment[live])
+        if self.limit_to_drop:
+            # Never dig deeper than the droplet fell this step, and fill in what it climbed, otherwise droplets
+            # rocking back and forth in a hollow carve it into an ever deeper pit
+            drop = sample_bilinear(height_map, self.position_x[live], self.position_y[live]) - \
+                   sample_bilinear(height_map, position_x, position_y)
+            sediment = np.where(drop < 0, -np.minimum(-drop, self.sediment[live]), np.minimum(sediment, drop))
+        self.sediment[live] += sediment
+        volume = volume * (1.0 - dt*EVAPORATION_RATE)
+
+        # Material is taken from or left at the point the droplet moved away from
+        apply_bilinear(height_map, self.position_x[live], self.position_y[live], -sediment, self.gradient)
+        self.position_x[live] = position_x
+        self.position_y[live] = position_y
+        self.velocity_x[live] = velocity_x
+        self.velocity_y[live] = velocity_y
+        self.volume[live] = volume
+
+        # Evaporated droplets drop what they carry and retire
+        self.retire(height_map, live[volume < min_volume])
+
+    def retire(self, height_map, indices):
+        """ Drop the sediment of the droplets at indices where they are and stop them """
+        apply_bilinear(height_map, self.position_x[indices], self.position_y[indices], self.sediment[indices], self.gradient)
+        self.sediment[indices] = 0
+        self.alive[indices] = False
+
+    def retire_all(self, height_map):
+        """ Drop the sediment of every droplet still alive """
+        self.retire(height_map, np.nonzero(self.alive)[0])
+
+    def run(self, height_map, max_steps = 1000, dt = 1, force = GRAVITY, min_volume = MIN_VOLUME, bounds = None):
+        """
+        Step until every droplet has evaporated or max_steps pass, then retire the rest.
+        Droplets that leave bounds (x_min, x_max, y_min, y_max) retire where they are.
+        """
+        for _ in range(max_steps):
+            if not self.alive.any():
+                break
+            self.step(height_map, dt, force, min_volume)
+            if bounds is not None:
+                x_min, x_max, y_min, y_max = bounds
+                outside = self.alive & ((self.position_x < x_min) | (self.position_x > x_max) |
+                                        (self.position_y < y_min) | (self.position_y > y_max))
+                self.retire(height_map, np.nonzero(outside)[0])
+        self.retire_all(height_map)
+
+def bilinear_weights(height_map, position_x, position_y):
+    """ The four cells around each fractional position as (offset_x, offset_y, weight), plus the corner cells x0, y0 """
+    map_width, map_height = height_map.shape
+    x0 = np.minimum(np.floor(position_x).astype(np.int64), map_width - 2)
+    y0 = np.minimum(np.floor(position_y).astype(np.int64), map_height - 2)
+    fraction_x = position_x - x0
+    fraction_y = position_y - y0
+    weights = [(0, 0, (1 - fraction_x) * (1 - fraction_y)),
+               (1, 0, fraction_x * (1 - fraction_y)),
+               (0, 1, (1 - fraction_x) * fraction_y),
+               (1, 1, fraction_x * fraction_y)]
+    return x0, y0, weights
+
+def sample_bilinear(height_map, position_x, position_y):
+    """ Bilinearly interpolated height at each fractional position """
+    x0, y0, weights = bilinear_weights(height_map, position_x, position_y)
+    cells = particle.cell_reader(height_map)
+    return sum(weight * cells(x0 + offset_x, y0 + offset_y) for offset_x, offset_y, weight in weights)
+
+def apply_bilinear(height_map, position_x, position_y, amount, gradient = None):
+    """
+    Scatter-add amount onto the four cells around each fractional position, weighted bilinearly.
+    A GradientField for height_map has the slopes around the changed cells recomputed.
+    """
+    x0, y0, weights = bilinear_weights(height_map, position_x, position_y)
+    if height_map.flags.c_contiguous:
+        # One scatter over flat indices, adding in the same order as one per corner
+        map_height = height_map.shape[1]
+        np.add.at(height_map.reshape(-1), np.concatenate([(x0 + offset_x) * map_height + y0 + offset_y
+                                                          for offset_x, offset_y, _ in weights]),
+                  np.concatenate([weight * amount for _, _, weight in weights]))
+    else:
+        for offset_x, offset_y, weight in weights:
+            np.add.at(height_map, (x0 + offset_x, y0 + offset_y), weight * amount)
+    if gradient is not None and len(x0) > 0:
+        gradient.update_cells(np.concatenate([x0, x0 + 1, x0, x0 + 1]), np.concatenate([y0, y0, y0 + 1, y0 + 1]))
+
+def erode(height_map, droplets, batch_size = 10000, seed = None, max_steps = 1000, dt = 1, force = GRAVITY,
+          min_volume = MIN_VOLUME, capacity = EROSION_CAPACITY):
+    """
+    Run droplets erosion droplets over height_map (modified in place), batch_size at a time.
+    Droplets start at uniformly random positions and run until they evaporate or max_steps pass.
+    capacity scales how much sediment a droplet can carry relative to ErosionParticle, and no droplet erodes more
+    than it descends in a step.
+    """
+    rng = np.random.default_rng(seed)
+    map_width, map_height = height_map.shape
+    for batch_start in range(0, droplets, batch_size):
+        count = min(batch_size, droplets - batch_start)
+        batch = ErosionBatch(rng.random(count) * (map_width - 1), rng.random(count) * (map_height - 1), capacity=capacity,
+                             limit_to_drop=True)
+        batch.run(height_map, max_steps, dt, force, min_volume)
+    return height_map
+
+def tiled_erode(height_map, droplets, tile_size = 512, halo = 64, workers = None, batch_size = 10000, seed = None,
+                max_steps = 1000, dt = 1, force = GRAVITY, min_volume = MIN_VOLUME, capacity = EROSION_CAPACITY):
+    """
+    erode() split over tiles of height_map (modified in place) run on a process pool over shared memory.
+    Droplets start inside a tile and may run into a halo of halo cells around it, retiring if they leave it.
+    Tiles are run in four phases by the parity of their tile coordinates, so tiles running at the same time never
+    share a halo cell and each phase sees the erosion of the previous ones. A round runs all four phases with up to
+    batch_size droplets per tile, and rounds repeat until all droplets have run.
+    The result depends only on seed, tile_size and halo, not on the number of workers.
+    """
+    assert(2 * halo <= tile_size)
+    if seed is None:
+        seed = int(np.random.default_rng().integers(2**63))
+    map_width, map_height = height_map.shape
+    tiles = [(x_start, min(x_start + tile_size, map_width), y_start, min(y_start + tile_size, map_height))
+             for x_start in range(0, map_width, tile_size) for y_start in range(0, map_height, tile_size)]
+    rounds = max(1, -(-droplets // (batch_size * len(tiles))))
+
+    # Share out droplets by tile area, handing the remainder to the first tiles
+    tile_droplets = []
+    for round_index in range(rounds):
+        round_droplets = droplets // rounds + (1 if round_index < droplets % rounds else 0)
+        areas = np.array([(x_end - x_start) * (y_end - y_start) for x_start, x_end, y_start, y_end in tiles])
+        counts = round_droplets * areas // areas.sum()
+        counts[:round_droplets - counts.sum()] += 1
+        tile_droplets.append(counts)
+
+    shared = shared_memory.SharedMemory(create=True, size=max(height_map.nbytes, 1))
+    try:
+        shared_map = np.ndarray(height_map.shape, dtype=np.float64, buffer=shared.buf)
+        shared_map[:] = height_map
+        parameters = (max_steps, dt, force, min_volume, capacity)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for round_index in range(rounds):
+                for phase in [(0, 0), (0, 1), (1, 0), (1, 1)]:
+                    tasks = [(shared.name, height_map.shape, tile, halo, int(tile_droplets[round_index][tile_index]),
+                              (seed, round_index, tile_index), parameters)
+                             for tile_index, tile in enumerate(tiles)
+                             if ((tile[0] // tile_size) % 2, (tile[2] // tile_size) % 2) == phase]
+                    for _ in pool.map(_erode_tile, tasks):
+                        pass
+        height_map[:] = shared_map
+        del shared_map
+    finally:
+        shared.close()
+        shared.unlink()
+    return height_map
+
+def _erode_tile(task):
+    """ Worker for tiled_erode: erode one tile and its halo in place in the shared height map """
+    shared_name, shape, tile, halo, droplets, entropy, parameters = task
+    max_steps, dt, force, min_volume, capacity = parameters
+    if droplets == 0:
+        return
+    shared = shared_memory.SharedMemory(name=shared_name)
+    try:
+        height_map = np.ndarray(shape, dtype=np.float64, buffer=shared.buf)
+        x_start, x_end, y_start, y_end = tile
+        region_x_start, region_x_end = max(x_start - halo, 0), min(x_end + halo, shape[0])
+        region_y_start, region_y_end = max(y_start - halo, 0), min(y_end + halo, shape[1])
+        region = height_map[region_x_start:region_x_end, region_y_start:region_y_end].copy()
+        region_width, region_height = region.shape
+
+        # Droplets start anywhere in the tile, short of the last row and column only at the map edge as in erode()
+        rng = np.random.default_rng(entropy)
+        batch = ErosionBatch(x_start - region_x_start + rng.random(droplets) * (x_end - x_start - (x_end == shape[0])),
+                             y_start - region_y_start + rng.random(droplets) * (y_end - y_start - (y_end == shape[1])),
+                             capacity=capacity, limit_to_drop=True)
+        # Droplets stop at the edge of the halo, but run up to the map edge as in erode()
+        bounds = (0 if region_x_start == 0 else 1, region_width - 1 if region_x_end == shape[0] else region_width - 2,
+                  0 if region_y_start == 0 else 1, region_height - 1 if region_y_end == shape[1] else region_height - 2)
+        batch.run(region, max_steps, dt, force, min_volume, bounds)
+
+        height_map[region_x_start:region_x_end, region_y_start:region_y_end] = region
+        del height_map
+    finally:
+        shared.close()
+
 
 class TestParticle(unittest.TestCase): 
 
@@ -83,6 +328,79 @@ class TestParticle(unittest.TestCase):
         self.assertEqual(dep_3, -0.344375, f"{test_name}, 1 Unit Velocity")
         self.assertEqual(test_part.sediment, dep + dep_2 + dep_3, f"{test_name}, 1 Unit Velocity")
 
+class TestErosionBatch(unittest.TestCase):
+
+    def test_matches_particle(self):
+        height_map = np.fromfunction(lambda x, y: np.sin(x / 4) + np.cos(y / 3) + 2, (30, 25))
+        start = [(3.5, 4.25), (0.0, 12.0), (28.7, 24.0), (15.2, 9.9)]
+        particles = [ErosionParticle(x, y) for x, y in start]
+        batch = ErosionBatch([x for x, _ in start], [y for _, y in start])
+        for _ in range(20):
+            for test_part in particles:
+                test_part.step_particle(height_map)
+            # Stepping against a copy keeps both on the same, unchanged height map
+            batch.step(height_map.copy(), force=-9.8)
+
+        for index, test_part in enumerate(particles):
+            self.assertAlmostEqual(batch.position_x[index], test_part.position_x)
+            self.assertAlmostEqual(batch.position_y[index], test_part.position_y)
+            self.assertAlmostEqual(batch.sediment[index], test_part.sediment)
+            self.assertAlmostEqual(batch.volume[index], test_part.volume)
+
+    def test_gradient_field_follows_erosion(self):
+        height_map = np.fromfunction(lambda x, y: np.sin(x / 4) + np.cos(y / 3) + 2, (30, 25))
+        gradient = particle.GradientField(height_map)
+        rng = np.random.default_rng(0)
+        batch = ErosionBatch(rng.random(50) * 29, rng.random(50) * 24, capacity=EROSION_CAPACITY, limit_to_drop=True,
+                             gradient=gradient)
+        batch.run(height_map, max_steps=40)
+        self.assertTrue(np.allclose(gradient.slope, particle.GradientField(height_map).slope))
+
+    def test_gradient_field_is_only_a_cache(self):
+        height_map = np.fromfunction(lambda x, y: np.sin(x / 4) + np.cos(y / 3) + 2, (30, 25))
+        rng = np.random.default_rng(3)
+        start_x, start_y = rng.random(50) * 29, rng.random(50) * 24
+        direct_map, cached_map = height_map.copy(), height_map.copy()
+        direct = ErosionBatch(start_x.copy(), start_y.copy(), capacity=EROSION_CAPACITY, limit_to_drop=True)
+        cached = ErosionBatch(start_x.copy(), start_y.copy(), capacity=EROSION_CAPACITY, limit_to_drop=True,
+                              gradient=particle.GradientField(cached_map))
+        direct.run(direct_map, max_steps=40)
+        cached.run(cached_map, max_steps=40)
+        self.assertTrue(np.array_equal(direct.position_x, cached.position_x))
+        self.assertTrue(np.array_equal(direct.position_y, cached.position_y))
+        self.assertTrue(np.array_equal(direct_map, cached_map))
+
+    def test_erosion_conserves_material(self):
+        height_map = np.fromfunction(lambda x, y: np.sin(x / 4) + np.cos(y / 3) + 2, (40, 40))
+        total = height_map.sum()
+        eroded = erode(height_map.copy(), 500, batch_size=200, seed=1)
+        self.assertAlmostEqual(eroded.sum(), total, places=6)
+        self.assertFalse(np.allclose(eroded, height_map))
+        # Droplets run downhill, so material moves from high ground to low ground
+        high = height_map > np.quantile(height_map, 0.8)
+        low = height_map < np.quantile(height_map, 0.2)
+        self.assertLess((eroded - height_map)[high].mean(), 0)
+        self.assertGreater((eroded - height_map)[low].mean(), 0)
+
+    def test_tiled_erosion(self):
+        height_map = np.fromfunction(lambda x, y: np.sin(x / 6) + np.cos(y / 5) + 2, (96, 80))
+        serial = erode(height_map.copy(), 1000, seed=2, max_steps=300)
+        # Two rounds of six tiles
+        tiled = tiled_erode(height_map.copy(), 1000, tile_size=40, halo=8, workers=1, batch_size=100, seed=2, max_steps=300)
+        self.assertTrue(np.array_equal(tiled_erode(height_map.copy(), 1000, tile_size=40, halo=8, workers=2, batch_size=100,
+                                                   seed=2, max_steps=300), tiled))
+        self.assertAlmostEqual(tiled.sum(), height_map.sum(), places=6)
+        serial_change = np.abs(serial - height_map).mean()
+        tiled_change = np.abs(tiled - height_map).mean()
+        self.assertLess(abs(tiled_change - serial_change), serial_change * 0.25)
+
+        # On a slope along y droplets barely move in x, so each row's erosion follows how many droplets started near
+        # it. The rows either side of the seams between tiles get as much as the rest
+        slope = np.fromfunction(lambda x, y: 2 + 0.05 * y + 0 * x, (96, 80))
+        row_change = np.abs(tiled_erode(slope.copy(), 4000, tile_size=40, halo=8, workers=1, batch_size=1000, seed=2,
+                                         max_steps=300) - slope).mean(axis=1)
+        self.assertGreater(row_change[[39, 40, 79, 80]].mean(), 0.85 * np.median(row_change))
+
 if __name__ == "__main__":
     unittest.main() 
         
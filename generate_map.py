@@ -1,34 +1,68 @@
-from particle import ThermalParticleDistribution
+from particle import ThermalParticleDistribution, SimulationMode
+from map_cache import MapLayerCache
 import generate_terrain
+import map_format
+import numpy as np
 import time
 import os
 import argparse
 import json
 
-def generate_map(dim_x, dim_y, map_type):
+def cached_layer(cache, stage, parameters, build):
+    if cache is None:
+        return build()
+    return cache.layer(stage, parameters, build)
+
+def generate_map(dim_x, dim_y, map_type, seed = None, workers = 1, wind = (0, 0), max_thermal = None, cache = None, thermal_mode = SimulationMode.BATCH,
+                 erosion_droplets = 0, erosion_tile_size = None):
     print(f"Beginning Generation")
     start_time = time.time()
-    map_layer = None
-    thermal_strength = None
-    if (map_type == "big_ranges"):
-        map_layer = generate_terrain.generate_big_ranges(dim_x, dim_y)
-        thermal_strength = 7
-    elif (map_type == "little_ranges"):
-        map_layer = generate_terrain.generate_little_ranges(dim_x, dim_y)
-        thermal_strength = 4
-    else: 
+    if map_type not in generate_terrain.RECIPE_THERMAL_STRENGTH:
         raise Exception("Bad map type specified")
+    thermal_strength = generate_terrain.RECIPE_THERMAL_STRENGTH[map_type]
+    if max_thermal is not None:
+        thermal_strength = max_thermal
+    if seed is None and cache is not None:
+        print("No seed given, not using the map cache")
+        cache = None
+
+    # Each stage's parameters include everything upstream of it
+    terrain_parameters = {"map_type": map_type, "dim_x": dim_x, "dim_y": dim_y, "seed": seed}
+    height_parameters = dict(terrain_parameters, erosion_droplets=erosion_droplets, erosion_tile_size=erosion_tile_size)
+    particle_parameters = dict(height_parameters, wind=list(wind), thermal_mode=thermal_mode.name)
+    thermal_parameters = dict(particle_parameters, max_thermal=thermal_strength)
+
+    noise_layer = cached_layer(cache, "noise", terrain_parameters,
+                               lambda: generate_terrain.recipe_noise(map_type, dim_x, dim_y, seed=seed, workers=workers))
+    map_layer = cached_layer(cache, "height", height_parameters,
+                             lambda: generate_terrain.shape_recipe(map_type, np.array(noise_layer), verbose=True,
+                                                                   erosion_droplets=erosion_droplets, seed=seed,
+                                                                   erosion_tile_size=erosion_tile_size, workers=workers))
+    map_layer = np.array(map_layer)
     map_gen_time = time.time()
     elapsed_time = map_gen_time - start_time
     print(f"Map generation took {elapsed_time}s")
-    thermals = ThermalParticleDistribution((dim_x * dim_y)/10, map_layer, thermal_strength)
-    thermal_distribution_time = time.time()
-    elapsed_time = thermal_distribution_time - map_gen_time
-    print(f"Distribution took {elapsed_time}s")
-    thermals.simulate_particles((0, 0))
-    sim_time = time.time()
-    elapsed_time = sim_time - thermal_distribution_time
-    print(f"Simulation took {elapsed_time}s")
+
+    thermals = ThermalParticleDistribution(0, map_layer, thermal_strength, seed=seed)
+    def simulate():
+        distribution_start_time = time.time()
+        thermals.particles = thermals.distribute_particles((dim_x * dim_y)/10)
+        thermal_distribution_time = time.time()
+        elapsed_time = thermal_distribution_time - distribution_start_time
+        print(f"Distribution took {elapsed_time}s")
+        thermals.simulate_particles(wind, mode=thermal_mode)
+        elapsed_time = time.time() - thermal_distribution_time
+        print(f"Simulation took {elapsed_time}s")
+        return thermals.particle_state()
+    particle_state = cached_layer(cache, "particles", particle_parameters, simulate)
+
+    def aggregate():
+        if not thermals.thermal_movement_simulated:
+            thermals.load_particle_state(particle_state)
+            thermals.aggregate_particles()
+        return np.array(thermals.thermal_map)
+    thermal_map = cached_layer(cache, "thermal_map", thermal_parameters, aggregate)
+    thermals.thermal_map = np.array(thermal_map)
     return(map_layer, thermals)
     
 
@@ -40,18 +74,43 @@ def save_map_file(hm, tm, folder):
         json.dump(hm.tolist(), f)
 
     with open(os.path.join(folder, "thermal_map.json"), "w") as f:
-        json.dump(tm, f)
+        json.dump(np.asarray(tm).tolist(), f)
 
 
-def build_json_map_file(map_type, dim_x, dim_y, folder):
-    map_layer, thermals = generate_map(dim_x, dim_y, map_type)
+def build_json_map_file(map_type, dim_x, dim_y, folder, seed = None, workers = 1, wind = (0, 0), max_thermal = None, cache = None, thermal_mode = SimulationMode.BATCH,
+                        erosion_droplets = 0, erosion_tile_size = None):
+    map_layer, thermals = generate_map(dim_x, dim_y, map_type, seed=seed, workers=workers, wind=wind, max_thermal=max_thermal, cache=cache, thermal_mode=thermal_mode,
+                                       erosion_droplets=erosion_droplets, erosion_tile_size=erosion_tile_size)
     save_map_file(map_layer, thermals.thermal_map, folder)
 
+def build_binary_map_file(map_type, dim_x, dim_y, folder, seed = None, workers = 1, wind = (0, 0), max_thermal = None, cache = None, thermal_mode = SimulationMode.BATCH,
+                          erosion_droplets = 0, erosion_tile_size = None):
+    map_layer, thermals = generate_map(dim_x, dim_y, map_type, seed=seed, workers=workers, wind=wind, max_thermal=max_thermal, cache=cache, thermal_mode=thermal_mode,
+                                       erosion_droplets=erosion_droplets, erosion_tile_size=erosion_tile_size)
+    map_format.save_map_files(map_layer, thermals.thermal_map, folder)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("dim_x", type=int)
     parser.add_argument("dim_y", type=int)
     parser.add_argument("--map_type", default="big_ranges")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--wind", type=float, nargs=2, default=(0, 0))
+    parser.add_argument("--max_thermal", type=float, default=None)
+    parser.add_argument("--cache_dir", default=None)
+    parser.add_argument("--cache_size_mb", type=int, default=2048)
+    parser.add_argument("--format", choices=["binary", "json"], default="binary")
+    parser.add_argument("--thermal_mode", choices=[mode.name.lower() for mode in SimulationMode], default="batch")
+    parser.add_argument("--erosion_droplets", type=int, default=0)
+    parser.add_argument("--erosion_tile_size", type=int, default=None)
 
     args = parser.parse_args()
-    build_json_map_file(args.map_type, args.dim_x, args.dim_y, os.path.join("soaring-game/public/assets/maps", args.map_type))
+    cache = None
+    if args.cache_dir is not None:
+        cache = MapLayerCache(args.cache_dir, max_bytes=args.cache_size_mb * 1024 * 1024)
+    build_map_file = build_binary_map_file if args.format == "binary" else build_json_map_file
+    build_map_file(args.map_type, args.dim_x, args.dim_y, os.path.join("soaring-game/public/assets/maps", args.map_type), seed=args.seed, workers=args.workers,
+                   wind=tuple(args.wind), max_thermal=args.max_thermal, cache=cache,
+                   thermal_mode=SimulationMode[args.thermal_mode.upper()], erosion_droplets=args.erosion_droplets,
+                   erosion_tile_size=args.erosion_tile_size)
@@ -1,76 +1,181 @@
 import matplotlib.pyplot as plt
 import perlin_noise
 from particle import ThermalParticleDistribution
+import erosion
 import numpy as np
 from isometrics import create_iso_lines, xyz_to_iso_xy
 from matplotlib.collections import LineCollection
 import matplotlib.animation as animation
 import random
+import time
 from enum import Enum
 
 
 def flatten(terrain, threshold, above = True):
-    flattened_terrain = terrain
-    for x_index in range(len(terrain)):
-        for y_index in range(len(terrain[0])):
-            if ((terrain[x_index][y_index] < threshold) and above):
-                flattened_terrain[x_index][y_index] = threshold
-            elif ((terrain[x_index][y_index] > threshold) and not above):
-                flattened_terrain[x_index][y_index] = threshold
-    return flattened_terrain
+    """ Clamp the terrain in place so that it lies above (or below) threshold """
+    if above:
+        np.maximum(terrain, threshold, out=terrain)
+    else:
+        np.minimum(terrain, threshold, out=terrain)
+    return terrain
 
 def augment(terrain, function):
-    augmented_terrain = terrain
-    for x_index in range(len(terrain)):
-        for y_index in range(len(terrain[0])):
-            augmented_terrain[x_index][y_index] = function(terrain[x_index][y_index])
+    """ Apply a whole-array (ufunc style) function to the terrain in place """
+    if isinstance(function, np.ufunc):
+        function(terrain, out=terrain)
+    else:
+        terrain[...] = function(terrain)
+    return terrain
 
-    return augmented_terrain
+def normalize(terrain, max_value = None, out = None):
+    """
+    Return the terrain scaled so its maximum is 1, as a new array or written into out (which may be terrain itself).
+    A fixed max_value can be given instead of the terrain's own maximum. Terrain with no positive maximum can't be
+    scaled to 1 and is returned unscaled.
+    """
+    if max_value is None:
+        max_value = np.max(terrain)
+    if max_value <= 0:
+        max_value = 1
+    return np.divide(terrain, max_value, out=out)
 
-def normalize(terrain):
-    max_value = 0
-    for x_index in range(len(terrain)):
-        for y_index in range(len(terrain[0])):
-            if (terrain[x_index][y_index] > max_value):
-                max_value = terrain[x_index][y_index]
-    return (terrain/max_value)
+class TerrainPipeline():
+    """
+    A list of (name, stage) post-processing steps run in order on a single terrain buffer.
+    Each stage modifies the buffer in place with whole-array numpy operations. The time spent in each stage of the
+    last run is kept in stage_times.
+    """
+    def __init__(self, stages):
+        self.stages = stages
+        self.stage_times = []
 
-    
-def generate_big_ranges(dim_x, dim_y):
-    noise_layers = [ 3 * perlin_noise.noise_map(dim_x, dim_y, 1,               z_pos=random.random() * 10), 
-                     8 * perlin_noise.noise_map(dim_x, dim_y, 5,  scale_y = 2, z_pos=random.random() * 10), 
-                     2 * perlin_noise.noise_map(dim_x, dim_y, 15, scale_y = 5, z_pos=random.random() * 10), 
-                     5 * perlin_noise.noise_map(dim_x, dim_y, 20,              z_pos=random.random() * 10)]
-    map_layer = np.sum(noise_layers, axis=0)
-    map_layer += 2
-    map_layer = normalize(map_layer)
-    map_layer = flatten(map_layer, 0, above=True)
-    # map_layer = augment(map_layer, sigmoid)
-    map_layer *= 4
-    return map_layer
-    
+    def run(self, terrain):
+        self.stage_times = []
+        for name, stage in self.stages:
+            start_time = time.time()
+            stage(terrain)
+            self.stage_times.append((name, time.time() - start_time))
+        return terrain
 
-def generate_little_ranges(dim_x, dim_y):
-    noise_layers = [10 * perlin_noise.noise_map(dim_x, dim_y, 10, z_pos=random.random() * 10), 
-                     4 * perlin_noise.noise_map(dim_x, dim_y, 40, z_pos=random.random() * 10)]
-    map_layer = np.sum(noise_layers, axis=0)
-    map_layer = normalize(map_layer)
-    map_layer = flatten(map_layer, 0, above=True)
-    map_layer *= 2
-    return map_layer
+    def report(self):
+        return ", ".join(f"{name} {elapsed_time:.4f}s" for name, elapsed_time in self.stage_times)
+
+def offset_stage(value):
+    return ("offset", lambda terrain: np.add(terrain, value, out=terrain))
+
+def scale_stage(factor):
+    return ("scale", lambda terrain: np.multiply(terrain, factor, out=terrain))
+
+def clip_stage(minimum = None, maximum = None):
+    return ("clip", lambda terrain: np.clip(terrain, minimum, maximum, out=terrain))
+
+def normalize_stage(max_value = None):
+    return ("normalize", lambda terrain: normalize(terrain, max_value, out=terrain))
+
+def transform_stage(function, name = "transform"):
+    return (name, lambda terrain: augment(terrain, function))
+
+def erosion_stage(droplets, seed = None, batch_size = 10000, tile_size = None, workers = 1):
+    if tile_size is None:
+        return ("erosion", lambda terrain: erosion.erode(terrain, droplets, batch_size=batch_size, seed=seed))
+    return ("tiled erosion", lambda terrain: erosion.tiled_erode(terrain, droplets, tile_size, tile_size // 8, workers,
+                                                                 batch_size=batch_size, seed=seed))
+
+
+def seeded_generators(seed = None):
+    """
+    Return the noise generator and the random source for the z offsets of a terrain recipe.
+    The same seed always gives the same terrain; without a seed the classic permutation table and a fresh random state are used.
+    """
+    return perlin_noise.PerlinNoise(seed), random.Random(seed)
+
+def noise_bound(noise, octaves, extent = 1024, stride = 4):
+    """
+    Maximum of the layered noise sampled every stride cells over an extent x extent region at the origin.
+    Maps generated piece by piece are normalized by this rather than their own maximum, so they come out as tall as a
+    generate_recipe map of the same recipe and seed.
+    """
+    # Sampling every stride cells is the same as scaling every octave's frequency by stride
+    strided = [(weight, scale_x * stride, (scale_x if scale_y == -1 else scale_y) * stride, z_pos)
+               for weight, scale_x, scale_y, z_pos in octaves]
+    return float(np.max(noise.layered_noise_map(extent // stride, extent // stride, strided)))
+
+# Each recipe is a set of noise octaves followed by a post-processing pipeline.
+# The pipeline normalizes by the map maximum, or by a sampled bound on the noise when the map is built in pieces (see terrain_chunks)
 
-def generate_lengthwise_ranges(dim_x, dim_y):
-    noise_layers = [perlin_noise.noise_map(dim_x, dim_y, 15, scale_y = 4, z_pos=random.random() * 10), 
-                    perlin_noise.noise_map(dim_x, dim_y, 30, scale_y = 15, z_pos=random.random() * 10), 
-                    perlin_noise.noise_map(dim_x, dim_y, 50, z_pos=random.random() * 10)]
-    map_layer = np.sum([noise_layers[0]*10, noise_layers[1]*6, noise_layers[2] * 2], axis=0)
-    map_layer = normalize(map_layer)
-    map_layer = flatten(map_layer, 0, above=True)
-    map_layer = flatten(map_layer, 0, above=True)
-    map_layer = augment(map_layer, lambda x: (x*x*x + np.pow(x, 1/3))/2)
-    map_layer *= 3
+def big_ranges_octaves(rng):
+    return [(3, 1,  -1, rng.random() * 10),
+            (8, 5,   2, rng.random() * 10),
+            (2, 15,  5, rng.random() * 10),
+            (5, 20, -1, rng.random() * 10)]
+
+def big_ranges_pipeline(bound = None):
+    return TerrainPipeline([offset_stage(2),
+                            normalize_stage(None if bound is None else bound + 2),
+                            clip_stage(minimum=0),
+                            # transform_stage(sigmoid, "sigmoid"),
+                            scale_stage(4)])
+
+def little_ranges_octaves(rng):
+    return [(10, 10, -1, rng.random() * 10),
+            (4,  40, -1, rng.random() * 10)]
+
+def little_ranges_pipeline(bound = None):
+    return TerrainPipeline([normalize_stage(bound),
+                            clip_stage(minimum=0),
+                            scale_stage(2)])
+
+def lengthwise_ranges_octaves(rng):
+    return [(10, 15,  4, rng.random() * 10),
+            (6,  30, 15, rng.random() * 10),
+            (2,  50, -1, rng.random() * 10)]
+
+def lengthwise_ranges_pipeline(bound = None):
+    return TerrainPipeline([normalize_stage(bound),
+                            clip_stage(minimum=0),
+                            transform_stage(lambda x: (x*x*x + np.pow(x, 1/3))/2, "cube blend"),
+                            scale_stage(3)])
+
+RECIPES = {"big_ranges": (big_ranges_octaves, big_ranges_pipeline),
+           "little_ranges": (little_ranges_octaves, little_ranges_pipeline),
+           "lengthwise_ranges": (lengthwise_ranges_octaves, lengthwise_ranges_pipeline)}
+
+# Thermal strength generate_map simulates each of its map types with
+RECIPE_THERMAL_STRENGTH = {"big_ranges": 7, "little_ranges": 4}
+
+def recipe_noise(recipe, dim_x, dim_y, seed = None, workers = 1):
+    """ Layered noise for a recipe, before post-processing """
+    noise, rng = seeded_generators(seed)
+    octaves_function, _ = RECIPES[recipe]
+    return noise.tiled_layered_noise_map(dim_x, dim_y, octaves_function(rng), workers=workers)
+
+def shape_recipe(recipe, map_layer, verbose = False, erosion_droplets = 0, seed = None, erosion_tile_size = None, workers = 1):
+    """
+    Run a recipe's post-processing pipeline in place on its noise, optionally eroding the result.
+    With an erosion_tile_size the erosion runs in tiles on workers processes.
+    """
+    _, pipeline_function = RECIPES[recipe]
+    pipeline = pipeline_function()
+    if erosion_droplets > 0:
+        pipeline.stages.append(erosion_stage(erosion_droplets, seed, tile_size=erosion_tile_size, workers=workers))
+    pipeline.run(map_layer)
+    if verbose:
+        print(f"Terrain stages: {pipeline.report()}")
     return map_layer
 
+def generate_recipe(recipe, dim_x, dim_y, seed = None, workers = 1, verbose = False, erosion_droplets = 0, erosion_tile_size = None):
+    return shape_recipe(recipe, recipe_noise(recipe, dim_x, dim_y, seed, workers), verbose, erosion_droplets, seed,
+                        erosion_tile_size, workers)
+
+def generate_big_ranges(dim_x, dim_y, seed = None, workers = 1, verbose = False):
+    return generate_recipe("big_ranges", dim_x, dim_y, seed, workers, verbose)
+
+def generate_little_ranges(dim_x, dim_y, seed = None, workers = 1, verbose = False):
+    return generate_recipe("little_ranges", dim_x, dim_y, seed, workers, verbose)
+
+def generate_lengthwise_ranges(dim_x, dim_y, seed = None, workers = 1, verbose = False):
+    return generate_recipe("lengthwise_ranges", dim_x, dim_y, seed, workers, verbose)
+
 def sigmoid(x):
     return (1/(1+np.pow(10, -(4*x-2))))
     
@@ -0,0 +1,110 @@
+import numpy as np
+import unittest
+import tempfile
+import hashlib
+import json
+import os
+
+# Modules whose source is hashed into every cache key, so changing the generation code invalidates old layers
+CACHED_MODULES = ["perlin_noise.py", "generate_terrain.py", "particle.py", "erosion.py"]
+
+def code_version():
+    digest = hashlib.sha256()
+    for module in CACHED_MODULES:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), module), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+class MapLayerCache():
+    """
+    Content addressed on-disk cache of intermediate map layers.
+    Each layer is stored as a .npy file named by a hash of (stage, parameters, code version) and loaded memory mapped.
+    Parameters should hold everything the layer depends on (recipe, dimensions, seed, wind, ...), so a run that only
+    changes a downstream parameter reuses every upstream layer. The least recently used layers are evicted once the
+    folder grows past max_bytes.
+    """
+    def __init__(self, folder, max_bytes = 2 * 1024 ** 3):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.version = code_version()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def key(self, stage, parameters):
+        description = json.dumps({"stage": stage, "parameters": parameters, "code_version": self.version}, sort_keys=True)
+        return f"{stage}-{hashlib.sha256(description.encode()).hexdigest()[:32]}"
+
+    def path(self, key):
+        return os.path.join(self.folder, key + ".npy")
+
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+        # Touch the file so eviction sees it as recently used
+        os.utime(path)
+        return np.load(path, mmap_mode="r")
+
+    def store(self, key, layer):
+        path = self.path(key)
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            np.save(f, np.asarray(layer))
+        os.replace(temporary_path, path)
+        self.evict(keep=path)
+
+    def layer(self, stage, parameters, build):
+        """ Return the cached layer for stage and parameters, calling build() to create it on a miss """
+        key = self.key(stage, parameters)
+        layer = self.load(key)
+        if layer is not None:
+            self.hits += 1
+            print(f"Loaded {stage} from cache")
+            return layer
+        self.misses += 1
+        layer = build()
+        self.store(key, layer)
+        return layer
+
+    def evict(self, keep = None):
+        """ Remove least recently used layers until the cache fits in max_bytes """
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith(".npy"):
+                path = os.path.join(self.folder, name)
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total_size -= size
+
+
+class TestMapLayerCache(unittest.TestCase):
+
+    def test_layer_reuse_and_eviction(self):
+        with tempfile.TemporaryDirectory() as folder:
+            cache = MapLayerCache(folder, max_bytes=3000)
+            builds = []
+            def build():
+                builds.append(1)
+                return np.arange(200, dtype=np.float64)
+
+            first = cache.layer("height", {"seed": 1}, build)
+            second = cache.layer("height", {"seed": 1}, build)
+            self.assertEqual(len(builds), 1)
+            self.assertTrue(np.array_equal(first, second))
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            # Each layer is ~1.7kB, so storing a second one evicts the first
+            cache.layer("height", {"seed": 2}, build)
+            self.assertEqual(len(os.listdir(folder)), 1)
+            cache.layer("height", {"seed": 1}, build)
+            self.assertEqual(len(builds), 3)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+import numpy as np
+import unittest
+import tempfile
+import argparse
+import struct
+import json
+import gzip
+import time
+import os
+
+# Binary map layer format, written gzip compressed (".bin.gz")
+#
+# Header, 24 bytes little endian:
+#   magic     4s   b"SGMP"
+#   version   u8
+#   dtype     u8   one of DTYPE_CODES
+#   reserved  u16
+#   dim_x     u32
+#   dim_y     u32
+#   scale     f32
+#   offset    f32
+# Payload: dim_x * dim_y values of dtype, ordered so that layer[x][y] = payload[x * dim_y + y].
+# Stored values are quantized, the real value is offset + stored * scale.
+# The 24 byte header keeps the payload aligned for a Float32Array/Uint16Array view on the client (components/map_format.js)
+
+MAGIC = b"SGMP"
+VERSION = 1
+HEADER = struct.Struct("<4sBBHIIff")
+DTYPE_CODES = {"uint8": 1, "uint16": 2, "float32": 3}
+CODE_DTYPES = {code: np.dtype(name) for name, code in DTYPE_CODES.items()}
+
+HEIGHT_MAP_FILE = "height_map.bin.gz"
+THERMAL_MAP_FILE = "thermal_map.bin.gz"
+
+def quantization(layer, dtype):
+    """ Return (scale, offset) mapping the range of layer onto the integer range of dtype """
+    if dtype == "float32":
+        return 1.0, 0.0
+    minimum = float(np.min(layer))
+    maximum = float(np.max(layer))
+    steps = np.iinfo(dtype).max
+    scale = (maximum - minimum)/steps
+    if scale == 0:
+        scale = 1.0
+    return scale, minimum
+
+def write_map_layer(path, layer, dtype = "uint16", rows_per_block = 256):
+    """ Quantize and stream a map layer (layer[x][y]) to a gzip compressed binary file, a block of rows at a time """
+    layer = np.asarray(layer)
+    dim_x, dim_y = layer.shape
+    scale, offset = quantization(layer, dtype)
+    # Quantize against the values stored in the header so the reader reproduces them exactly
+    scale32, offset32 = np.float32(scale), np.float32(offset)
+
+    # No timestamp or file name in the gzip header, so the same layer always gives the same bytes
+    with open(path, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", mtime=0, filename="") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, DTYPE_CODES[dtype], 0, dim_x, dim_y, scale32, offset32))
+        for block_start in range(0, dim_x, rows_per_block):
+            block = layer[block_start:block_start + rows_per_block].astype(np.float64)
+            if dtype != "float32":
+                block = np.clip(np.rint((block - float(offset32))/float(scale32)), 0, np.iinfo(dtype).max)
+            f.write(block.astype("<" + np.dtype(dtype).str[1:]).tobytes())
+
+def read_map_layer(path):
+    """ Read a binary map layer back into a float32 array indexed [x][y] """
+    with gzip.open(path, "rb") as f:
+        magic, version, dtype_code, _, dim_x, dim_y, scale, offset = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} map layer")
+        dtype = CODE_DTYPES[dtype_code].newbyteorder("<")
+        payload = np.frombuffer(f.read(dim_x * dim_y * dtype.itemsize), dtype=dtype)
+    values = payload.astype(np.float32) * np.float32(scale) + np.float32(offset)
+    return values.reshape(dim_x, dim_y)
+
+def save_map_files(hm, tm, folder):
+    """ Write height (uint16) and thermal (uint8) layers in the binary format """
+    os.makedirs(folder, exist_ok=True)
+    write_map_layer(os.path.join(folder, HEIGHT_MAP_FILE), hm, "uint16")
+    write_map_layer(os.path.join(folder, THERMAL_MAP_FILE), tm, "uint8")
+
+def convert_json_map(folder):
+    """ Convert the height_map.json and thermal_map.json in folder to binary layers alongside them """
+    with open(os.path.join(folder, "height_map.json"), "r") as f:
+        hm = np.array(json.load(f))
+    with open(os.path.join(folder, "thermal_map.json"), "r") as f:
+        tm = np.array(json.load(f))
+    save_map_files(hm, tm, folder)
+    for name in ["height_map", "thermal_map"]:
+        json_size = os.path.getsize(os.path.join(folder, name + ".json"))
+        binary_size = os.path.getsize(os.path.join(folder, name + ".bin.gz"))
+        print(f"{name}: {json_size} bytes of JSON -> {binary_size} bytes")
+
+
+class TestMapFormat(unittest.TestCase):
+
+    def test_round_trip(self):
+        rng = np.random.default_rng(0)
+        height_map = rng.random((37, 23)) * 4
+        thermal_map = rng.random((37, 23)) * 7
+        thermal_map[0, 0] = 0
+        with tempfile.TemporaryDirectory() as folder:
+            save_map_files(height_map, thermal_map, folder)
+            heights = read_map_layer(os.path.join(folder, HEIGHT_MAP_FILE))
+            thermals = read_map_layer(os.path.join(folder, THERMAL_MAP_FILE))
+
+            path = os.path.join(folder, "float.bin.gz")
+            write_map_layer(path, height_map, "float32", rows_per_block=5)
+            exact = read_map_layer(path)
+
+        self.assertEqual(heights.dtype, np.float32)
+        self.assertEqual(heights.shape, (37, 23))
+        self.assertLess(np.max(np.abs(heights - height_map)), 4/65535)
+        self.assertLess(np.max(np.abs(thermals - thermal_map)), 7/255)
+        self.assertEqual(thermals[0, 0], 0)
+        self.assertTrue(np.array_equal(exact, height_map.astype(np.float32)))
+
+    def test_reproducible_bytes(self):
+        height_map = np.random.default_rng(1).random((40, 30)) * 4
+        contents = []
+        with tempfile.TemporaryDirectory() as folder:
+            for name in ["first.bin.gz", "second.bin.gz"]:
+                path = os.path.join(folder, name)
+                # Different names and a second apart, which gzip.open would both record
+                write_map_layer(path, height_map)
+                with open(path, "rb") as f:
+                    contents.append(f.read())
+                time.sleep(1.1)
+        self.assertEqual(contents[0], contents[1])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert JSON map folders to the binary map format")
+    parser.add_argument("folders", nargs="+")
+
+    args = parser.parse_args()
+    for folder in args.folders:
+        convert_json_map(folder)
@@ -1,7 +1,9 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
+from enum import Enum
 import numpy as np
 import unittest 
-import random
+import tempfile
+import os
 import time
 
 FRICTION = 0.2
@@ -9,32 +11,43 @@ STICKINESS = 0.05
 SEA_LEVEL_PROBABILITY = 0.25
 MAX_PROABILITY_CEILING = 3
 MAX_THERMAL_STRENGTH = 5
+INITIAL_HEAT_ENERGY = 100.0
 
-@dataclass
+# Share of a particle's heat added to each of the cells around it, to make thermals wider
+SPREAD_KERNEL = np.array([[0.2, 0.4, 0.2],
+                          [0.4, 1.0, 0.4],
+                          [0.2, 0.4, 0.2]])
+
+class SimulationMode(Enum):
+    OBJECTS = 0
+    BATCH = 1
+    ASCENT_GRAPH = 2
+
+@dataclass(slots=True)
 class Particle():
     # Location, Velocity
     position_x: int
     position_y: int
 
     friction: float = FRICTION
-    velocity_x = 0
-    velocity_y = 0
+    velocity_x: float = 0
+    velocity_y: float = 0
 
     # partical volume
-    volume = 10.0
+    volume: float = 10.0
     
     # Volume of sediment 
-    sediment = 0.0
+    sediment: float = 0.0
 
     # Particle density
-    density = 0.1
-
-    def normal_force(self, heightmap, force = -9.8):
-        """ Calculate the gradient of the current position on the given heightmap"""
-        normal_x = 0
-        normal_y = 0
-
+    density: float = 0.1
 
+    def normal_force(self, heightmap, force = -9.8, gradient = None):
+        """
+        Calculate the gradient of the current position on the given heightmap.
+        The slope is interpolated bilinearly between the four cells around the position, read from a GradientField
+        for the heightmap when one is given and computed from the heightmap otherwise, with the same result.
+        """
         # Given a slope with opposite Δ, adjacent s, hypotenuse h and angle θ
         #   |\
         #   | \
@@ -57,46 +70,22 @@ class Particle():
         # Finally, 
         # Fnx = mg * (s * Δ)/(s^s + Δ^2)
 
+        # The slope terms (s * Δ)/(s^2 + Δ^2) use centred differences inside the map (s = 2) and one sided ones at
+        # the edges (s = 1), see slope_terms
         mg = self.density * self.volume * force
-
-        # TODO Clean this up. Is fractional indicies the right way to hold position?
-
-        delta_x, delta_y = 0, 0
-
-        # left side of map
-        span = 1
-        if int(self.position_x) == 0:
-            delta_x = heightmap[0][int(self.position_y)] - heightmap[1][int(self.position_y)]
-        # right side of map
-        elif int(self.position_x) >= (len(heightmap) - 2):
-            delta_x = heightmap[-2][int(self.position_y)] - heightmap[-1][int(self.position_y)]
-        # anywhere else in map
-        else:
-            delta_x = heightmap[int(self.position_x)-1][int(self.position_y)] - heightmap[int(self.position_x)+1][int(self.position_y)]
-            span = 2
-        normal_x = mg * (span * delta_x)/(span ** 2 + delta_x **2)
-
-        # bottom of map
-        span = 1
-        if int(self.position_y) == 0:
-            delta_y = (heightmap[int(self.position_x)][0] - heightmap[int(self.position_x)][1])
-        # top of map
-        elif int(self.position_y) >= (len(heightmap[0]) - 2):
-            delta_y = (heightmap[int(self.position_x)][-2] - heightmap[int(self.position_x)][-1])
+        if gradient is not None:
+            slope_x, slope_y = gradient.sample_point(self.position_x, self.position_y)
         else:
-            delta_y = (heightmap[int(self.position_x)][int(self.position_y)-1] - heightmap[int(self.position_x)][int(self.position_y)+1])
-            span = 2
-        normal_y = mg * (span * delta_y)/((span ** 2) + (delta_y ** 2))
-
-        return normal_x, normal_y
+            slope_x, slope_y = sample_slope_point(heightmap, self.position_x, self.position_y)
+        return mg * float(slope_x), mg * float(slope_y)
 
     def particle_speed(self):
         """ Calculate the magnitude of the current particle velocity """
         return np.sqrt(self.velocity_x**2 + self.velocity_y**2)
     
-    def step_dynamics(self, heightmap, dt = 1, force = -9.8):
+    def step_dynamics(self, heightmap, dt = 1, force = -9.8, gradient = None):
         """ Step the particle down a heightmap subject to gravity"""
-        normal_x, normal_y = self.normal_force(heightmap, force)
+        normal_x, normal_y = self.normal_force(heightmap, force, gradient)
 
         # Calculate acceleration based on provided surface normal vector
         acceleraton_x = normal_x/(self.volume * self.density)
@@ -128,11 +117,147 @@ class Particle():
             self.position_y = len(heightmap[0]) - 1
             self.velocity_y = 0
 
+def slope_neighbours(size):
+    """
+    For every index along an axis of size cells, the two cells its slope is taken between and their distance:
+    centred inside the map, one sided at the edges
+    """
+    index = np.arange(size)
+    low = np.where(index == 0, 0, np.where(index >= size - 2, size - 2, index - 1))
+    high = np.where(index == 0, 1, np.where(index >= size - 2, size - 1, index + 1))
+    span = np.where((index == 0) | (index >= size - 2), 1.0, 2.0)
+    return low, high, span
+
+def cell_reader(height_map):
+    """ A function reading height_map[x, y] for integer arrays x and y """
+    if not height_map.flags.c_contiguous:
+        return lambda x, y: height_map[x, y]
+    # Gathering by flat index skips numpy's per axis index handling, several times faster for scattered cells
+    flat = height_map.reshape(-1)
+    map_height = height_map.shape[1]
+    return lambda x, y: flat[x * map_height + y]
+
+def slope_terms(height_map, x, y):
+    """ Vectorized slope terms of Particle.normal_force for cells (x, y), integer arrays that broadcast together """
+    map_width, map_height = height_map.shape
+    cells = cell_reader(height_map)
+    # Looking the neighbours up per axis is much cheaper than working out the edge cases per cell
+    left_x, right_x, span_x = (table[x] for table in slope_neighbours(map_width))
+    delta_x = cells(left_x, y) - cells(right_x, y)
+
+    down_y, up_y, span_y = (table[y] for table in slope_neighbours(map_height))
+    delta_y = cells(x, down_y) - cells(x, up_y)
+    return (span_x * delta_x)/(span_x ** 2 + delta_x ** 2), (span_y * delta_y)/(span_y ** 2 + delta_y ** 2)
+
+def slope_term(height_map, x, y, map_width, map_height):
+    """ slope_terms for a single integer cell, read with plain indexing so the height map may be a list of rows """
+    if x == 0:
+        left_x, right_x, span_x = 0, 1, 1
+    elif x >= map_width - 2:
+        left_x, right_x, span_x = map_width - 2, map_width - 1, 1
+    else:
+        left_x, right_x, span_x = x - 1, x + 1, 2
+    delta_x = float(height_map[left_x][y]) - float(height_map[right_x][y])
+
+    if y == 0:
+        down_y, up_y, span_y = 0, 1, 1
+    elif y >= map_height - 2:
+        down_y, up_y, span_y = map_height - 2, map_height - 1, 1
+    else:
+        down_y, up_y, span_y = y - 1, y + 1, 2
+    delta_y = float(height_map[x][down_y]) - float(height_map[x][up_y])
+    return (span_x * delta_x)/(span_x ** 2 + delta_x ** 2), (span_y * delta_y)/(span_y ** 2 + delta_y ** 2)
+
+def interpolate_slopes(shape, position_x, position_y, slopes):
+    """
+    Bilinear interpolation at fractional positions of slopes(x, y), which returns the (slope_x, slope_y) arrays of
+    integer cells. It's called once with the four corners of every position stacked along a new first axis.
+    Shared by sample_slope and GradientField.sample so both round identically
+    """
+    map_width, map_height = shape
+    x0 = np.minimum(np.floor(position_x).astype(np.int64), map_width - 2)
+    y0 = np.minimum(np.floor(position_y).astype(np.int64), map_height - 2)
+    fraction_x = np.asarray(position_x - x0)
+    fraction_y = np.asarray(position_y - y0)
+    weights = ((1 - fraction_x) * (1 - fraction_y), fraction_x * (1 - fraction_y),
+               (1 - fraction_x) * fraction_y, fraction_x * fraction_y)
+    corners = slopes(np.stack([x0, x0 + 1, x0, x0 + 1]), np.stack([y0, y0, y0 + 1, y0 + 1]))
+    return tuple(weights[0] * slope[0] + weights[1] * slope[1] + weights[2] * slope[2] + weights[3] * slope[3]
+                 for slope in corners)
+
+def sample_slope(height_map, position_x, position_y):
+    """
+    What GradientField(height_map).sample returns, computed from the height map without building the field.
+    The corner slopes of all positions come from a single slope_terms call
+    """
+    return interpolate_slopes(height_map.shape, position_x, position_y, lambda x, y: slope_terms(height_map, x, y))
+
+def blend_point(corners, fraction_x, fraction_y):
+    """ Bilinear blend for one position of corners[x][y] = (slope_x, slope_y), in the order interpolate_slopes uses """
+    slope = [(1 - fraction_x) * (1 - fraction_y) * corners[0][0][axis] + fraction_x * (1 - fraction_y) * corners[1][0][axis] +
+             (1 - fraction_x) * fraction_y * corners[0][1][axis] + fraction_x * fraction_y * corners[1][1][axis]
+             for axis in (0, 1)]
+    return slope[0], slope[1]
+
+def sample_slope_point(height_map, position_x, position_y):
+    """ sample_slope for a single position, reading only the cells around it """
+    map_width, map_height = len(height_map), len(height_map[0])
+    x0 = min(int(position_x), map_width - 2)
+    y0 = min(int(position_y), map_height - 2)
+    corners = [[slope_term(height_map, x, y, map_width, map_height) for y in (y0, y0 + 1)] for x in (x0, x0 + 1)]
+    return blend_point(corners, position_x - x0, position_y - y0)
+
+class GradientField():
+    """
+    The slope term of Particle.normal_force, (s * Δ)/(s^2 + Δ^2), for every cell of a height map, computed once with
+    the same edge rules. slope[x, y] holds the x and y terms together so a sample is one lookup per corner.
+    The field keeps a reference to the height map; after cells of it change, update or update_cells recompute the
+    affected slopes.
+    """
+    def __init__(self, height_map):
+        self.height_map = height_map
+        self.slope = np.empty(height_map.shape + (2,))
+        self.update(0, 0, height_map.shape[0], height_map.shape[1])
+
+    def update(self, x_start, y_start, x_end, y_end):
+        """ Recompute the slopes that depend on the height map cells [x_start:x_end, y_start:y_end] """
+        map_width, map_height = self.height_map.shape
+        x_start, y_start = max(x_start - 1, 0), max(y_start - 1, 0)
+        x_end, y_end = min(x_end + 1, map_width), min(y_end + 1, map_height)
+        slope_x, slope_y = slope_terms(self.height_map, np.arange(x_start, x_end)[:, None], np.arange(y_start, y_end)[None, :])
+        self.slope[x_start:x_end, y_start:y_end, 0] = slope_x
+        self.slope[x_start:x_end, y_start:y_end, 1] = slope_y
+
+    def update_cells(self, x, y):
+        """ Recompute the slopes that depend on the height map cells (x, y), integer arrays """
+        map_width, map_height = self.height_map.shape
+        # A cell's height is used by its neighbours along each axis. Repeated cells just get the same slope again
+        x = np.clip(np.concatenate([x, x - 1, x + 1, x, x]), 0, map_width - 1)
+        y = np.clip(np.concatenate([y, y, y, y - 1, y + 1]), 0, map_height - 1)
+        slope_x, slope_y = slope_terms(self.height_map, x, y)
+        self.slope[x, y, 0] = slope_x
+        self.slope[x, y, 1] = slope_y
+
+    def sample(self, position_x, position_y):
+        """ Bilinearly interpolated (slope_x, slope_y) at fractional positions, scalars or arrays """
+        def slopes(x, y):
+            slope = self.slope[x, y]
+            return slope[..., 0], slope[..., 1]
+        return interpolate_slopes(self.height_map.shape, position_x, position_y, slopes)
+
+    def sample_point(self, position_x, position_y):
+        """ sample for a single position, without the array overhead """
+        map_width, map_height = self.height_map.shape
+        x0 = min(int(position_x), map_width - 2)
+        y0 = min(int(position_y), map_height - 2)
+        return blend_point(self.slope[x0:x0 + 2, y0:y0 + 2].tolist(), position_x - x0, position_y - y0)
+
+@dataclass(slots=True)
 class DiscreteThermalParticle(Particle):
     released: bool = False
     upward_velocity : float = 0.0
     
-    heat_energy = 100
+    heat_energy: float = INITIAL_HEAT_ENERGY
 
     def step_dynamics(self, heightmap, force = -9.8, wind = (0,0)):
         # Move to the highest adjacent point
@@ -182,6 +307,352 @@ class DiscreteThermalParticle(Particle):
         # As we move, lose some heat to the outside environment
         self.heat_energy *= 0.95
 
+COLUMN_DTYPES = {int: np.int64, float: np.float64, bool: np.bool_}
+
+class ParticlePool():
+    """
+    Particles of a slotted particle_type stored as one numpy column per field instead of one object each.
+    Hot loops work on the columns directly, pool.columns[field] being a plain array, or on a ThermalParticleBatch.
+    pool[i] is a view kept for compatibility with code written against particle objects: an instance of particle_type
+    whose fields read and write row i of the columns, so the scalar methods (step_dynamics, normal_force, ...) run on
+    it unchanged. Every field access goes through a property and an array lookup, around 40x slower than a slotted
+    object's (benchmark_terrain.py --particles), so per particle loops should convert with to_particles and write back
+    with write_particles instead, as simulate_particles' OBJECTS mode does.
+    Indexing with a slice gives a pool over views of the columns, like numpy, and an integer array or mask a pool
+    over copies. Columns missing from the constructor are filled with the field defaults. Memory is the columns'
+    8 bytes (1 for flags) per field per particle.
+    """
+    # particle_type -> view type, one cache per pool class
+    view_types = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.view_types = {}
+
+    def __init__(self, particle_type, count, **columns):
+        self.particle_type = particle_type
+        self.count = count
+        self.columns = {}
+        for field in fields(particle_type):
+            dtype = COLUMN_DTYPES[field.type]
+            if field.name not in columns:
+                self.columns[field.name] = np.full(count, field.default, dtype=dtype)
+            elif dtype == np.float64:
+                self.columns[field.name] = np.asarray(columns[field.name], dtype=np.float64)
+            else:
+                # Integer fields may still hold fractional values, like the positions of erosion particles
+                self.columns[field.name] = np.asarray(columns[field.name])
+            assert(len(self.columns[field.name]) == count)
+
+    @classmethod
+    def from_particles(cls, particle_type, particles):
+        return cls(particle_type, len(particles),
+                   **{field.name: [getattr(particle, field.name) for particle in particles] for field in fields(particle_type)})
+
+    @classmethod
+    def concatenate(cls, pools):
+        return cls(pools[0].particle_type, sum(len(pool) for pool in pools),
+                   **{name: np.concatenate([pool.columns[name] for pool in pools]) for name in pools[0].columns})
+
+    def to_particles(self):
+        """ Independent particle_type objects with the pool's values """
+        names = list(self.columns)
+        return [self.particle_type(**dict(zip(names, values)))
+                for values in zip(*(self.columns[name].tolist() for name in names))]
+
+    def write_particles(self, particles):
+        """ Copy the values of particle objects (as from to_particles) back into the columns """
+        for field in fields(self.particle_type):
+            self.columns[field.name][:] = [getattr(particle, field.name) for particle in particles]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            if not -self.count <= index < self.count:
+                raise IndexError(f"particle {index} out of range for a pool of {self.count}")
+            view = object.__new__(self.view_type(self.particle_type))
+            view.pool_columns = self.columns
+            view.pool_index = int(index) % self.count
+            return view
+        if isinstance(index, slice):
+            count = len(range(*index.indices(self.count)))
+        else:
+            index = np.asarray(index)
+            if index.dtype == bool:
+                count = int(np.count_nonzero(index))
+            elif np.issubdtype(index.dtype, np.integer) and index.ndim == 1:
+                count = len(index)
+            else:
+                raise TypeError(f"particle pools are indexed by an integer, slice, integer array or mask, not {index.dtype}")
+        return type(self)(self.particle_type, count, **{name: column[index] for name, column in self.columns.items()})
+
+    def __iter__(self):
+        return (self[index] for index in range(self.count))
+
+    @classmethod
+    def view_type(cls, particle_type):
+        """ Subclass of particle_type whose fields are properties over pool columns """
+        if particle_type not in cls.view_types:
+            namespace = {"__slots__": ("pool_columns", "pool_index")}
+            for field in fields(particle_type):
+                namespace[field.name] = property(lambda view, name=field.name: view.pool_columns[name].item(view.pool_index),
+                                                 lambda view, value, name=field.name: view.pool_columns[name].__setitem__(view.pool_index, value))
+            cls.view_types[particle_type] = type(particle_type.__name__ + "View", (particle_type,), namespace)
+        return cls.view_types[particle_type]
+
+class ThermalParticleBatch():
+    """
+    Struct of arrays form of a list of DiscreteThermalParticle.
+    Positions, upward velocity, heat and released flags live in numpy arrays and every live particle is advanced at
+    once by step(), following the same hill climbing, stickiness, friction and heat loss rules as
+    DiscreteThermalParticle.step_dynamics, so both produce identical particles.
+    With track_paths the bounding box of the cells each particle visits is kept too, which update_region needs.
+    """
+    def __init__(self, position_x, position_y, upward_velocity = None, heat_energy = None, released = None, track_paths = False):
+        self.position_x = np.asarray(position_x, dtype=np.int64)
+        self.position_y = np.asarray(position_y, dtype=np.int64)
+        count = len(self.position_x)
+        self.upward_velocity = np.zeros(count) if upward_velocity is None else np.asarray(upward_velocity, dtype=np.float64)
+        self.heat_energy = np.full(count, INITIAL_HEAT_ENERGY) if heat_energy is None else np.asarray(heat_energy, dtype=np.float64)
+        self.released = np.zeros(count, dtype=bool) if released is None else np.asarray(released, dtype=bool)
+        self.track_paths = track_paths
+        # Bounding box of the cells each particle has visited
+        self.path_min_x = self.position_x.copy() if track_paths else None
+        self.path_max_x = self.position_x.copy() if track_paths else None
+        self.path_min_y = self.position_y.copy() if track_paths else None
+        self.path_max_y = self.position_y.copy() if track_paths else None
+
+    @classmethod
+    def from_particles(cls, particles, track_paths = False):
+        if isinstance(particles, ParticlePool):
+            columns = particles.columns
+            return cls(columns["position_x"].copy(), columns["position_y"].copy(), columns["upward_velocity"].copy(),
+                       columns["heat_energy"].copy(), columns["released"].copy(), track_paths)
+        return cls([particle.position_x for particle in particles],
+                   [particle.position_y for particle in particles],
+                   [particle.upward_velocity for particle in particles],
+                   [particle.heat_energy for particle in particles],
+                   [particle.released for particle in particles], track_paths)
+
+    def write_to_particles(self, particles):
+        """ Copy the batch state back onto the particle objects or ParticlePool it was built from """
+        if isinstance(particles, ParticlePool):
+            particles.columns["position_x"] = self.position_x.copy()
+            particles.columns["position_y"] = self.position_y.copy()
+            particles.columns["upward_velocity"] = self.upward_velocity.copy()
+            particles.columns["heat_energy"] = self.heat_energy.copy()
+            particles.columns["released"] = self.released.copy()
+            return
+        for index, particle in enumerate(particles):
+            particle.position_x = int(self.position_x[index])
+            particle.position_y = int(self.position_y[index])
+            particle.upward_velocity = float(self.upward_velocity[index])
+            particle.heat_energy = float(self.heat_energy[index])
+            particle.released = bool(self.released[index])
+
+    def step(self, height_map, wind = (0, 0)):
+        """ Advance every particle that hasn't released by one step. Returns the indices that moved """
+        active = np.nonzero(~self.released)[0]
+        map_width, map_height = height_map.shape
+        x = self.position_x[active]
+        y = self.position_y[active]
+
+        current_height = height_map[x, y]
+        # Candidate heights in the order left, right, down, up. Off the map a candidate is the current height
+        candidates = [(-1,  0, np.where(x > 0, height_map[x-1, y] - wind[0]/40, current_height)),
+                      ( 1,  0, np.where(x < map_width-1, height_map[np.minimum(x+1, map_width-1), y] + wind[0]/40, current_height)),
+                      ( 0, -1, np.where(y > 0, height_map[x, y-1] - wind[1]/40, current_height)),
+                      ( 0,  1, np.where(y < map_height-1, height_map[x, np.minimum(y+1, map_height-1)] + wind[1]/40, current_height))]
+
+        # Identify the highest adjacent point, the first one wins ties
+        next_height = current_height
+        delta_x = np.zeros(len(active), dtype=np.int64)
+        delta_y = np.zeros(len(active), dtype=np.int64)
+        for candidate_x, candidate_y, candidate_height in candidates:
+            higher = candidate_height > next_height
+            next_height = np.where(higher, candidate_height, next_height)
+            delta_x[higher] = candidate_x
+            delta_y[higher] = candidate_y
+
+        z_delta = next_height - current_height
+        upward_velocity = self.upward_velocity[active]
+        bending = upward_velocity - z_delta
+
+        # Release particles that aren't moving or where the terrain drops away too quickly
+        self.released[active] = (next_height == current_height) | (bending > STICKINESS)
+        self.upward_velocity[active] = upward_velocity + (z_delta - upward_velocity) * (1 - FRICTION)
+        next_x = x + delta_x
+        next_y = y + delta_y
+        self.position_x[active] = next_x
+        self.position_y[active] = next_y
+        self.heat_energy[active] *= 0.95
+        if self.track_paths:
+            # active holds every index once, so plain fancy indexing updates the bounds
+            self.path_min_x[active] = np.minimum(self.path_min_x[active], next_x)
+            self.path_max_x[active] = np.maximum(self.path_max_x[active], next_x)
+            self.path_min_y[active] = np.minimum(self.path_min_y[active], next_y)
+            self.path_max_y[active] = np.maximum(self.path_max_y[active], next_y)
+        return active
+
+    def simulate(self, height_map, wind = (0, 0), max_steps = 10000, trail = None):
+        """ Step until every particle has released, recording into trail (a ParticleTrail) if one is given """
+        height_map = np.asarray(height_map, dtype=np.float64)
+        if trail is not None:
+            trail.start(len(self.position_x))
+        for step in range(1, max_steps + 1):
+            if self.released.all():
+                break
+            active = self.step(height_map, wind)
+            if trail is not None:
+                trail.record(step, active, self.position_x[active], self.position_y[active], self.heat_energy[active])
+
+class ParticleTrail():
+    """
+    Recorder for thermal particle paths, used for debugging and animation. Simulations record nothing unless one is
+    passed to simulate_particles.
+    Positions and heat are kept in preallocated (recorded steps, particles) int32/float32 arrays that double in size
+    when full; every = k records only every k-th step, and with a folder the arrays are .npy memmaps on disk instead
+    of in memory. Cells for a particle that didn't move on a recorded step hold x = y = -1 and heat = nan.
+    """
+    def __init__(self, every = 1, folder = None, initial_steps = 64):
+        self.every = every
+        self.folder = folder
+        self.initial_steps = initial_steps
+        self.steps_recorded = 0
+        self.position_x = None
+        self.position_y = None
+        self.heat_energy = None
+
+    def allocate(self, name, steps, number_of_particles, dtype, fill):
+        if self.folder is None:
+            return np.full((steps, number_of_particles), fill, dtype=dtype)
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, f"trail_{name}.npy")
+        if os.path.exists(path):
+            # Move the existing recording aside while the larger file is created
+            os.replace(path, path + ".old")
+        array = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(steps, number_of_particles))
+        array[:] = fill
+        return array
+
+    def start(self, number_of_particles):
+        self.steps_recorded = 0
+        self.position_x = self.allocate("x", self.initial_steps, number_of_particles, np.int32, -1)
+        self.position_y = self.allocate("y", self.initial_steps, number_of_particles, np.int32, -1)
+        self.heat_energy = self.allocate("heat", self.initial_steps, number_of_particles, np.float32, np.nan)
+
+    def grow(self):
+        steps, number_of_particles = self.position_x.shape
+        for name, fill in [("x", -1), ("y", -1), ("heat", np.nan)]:
+            attribute = "heat_energy" if name == "heat" else f"position_{name}"
+            old = getattr(self, attribute)
+            new = self.allocate(name, 2 * steps, number_of_particles, old.dtype, fill)
+            new[:steps] = old
+            setattr(self, attribute, new)
+            del old
+            if self.folder is not None:
+                os.remove(os.path.join(self.folder, f"trail_{name}.npy.old"))
+
+    def record(self, step, indices, position_x, position_y, heat_energy):
+        """ Record the particles at indices after the given (1 based) step """
+        if step % self.every:
+            return
+        if self.steps_recorded == len(self.position_x):
+            self.grow()
+        row = self.steps_recorded
+        self.position_x[row, indices] = position_x
+        self.position_y[row, indices] = position_y
+        self.heat_energy[row, indices] = heat_energy
+        self.steps_recorded += 1
+
+    def as_lists(self):
+        """ The trail as one {"x": [...], "y": [...], "heat": [...]} dict per particle """
+        trails = []
+        for particle_index in range(self.position_x.shape[1]):
+            recorded = self.position_x[:self.steps_recorded, particle_index] >= 0
+            trails.append({"x": self.position_x[:self.steps_recorded, particle_index][recorded].tolist(),
+                           "y": self.position_y[:self.steps_recorded, particle_index][recorded].tolist(),
+                           "heat": self.heat_energy[:self.steps_recorded, particle_index][recorded].tolist()})
+        return trails
+
+class ThermalAscentGraph():
+    """
+    Precomputed thermal particle paths for a height map and a fixed wind.
+    With a fixed wind every cell's wind-biased best neighbour depends only on the height map, so the "next cell" field
+    is computed once and where a particle starting anywhere ends up is resolved for every cell at once by pointer doubling,
+    in O(cells * log L) for paths of length L.
+
+    The stickiness rule depends on a particle's upward velocity, which carries its whole history. Here it is
+    approximated by the last step only: a particle arriving with height change z_in has upward velocity
+    (1 - FRICTION) * z_in, the exact value after one step and within FRICTION ** 2 of it afterwards. The graph state is
+    therefore (cell, direction arrived from), five states per cell, plus a stopped state per cell.
+    """
+    # Order in which DiscreteThermalParticle.step_dynamics checks neighbours: left, right, down, up
+    DIRECTIONS = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+
+    def __init__(self, height_map, wind = (0, 0)):
+        height_map = np.asarray(height_map, dtype=np.float64)
+        self.map_width, self.map_height = height_map.shape
+        cells = self.map_width * self.map_height
+        x, y = np.meshgrid(np.arange(self.map_width), np.arange(self.map_height), indexing="ij")
+
+        # Wind-biased candidate heights, off the map a candidate is the current height
+        candidates = [np.where(x > 0, np.roll(height_map, 1, axis=0) - wind[0]/40, height_map),
+                      np.where(x < self.map_width-1, np.roll(height_map, -1, axis=0) + wind[0]/40, height_map),
+                      np.where(y > 0, np.roll(height_map, 1, axis=1) - wind[1]/40, height_map),
+                      np.where(y < self.map_height-1, np.roll(height_map, -1, axis=1) + wind[1]/40, height_map)]
+        next_height = height_map.copy()
+        next_direction = np.zeros(height_map.shape, dtype=np.int64)
+        for direction, candidate_height in enumerate(candidates, start=1):
+            higher = candidate_height > next_height
+            next_height = np.where(higher, candidate_height, next_height)
+            next_direction[higher] = direction
+        next_direction = next_direction.ravel()
+        z_out = (next_height - height_map).ravel()
+
+        offsets = np.array([(0, 0)] + self.DIRECTIONS)
+        cell = np.arange(cells)
+        next_cell = cell + offsets[next_direction, 0] * self.map_height + offsets[next_direction, 1]
+
+        # State d * cells + c is "at cell c, arrived moving in direction d" (d = 0 at the start), state 5 * cells + c is "stopped at c"
+        stopped = 5 * cells + cell
+        successor = np.empty(6 * cells, dtype=np.int64)
+        steps = np.ones(6 * cells, dtype=np.int64)
+        for direction in range(5):
+            if direction == 0:
+                upward_velocity = np.zeros(cells)
+            else:
+                # z_in is the height change of the step into the cell, taken by the neighbour it came from
+                previous_cell = cell - offsets[direction, 0] * self.map_height - offsets[direction, 1]
+                upward_velocity = (1 - FRICTION) * z_out[np.clip(previous_cell, 0, cells - 1)]
+            bending = upward_velocity - z_out
+            states = slice(direction * cells, (direction + 1) * cells)
+            successor[states] = np.where(next_direction == 0, stopped,
+                                 np.where(bending > STICKINESS, 5 * cells + next_cell,
+                                          next_direction * cells + next_cell))
+        successor[stopped] = stopped
+        steps[stopped] = 0
+
+        # Pointer doubling: after k rounds each state points 2^k steps ahead, stopping once every path has ended
+        while True:
+            jumped = successor[successor]
+            if np.array_equal(jumped, successor):
+                break
+            steps = steps + steps[successor]
+            successor = jumped
+
+        self.end_cell = successor[:cells] - 5 * cells
+        self.steps = steps[:cells]
+
+    def resolve(self, position_x, position_y):
+        """ Final positions and heat of particles starting at the given cells """
+        start_cell = np.asarray(position_x) * self.map_height + np.asarray(position_y)
+        end_x, end_y = np.divmod(self.end_cell[start_cell], self.map_height)
+        heat_energy = INITIAL_HEAT_ENERGY * np.power(0.95, self.steps[start_cell])
+        return end_x, end_y, heat_energy
+
 def elevation_distribution(elevation):
     if (elevation > MAX_PROABILITY_CEILING):
         return 1
@@ -190,33 +661,66 @@ def elevation_distribution(elevation):
             (MAX_PROABILITY_CEILING+SEA_LEVEL_PROBABILITY))
 
 class ThermalParticleDistribution():
-    particles = []
-    particle_trail = []
-    height_map = None
-    albedo_map = None 
-    map_height = 0
-    map_width = 0
-    thermal_movement_simulated = False   
-    thermals = {}
-    thermal_map = [[]]
-    aggregated_particles = {"x": [], "y":[], "strength": []}
-
-    def __init__(self, number_of_particles, height_map, max_thermal, albedo_map=None):
-        
-        if albedo_map:
-            assert(len(height_map) == len(albedo_map))
-            assert(len(height_map[0]) == len(albedo_map[0]))
+
+    def __init__(self, number_of_particles, height_map, max_thermal, albedo_map=None, seed=None, heat_bound=None):
+        # Work buffers for aggregation, kept across reset() while the map dimensions stay the same
+        self.heat_buffer = None
+        self.spread_buffer = None
+        self.thermal_buffer = None
+        self.reset(number_of_particles, height_map, max_thermal, albedo_map, seed, heat_bound)
+
+    def reset(self, number_of_particles, height_map, max_thermal, albedo_map=None, seed=None, heat_bound=None):
+        """
+        Start over on a new map, dropping all particles and results from the previous one.
+        Work buffers are reused when the new map has the same dimensions, so one instance can generate many maps
+        with flat memory use. thermal_map is one of them, copy it to keep it past the next simulation.
+        The thermal map is normalized against its strongest cell, or against a fixed heat_bound so that maps simulated
+        separately, like terrain chunks, share one scale.
+        """
+        if albedo_map is not None:
+            assert(np.shape(height_map) == np.shape(albedo_map))
 
         self.height_map = height_map
         self.albedo_map = albedo_map
         self.map_width = len(height_map)
         self.map_height = len(height_map[1])
         self.max_thermal = max_thermal
+        self.heat_bound = heat_bound
+        # Instance owned random source so that a seed reproduces the same particle distribution
+        self.random = np.random.default_rng(seed)
         assert(self.map_width > 0)
         assert(self.map_height > 0)
 
+        if self.heat_buffer is None or self.heat_buffer.shape != (self.map_width, self.map_height):
+            self.heat_buffer = np.zeros((self.map_width, self.map_height))
+            self.spread_buffer = np.zeros((self.map_width, self.map_height))
+            self.thermal_buffer = np.zeros((self.map_width, self.map_height))
+
+        self.particle_trail = None
+        self.particle_batch = None
+        self.start_x = None
+        self.start_y = None
+        self.max_value = 0
+        self.kernel = SPREAD_KERNEL
+        self.thermal_movement_simulated = False
+        self.thermals = {}
+        self.thermal_map = None
+        self.aggregated_particles = {"x": np.zeros(0, dtype=np.int64), "y": np.zeros(0, dtype=np.int64), "strength": np.zeros(0)}
         self.particles = self.distribute_particles(number_of_particles)
 
+    def particle_probability_map(self):
+        """ Probability of a thermal particle starting in each cell, combining the elevation and albedo distributions """
+        elevation = np.asarray(self.height_map, dtype=np.float64)
+        probability = np.where(elevation > MAX_PROABILITY_CEILING, 1,
+                               (elevation + SEA_LEVEL_PROBABILITY) / (MAX_PROABILITY_CEILING+SEA_LEVEL_PROBABILITY))
+
+        # If there is an albedo map, combine it with the elevation probabiolity and
+        # value it 2:1 against the elevation map
+        if self.albedo_map is not None:
+            albedo_probability = 1 - np.asarray(self.albedo_map, dtype=np.float64)
+            probability = ((2 * albedo_probability) + probability)/3
+
+        return np.clip(probability, 0, None)
 
     def distribute_particles(self, desired_number_of_particles):
         """
@@ -225,120 +729,525 @@ class ThermalParticleDistribution():
         Height map should have a lower bound of 0. Values map roughly to kilometers, I.E. a value of 1 means 1000m of elevation.
         Albedo map shoule be on the range 0-1, with 0 as a perfect absorber and 1 as a perfect reflector.
         https://en.wikipedia.org/wiki/Albedo
-        Note: 
-        This function is not efficient for very high numbers of particles, as particles are drawn randomly and may be culled based on
-        the distributions. TODO for later is to rewrite this to instead draw each particle from the distributions. 
+        Particles are drawn in one batch straight from the combined probability map by inverting its cumulative sum,
+        so the cost is O(cells + particles) however low the acceptance probability is.
+        Particles are returned as a ParticlePool of DiscreteThermalParticle rather than individual objects.
         """
+        positions_x, positions_y = self.sample_cells(self.particle_probability_map(), int(np.ceil(desired_number_of_particles)))
+        return ParticlePool(DiscreteThermalParticle, len(positions_x), position_x=positions_x, position_y=positions_y)
 
+    def sample_cells(self, probability, number_of_particles):
+        """ Draw cells (x, y arrays) from a probability map by inverting its cumulative sum """
+        cumulative_probability = np.cumsum(probability.ravel())
+        if number_of_particles == 0 or cumulative_probability[-1] <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
 
-        particles = []
-        while len(particles) < desired_number_of_particles:
-            # Create a particle random;
-            new_particle = DiscreteThermalParticle(random.randrange(self.map_width), random.randrange(self.map_height))
-            
-            # pull the height of the particle & pull its probability
-            elevation = self.height_map[new_particle.position_x][new_particle.position_y]
-            elevation_probability = elevation_distribution(elevation)
-
-            # If we don't have a albedo map, just use the height map
-            total_probability = elevation_probability
-            if self.albedo_map:
-                albedo = self.albedo_map[new_particle.position_x][new_particle.position_y]
-                albedo_probability = 1-albedo
-                # If there is an albedo map, combine it with the elevation probabiolity and 
-                # value it 2:1 against the elevation map
-                total_probability = ((2 * albedo_probability) + elevation_probability)/3
-
-            # Make a random draw based on the total probability. If it passes, add the particle to the list
-            if (random.random() < total_probability):
-                particles.append(new_particle)
-
-        return particles
+        draws = self.random.random(number_of_particles) * cumulative_probability[-1]
+        cells = np.minimum(np.searchsorted(cumulative_probability, draws, side="right"), len(cumulative_probability) - 1)
+        return np.divmod(cells, probability.shape[1])
 
     def check_all_released(self):
         """ 
         Check if all the thermal particles have released
         """
-        all_released = True
-        for particle in self.particles:
-            all_released = all_released and particle.released
-        return all_released
+        return bool(np.all(self.particles.columns["released"]))
+
+    def particle_state(self):
+        """ Final particle positions and heat as an (n, 3) array of [x, y, heat_energy] rows """
+        columns = self.particles.columns
+        return np.stack([columns["position_x"], columns["position_y"], columns["heat_energy"]], axis=1).astype(np.float64)
 
-    def aggregate_particles(self):
+    def place_particles(self, position_x, position_y):
+        """ Start the simulation from the given cells (integer arrays) instead of the particles drawn for this map """
+        self.particles = ParticlePool(DiscreteThermalParticle, len(position_x),
+                                      position_x=np.asarray(position_x, dtype=np.int64),
+                                      position_y=np.asarray(position_y, dtype=np.int64))
+        self.particle_batch = None
+        self.thermal_movement_simulated = False
+
+    def load_particle_state(self, state):
+        """ Restore simulated particles saved with particle_state, so aggregate_particles can run without re-simulating """
+        state = np.asarray(state, dtype=np.float64).reshape(-1, 3)
+        self.particles = ParticlePool(DiscreteThermalParticle, len(state), position_x=state[:, 0].astype(np.int64),
+                                      position_y=state[:, 1].astype(np.int64), heat_energy=state[:, 2],
+                                      released=np.ones(len(state), dtype=bool))
+        self.particle_batch = None
+        self.thermal_movement_simulated = True
+
+    def aggregate_particles(self, kernel = None):
+        """
+        Build thermal_map from the released particles.
+        Particle heat is scatter-added onto the map, spread with kernel (SPREAD_KERNEL by default) to make thermals
+        wider, then normalized against the strongest cell holding a particle and shaped with thermal_distribution.
+        Particles closer to the edge of the map than the kernel's radius are discarded.
+        """
         assert(self.thermal_movement_simulated)
-        self.thermal_map = [[0 for _ in range(self.map_height)] for _ in range(self.map_width)]
-        max_value = 0
-        for particle in self.particles:
+        self.kernel = SPREAD_KERNEL if kernel is None else np.asarray(kernel, dtype=np.float64)
+        self.aggregate_heat(self.kernel)
+        spread(self.heat_buffer, self.kernel, out=self.spread_buffer)
+        self.normalize_thermal_map()
 
-            # Discard anything on the edge of the map
-            if (particle.position_x == 0) or (particle.position_x == self.map_width - 1):
-                continue
-            if (particle.position_y == 0) or (particle.position_y == self.map_height -1):
-                continue
+    def aggregate_heat(self, kernel, window = None):
+        """
+        Scatter-add particle heat into heat_buffer and rebuild the thermals dict, over the whole map or only the cells
+        inside window (a pair of slices)
+        """
+        radius_x, radius_y = kernel.shape[0] // 2, kernel.shape[1] // 2
+        if self.particle_batch is not None:
+            position_x, position_y, heat_energy = self.particle_batch.position_x, self.particle_batch.position_y, self.particle_batch.heat_energy
+        else:
+            columns = self.particles.columns
+            position_x, position_y, heat_energy = columns["position_x"], columns["position_y"], columns["heat_energy"]
 
-            # Add the particle's energy to the thermal particle map
-            if (particle.position_x, particle.position_y) in self.thermals.keys():
-                self.thermals[(particle.position_x, particle.position_y)] += particle.heat_energy
-            else:
-                self.thermals[(particle.position_x, particle.position_y)] = particle.heat_energy
-
-            self.thermal_map[particle.position_x][particle.position_y] += particle.heat_energy
-            for x_delta, y_delta, factor in [   [-1, -1, 0.2],
-                                                [-1,  1, 0.2],
-                                                [ 1, -1, 0.2],
-                                                [ 1,  1, 0.2],
-                                                [-1,  0, 0.4],
-                                                [ 0, -1, 0.4],
-                                                [ 0,  1, 0.4],
-                                                [ 1,  0, 0.4]] :
-                # Make thermals wider
-                # We be sure to not exceed bounds here as we skip any particles on the edges above
-                self.thermal_map[particle.position_x + x_delta][particle.position_y + y_delta] += (particle.heat_energy * factor)
-                
-            if self.thermal_map[particle.position_x][particle.position_y] > max_value:
-                max_value = self.thermal_map[particle.position_x][particle.position_y]
-            
-        # Normalize with distribution and apply max value
-        for row_index, row in enumerate(self.thermal_map):
-            for col_index, initial_value in enumerate(row):
-                normalized_scaled_value = (self.max_thermal * thermal_distribution(initial_value/max_value))
-                self.thermal_map[row_index][col_index] = normalized_scaled_value
-                if (initial_value > 0):
-                    self.aggregated_particles["x"].append(row_index)
-                    self.aggregated_particles["y"].append(col_index)
-                    self.aggregated_particles["strength"].append(normalized_scaled_value)
+        if window is None:
+            window = (slice(0, self.map_width), slice(0, self.map_height))
+            self.thermals = {}
+        else:
+            old_x, old_y = np.nonzero(self.heat_buffer[window])
+            for cell in zip((old_x + window[0].start).tolist(), (old_y + window[1].start).tolist()):
+                self.thermals.pop(cell, None)
+        x_start, x_end, y_start, y_end = window[0].start, window[0].stop, window[1].start, window[1].stop
 
+        # Discard anything on the edge of the map
+        inside = ((position_x >= max(radius_x, x_start)) & (position_x < min(self.map_width - radius_x, x_end)) &
+                  (position_y >= max(radius_y, y_start)) & (position_y < min(self.map_height - radius_y, y_end)))
+        region = self.heat_buffer[window]
+        cells = (position_x[inside] - x_start) * region.shape[1] + position_y[inside] - y_start
+        region[:] = np.bincount(cells, weights=heat_energy[inside], minlength=region.size).reshape(region.shape)
 
+        thermal_x, thermal_y = np.nonzero(region)
+        self.thermals.update(zip(zip((thermal_x + x_start).tolist(), (thermal_y + y_start).tolist()),
+                                 region[thermal_x, thermal_y].tolist()))
 
-    def simulate_particles(self, wind):
+    def normalize_thermal_map(self):
         """
-        Simulate thermal particle dynamics until all have released from the landscape
+        Normalize the spread heat against the strongest cell holding a particle, or heat_bound when there is one, and
+        apply the max thermal
         """
-        self.particle_trail = [{"x": [], "y":[], "heat":[]} for _ in range(len(self.particles))]
+        if self.heat_bound is not None:
+            self.max_value = self.heat_bound
+        else:
+            thermal_x, thermal_y = np.nonzero(self.heat_buffer)
+            self.max_value = self.spread_buffer[thermal_x, thermal_y].max() if len(thermal_x) else 0
+        thermal_map = self.thermal_buffer
+        if self.max_value > 0:
+            np.divide(self.spread_buffer, self.max_value, out=thermal_map)
+            thermal_distribution(thermal_map, out=thermal_map)
+            np.multiply(self.max_thermal, thermal_map, out=thermal_map)
+        else:
+            thermal_map.fill(0)
+        self.thermal_map = thermal_map
 
-        for _ in range (10000):
-            if self.check_all_released():
-                break
-            for index, particle in enumerate(self.particles):
-                    if not particle.released:
-                        particle.step_dynamics(self.height_map, wind = wind)
-                        self.particle_trail[index]["x"].append(particle.position_x)
-                        self.particle_trail[index]["y"].append(particle.position_y)
-                        self.particle_trail[index]["heat"].append(particle.heat_energy)
+        aggregated_x, aggregated_y = np.nonzero(self.spread_buffer > 0)
+        self.aggregated_particles = {"x": aggregated_x, "y": aggregated_y, "strength": self.thermal_map[aggregated_x, aggregated_y]}
+
+    def simulate_particles(self, wind, mode = None, trail = None, track_paths = False):
+        """
+        Simulate thermal particle dynamics until all have released from the landscape.
+        SimulationMode.BATCH (the default) steps all particles together as a ThermalParticleBatch and OBJECTS steps each
+        particle object in turn; both give the same result. ASCENT_GRAPH looks every particle's end point up in a
+        precomputed ThermalAscentGraph, approximating the stickiness rule, and records no trail.
+        Particle paths are only recorded when a ParticleTrail is passed as trail; it is kept as particle_trail.
+        track_paths keeps the bounding box of every particle's path in a BATCH simulation so update_region can be used.
+        """
+        if mode is None:
+            mode = SimulationMode.BATCH
+        self.particle_trail = trail
+        self.particle_batch = None
+
+        if mode == SimulationMode.ASCENT_GRAPH:
+            graph = ThermalAscentGraph(self.height_map, wind)
+            end_x, end_y, heat_energy = graph.resolve(self.particles.columns["position_x"], self.particles.columns["position_y"])
+            ThermalParticleBatch(end_x, end_y, heat_energy=heat_energy,
+                                 released=np.ones(len(self.particles), dtype=bool)).write_to_particles(self.particles)
+            self.particle_trail = None
+        elif mode == SimulationMode.BATCH:
+            batch = ThermalParticleBatch.from_particles(self.particles, track_paths)
+            # Start points and the simulated batch are kept for update_region
+            self.start_x = batch.position_x.copy()
+            self.start_y = batch.position_y.copy()
+            batch.simulate(self.height_map, wind, trail=trail)
+            batch.write_to_particles(self.particles)
+            self.particle_batch = batch
+        else:
+            # Step slotted objects, which are quicker to work on one at a time than views into the pool
+            particles = self.particles.to_particles()
+            if trail is not None:
+                trail.start(len(particles))
 
+            for step in range (1, 10001):
+                if all(particle.released for particle in particles):
+                    break
+                moved = []
+                for index, particle in enumerate(particles):
+                        if not particle.released:
+                            particle.step_dynamics(self.height_map, wind = wind)
+                            moved.append(index)
+                if trail is not None:
+                    trail.record(step, moved,
+                                 [particles[index].position_x for index in moved],
+                                 [particles[index].position_y for index in moved],
+                                 [particles[index].heat_energy for index in moved])
+            self.particles.write_particles(particles)
 
         assert (self.check_all_released())
         self.thermal_movement_simulated = True
         self.aggregate_particles()
 
+    def update_region(self, x_start, y_start, x_end, y_end, height_map = None, albedo_map = None, wind = (0, 0)):
+        """
+        Patch the thermals after the height or albedo map changed inside [x_start, x_end) x [y_start, y_end), instead of
+        rebuilding everything. Requires a BATCH simulation run with track_paths.
+        Particles that started in the region are redrawn from the new probability map, keeping the particle density
+        of the rest of the map, and particles whose path came within a cell of the region are re-simulated from their
+        start. thermal_map is then patched in place around the cells whose heat changed, and only re-normalized
+        everywhere if the strongest thermal changed.
+        """
+        assert(self.particle_batch is not None and self.particle_batch.track_paths)
+        if height_map is not None:
+            self.height_map = height_map
+        if albedo_map is not None:
+            self.albedo_map = albedo_map
+        x_start, y_start = max(x_start, 0), max(y_start, 0)
+        x_end, y_end = min(x_end, self.map_width), min(y_end, self.map_height)
+        batch = self.particle_batch
+
+        started_inside = ((self.start_x >= x_start) & (self.start_x < x_end) &
+                          (self.start_y >= y_start) & (self.start_y < y_end))
+        # Moves are decided by the neighbours of every cell on the path, so paths a cell away are affected too
+        path_touches = ((batch.path_max_x >= x_start - 1) & (batch.path_min_x <= x_end) &
+                        (batch.path_max_y >= y_start - 1) & (batch.path_min_y <= y_end))
+        kept = ~started_inside
+        rerun = kept & path_touches
+        unchanged = kept & ~path_touches
+
+        # Redraw the starts inside the region at the same density per unit of probability as the rest of the map
+        probability = self.particle_probability_map()
+        region_probability = probability[x_start:x_end, y_start:y_end]
+        outside_mass = probability.sum() - region_probability.sum()
+        if outside_mass > 0:
+            number_of_new = int(round(np.count_nonzero(kept) * region_probability.sum() / outside_mass))
+        else:
+            number_of_new = int(np.count_nonzero(started_inside))
+        new_x, new_y = self.sample_cells(region_probability, number_of_new)
+
+        resimulated = ThermalParticleBatch(np.concatenate([self.start_x[rerun], new_x + x_start]),
+                                           np.concatenate([self.start_y[rerun], new_y + y_start]), track_paths=True)
+        start_x, start_y = resimulated.position_x.copy(), resimulated.position_y.copy()
+        resimulated.simulate(self.height_map, wind)
+
+        # Cells whose particle heat may have changed: the old ends of every dropped or re-simulated particle and the new ends
+        replaced = ~unchanged
+        changed_x = np.concatenate([batch.position_x[replaced], resimulated.position_x])
+        changed_y = np.concatenate([batch.position_y[replaced], resimulated.position_y])
+
+        merged = ThermalParticleBatch(np.concatenate([batch.position_x[unchanged], resimulated.position_x]),
+                                      np.concatenate([batch.position_y[unchanged], resimulated.position_y]),
+                                      np.concatenate([batch.upward_velocity[unchanged], resimulated.upward_velocity]),
+                                      np.concatenate([batch.heat_energy[unchanged], resimulated.heat_energy]),
+                                      np.ones(np.count_nonzero(unchanged) + len(start_x), dtype=bool), track_paths=True)
+        for bound in ["path_min_x", "path_max_x", "path_min_y", "path_max_y"]:
+            setattr(merged, bound, np.concatenate([getattr(batch, bound)[unchanged], getattr(resimulated, bound)]))
+        self.start_x = np.concatenate([self.start_x[unchanged], start_x])
+        self.start_y = np.concatenate([self.start_y[unchanged], start_y])
+        self.particle_batch = merged
+        # The particle pool lines up with the batch, so only the re-simulated rows are new
+        resimulated_particles = ParticlePool(DiscreteThermalParticle, len(start_x), position_x=start_x, position_y=start_y)
+        resimulated.write_to_particles(resimulated_particles)
+        self.particles = ParticlePool.concatenate([self.particles[unchanged], resimulated_particles])
+
+        if len(changed_x) == 0:
+            return
+        self.patch_thermal_map(changed_x.min(), changed_x.max() + 1, changed_y.min(), changed_y.max() + 1)
+
+    def patch_thermal_map(self, x_start, x_end, y_start, y_end):
+        """
+        Recompute thermal_map after particle heat changed only inside [x_start, x_end) x [y_start, y_end).
+        Heat is re-aggregated in that box and spread and shaped within the kernel's reach of it, so the cost follows the
+        size of the edit rather than the map, unless the strongest thermal changes and everything is re-normalized.
+        """
+        kernel = self.kernel
+        radius_x, radius_y = kernel.shape[0] // 2, kernel.shape[1] // 2
+
+        # Spreading reaches radius cells out from the changed cells, and reads radius cells further still
+        window = (slice(max(x_start - radius_x, 0), min(x_end + radius_x, self.map_width)),
+                  slice(max(y_start - radius_y, 0), min(y_end + radius_y, self.map_height)))
+        source = (slice(max(window[0].start - radius_x, 0), min(window[0].stop + radius_x, self.map_width)),
+                  slice(max(window[1].start - radius_y, 0), min(window[1].stop + radius_y, self.map_height)))
+        old_window_max = self.window_max(window)
+
+        self.aggregate_heat(kernel, (slice(x_start, x_end), slice(y_start, y_end)))
+        spread_source = spread(self.heat_buffer[source], kernel)
+        self.spread_buffer[window] = spread_source[window[0].start - source[0].start:window[0].stop - source[0].start,
+                                                   window[1].start - source[1].start:window[1].stop - source[1].start]
+
+        # Outside the window the spread heat is unchanged, so the strongest thermal only needs a full search when it
+        # was inside the window and got weaker. A fixed heat_bound never needs one
+        window_max = self.window_max(window)
+        if self.thermal_map is None or self.max_value == 0 or (self.heat_bound is None and (
+                window_max > self.max_value or (old_window_max == self.max_value and window_max < self.max_value))):
+            self.normalize_thermal_map()
+            return
+
+        self.thermal_map[window] = self.max_thermal * thermal_distribution(self.spread_buffer[window] / self.max_value)
+        aggregated = self.aggregated_particles
+        outside = ~((aggregated["x"] >= window[0].start) & (aggregated["x"] < window[0].stop) &
+                    (aggregated["y"] >= window[1].start) & (aggregated["y"] < window[1].stop))
+        aggregated_x, aggregated_y = np.nonzero(self.spread_buffer[window] > 0)
+        aggregated_x += window[0].start
+        aggregated_y += window[1].start
+        self.aggregated_particles = {"x": np.concatenate([aggregated["x"][outside], aggregated_x]),
+                                     "y": np.concatenate([aggregated["y"][outside], aggregated_y]),
+                                     "strength": np.concatenate([aggregated["strength"][outside],
+                                                                 self.thermal_map[aggregated_x, aggregated_y]])}
+
+    def window_max(self, window):
+        """ Strongest spread heat over the cells of window that hold particle heat, 0 if none do """
+        holds_heat = self.heat_buffer[window] > 0
+        return self.spread_buffer[window][holds_heat].max() if holds_heat.any() else 0
+
 # Make good thermals more likely
-def thermal_distribution(normalized_thermal):
-    normalized_thermal = np.sqrt(normalized_thermal)
-    if normalized_thermal > (6/10):
-        normalized_thermal = (6/10)
-    normalized_thermal *= 10/6
-    return normalized_thermal
+def thermal_distribution(normalized_thermal, out = None):
+    normalized_thermal = np.minimum(np.sqrt(normalized_thermal, out=out), 6/10, out=out)
+    return np.divide(np.multiply(normalized_thermal, 10, out=out), 6, out=out)
+
+def spread(heat_map, kernel, out = None):
+    """ Add every cell's heat onto its neighbours weighted by kernel (centred on the cell), i.e. a 2D convolution """
+    radius_x, radius_y = kernel.shape[0] // 2, kernel.shape[1] // 2
+    map_width, map_height = heat_map.shape
+    if out is None:
+        out = np.zeros(heat_map.shape)
+    else:
+        out.fill(0)
+    spread_map = out
+    for kernel_x in range(kernel.shape[0]):
+        for kernel_y in range(kernel.shape[1]):
+            factor = kernel[kernel_x, kernel_y]
+            if factor == 0:
+                continue
+            delta_x, delta_y = kernel_x - radius_x, kernel_y - radius_y
+            spread_map[max(delta_x, 0):map_width + min(delta_x, 0), max(delta_y, 0):map_height + min(delta_y, 0)] += (
+                factor * heat_map[max(-delta_x, 0):map_width - max(delta_x, 0), max(-delta_y, 0):map_height - max(delta_y, 0)])
+    return spread_map
+
+def generate_test_height_map(dim_x, dim_y):
+    """ Smooth hills, so that particles climb for several steps """
+    x, y = np.meshgrid(np.arange(dim_x), np.arange(dim_y), indexing="ij")
+    return 1.5 + np.sin(x / 7) + np.cos(y / 5) + 0.3 * np.sin((x + y) / 3)
+
+class TestThermalParticles(unittest.TestCase):
+
+    def test_batch_matches_objects(self):
+        rng = np.random.default_rng(1)
+        height_map = rng.random((40, 30)) * 3
+        for wind in [(0, 0), (5, -3)]:
+            results = []
+            for mode in [SimulationMode.OBJECTS, SimulationMode.BATCH]:
+                thermals = ThermalParticleDistribution(200, height_map, 5, seed=2)
+                thermals.simulate_particles(wind, mode=mode, trail=ParticleTrail(initial_steps=2))
+                results.append(thermals)
+            objects, batch = results
+            self.assertTrue(np.array_equal(objects.thermal_map, batch.thermal_map))
+            self.assertTrue(np.array_equal(objects.particle_trail.position_x, batch.particle_trail.position_x))
+            self.assertTrue(np.array_equal(objects.particle_trail.heat_energy, batch.particle_trail.heat_energy, equal_nan=True))
+            self.assertEqual([(particle.position_x, particle.position_y, particle.heat_energy) for particle in objects.particles],
+                             [(particle.position_x, particle.position_y, particle.heat_energy) for particle in batch.particles])
+
+    def test_trail_recording(self):
+        batch = ThermalParticleBatch([0, 3, 22], [2, 2, 4])
+        height_map = np.tile(np.arange(30, dtype=np.float64)[:, np.newaxis] * 0.1, (1, 5))
+        trail = ParticleTrail(initial_steps=1)
+        batch.simulate(height_map, trail=trail)
+        trails = trail.as_lists()
+        self.assertEqual(trails[1]["x"], list(range(4, 30)) + [29])
+        self.assertEqual(len(trails[2]["heat"]), 8)
+
+        with tempfile.TemporaryDirectory() as folder:
+            decimated = ParticleTrail(every=5, folder=folder, initial_steps=1)
+            ThermalParticleBatch([0, 3, 22], [2, 2, 4]).simulate(height_map, trail=decimated)
+            self.assertEqual(decimated.as_lists()[0]["x"], [5, 10, 15, 20, 25, 29])
+            self.assertEqual(np.load(os.path.join(folder, "trail_x.npy")).shape, (8, 3))
+            del decimated
+
+    def test_aggregation(self):
+        thermals = ThermalParticleDistribution(0, np.zeros((6, 5)), 5)
+        thermals.load_particle_state([[2, 2, 100], [2, 2, 50], [0, 3, 100], [4, 3, 15]])
+        thermals.aggregate_particles()
+
+        self.assertEqual(thermals.thermals, {(2, 2): 150, (4, 3): 15})
+        self.assertEqual(thermals.thermal_map.shape, (6, 5))
+        self.assertAlmostEqual(thermals.thermal_map[2, 2], 5)
+        # 0.4 of the strongest cell passes the 6/10 cap after the square root, 0.2 doesn't
+        self.assertAlmostEqual(thermals.thermal_map[2, 1], 5)
+        self.assertAlmostEqual(thermals.thermal_map[1, 1], 5 * np.sqrt(0.2) * 10/6)
+        self.assertEqual(thermals.thermal_map[0, 3], 0)
+        self.assertEqual(len(thermals.aggregated_particles["x"]), np.count_nonzero(thermals.thermal_map))
+
+    def test_instances_and_reset(self):
+        height_map = np.random.default_rng(0).random((20, 15)) * 3
+        first = ThermalParticleDistribution(100, height_map, 5, seed=1)
+        first.simulate_particles((0, 0))
+        second = ThermalParticleDistribution(100, height_map, 5, seed=1)
+        self.assertEqual(second.thermals, {})
+        self.assertEqual(len(second.aggregated_particles["x"]), 0)
+
+        expected = first.thermal_map.copy()
+        first.reset(50, np.zeros((10, 10)), 5, seed=2)
+        self.assertEqual(first.thermals, {})
+        self.assertIsNone(first.thermal_map)
+        first.reset(100, height_map, 5, seed=1)
+        first.simulate_particles((0, 0))
+        self.assertTrue(np.array_equal(first.thermal_map, expected))
+
+        # Same dimensions, so the work buffers are reused
+        heat_buffer = first.heat_buffer
+        thermal_map = first.thermal_map
+        first.reset(100, height_map * 2, 5, seed=1)
+        self.assertIs(first.heat_buffer, heat_buffer)
+        self.assertIsNone(first.particle_trail)
+        first.simulate_particles((0, 0))
+        self.assertIs(first.thermal_map, thermal_map)
+
+    def test_update_region(self):
+        height_map = generate_test_height_map(60, 50)
+        thermals = ThermalParticleDistribution(600, height_map, 5, seed=4)
+        thermals.simulate_particles((3, 1), track_paths=True)
+
+        edited = height_map.copy()
+        edited[20:30, 10:18] += 1.5
+        thermals.update_region(20, 10, 30, 18, height_map=edited, wind=(3, 1))
+
+        # Every particle now ends where a fresh simulation from its start point ends on the edited map
+        check = ThermalParticleBatch(thermals.start_x, thermals.start_y)
+        check.simulate(edited, (3, 1))
+        self.assertTrue(np.array_equal(check.position_x, thermals.particle_batch.position_x))
+        self.assertTrue(np.array_equal(check.heat_energy, thermals.particle_batch.heat_energy))
+
+        patched = thermals.thermal_map.copy()
+        thermals.aggregate_particles()
+        self.assertTrue(np.allclose(patched, thermals.thermal_map))
+
+    def test_update_region_matches_full_simulation(self):
+        height_map = generate_test_height_map(80, 70)
+        thermals = ThermalParticleDistribution(1500, height_map, 5, seed=2)
+        thermals.simulate_particles((0, 0), track_paths=True)
+
+        # Raise a patch of ground, dent another, then flatten the ground around the strongest thermal so it weakens
+        edited = height_map.copy()
+        edited[50:60, 10:20] += 1.0
+        thermals.update_region(50, 10, 60, 20, height_map=edited)
+        edited = edited.copy()
+        edited[5:12, 50:58] -= 0.3
+        thermals.update_region(5, 50, 12, 58, height_map=edited)
+        strongest_x, strongest_y = max(thermals.thermals, key=lambda cell: thermals.spread_buffer[cell])
+        edited = edited.copy()
+        region = (slice(max(strongest_x - 6, 0), strongest_x + 6), slice(max(strongest_y - 6, 0), strongest_y + 6))
+        edited[region] = np.min(edited[region])
+        thermals.update_region(region[0].start, region[1].start, region[0].stop, region[1].stop, height_map=edited)
+
+        full = ThermalParticleDistribution(0, edited, 5)
+        full.particles = ParticlePool(DiscreteThermalParticle, len(thermals.start_x),
+                                      position_x=thermals.start_x, position_y=thermals.start_y)
+        full.simulate_particles((0, 0))
+        self.assertTrue(np.allclose(thermals.thermal_map, full.thermal_map))
+        self.assertEqual(thermals.thermals.keys(), full.thermals.keys())
+        self.assertTrue(np.allclose([thermals.thermals[cell] for cell in full.thermals], list(full.thermals.values())))
+        patched_order = np.lexsort((thermals.aggregated_particles["y"], thermals.aggregated_particles["x"]))
+        for key in ["x", "y", "strength"]:
+            self.assertTrue(np.allclose(thermals.aggregated_particles[key][patched_order], full.aggregated_particles[key]))
+
+    def test_ascent_graph(self):
+        # A ramp climbing towards +x, with a cliff part way up that drops away fast enough to release particles
+        height_map = np.tile(np.arange(30, dtype=np.float64)[:, np.newaxis] * 0.1, (1, 5))
+        height_map[20:] -= 1.5
+        graph = ThermalAscentGraph(height_map)
+        end_x, end_y, heat_energy = graph.resolve([0, 3, 22], [2, 2, 4])
+        self.assertEqual(end_x.tolist(), [19, 19, 29])
+        self.assertEqual(end_y.tolist(), [2, 2, 4])
+        self.assertAlmostEqual(heat_energy[0], 100 * 0.95 ** 20)
+
+        batch = ThermalParticleBatch([0, 3, 22], [2, 2, 4])
+        batch.simulate(height_map)
+        self.assertEqual(batch.position_x.tolist(), end_x.tolist())
+        self.assertTrue(np.allclose(batch.heat_energy, heat_energy))
+
+    def test_particle_pool(self):
+        self.assertFalse(hasattr(DiscreteThermalParticle(1, 2), "__dict__"))
+        pool = ParticlePool(DiscreteThermalParticle, 4, position_x=np.arange(4), position_y=np.arange(4) * 2)
+        self.assertEqual(pool.columns["heat_energy"].dtype, np.float64)
+
+        view = pool[1]
+        self.assertIsInstance(view, DiscreteThermalParticle)
+        view.heat_energy *= 0.5
+        view.released = True
+        self.assertEqual(pool.columns["heat_energy"][1], INITIAL_HEAT_ENERGY / 2)
+        self.assertTrue(pool.columns["released"][1])
+
+        # Views step exactly like objects
+        height_map = np.fromfunction(lambda x, y: x + y / 2, (6, 10))
+        test_part = DiscreteThermalParticle(2, 4)
+        pool[2].step_dynamics(height_map, wind=(3, 0))
+        test_part.step_dynamics(height_map, wind=(3, 0))
+        self.assertEqual(pool.to_particles()[2], test_part)
+
+        # Slices share the columns, arrays and masks copy them
+        pool[1:3].columns["heat_energy"][1] = 7
+        self.assertEqual(pool.columns["heat_energy"][2], 7)
+        self.assertEqual(len(pool[::-2]), 2)
+        with self.assertRaises(TypeError):
+            pool[1.5]
+        with self.assertRaises(IndexError):
+            pool[4]
+        pool.columns["heat_energy"][2] = INITIAL_HEAT_ENERGY
+
+        class SubPool(ParticlePool):
+            pass
+        self.assertIsInstance(SubPool(DiscreteThermalParticle, 1, position_x=[0], position_y=[0])[:1], SubPool)
+        self.assertIsNot(SubPool.view_types, ParticlePool.view_types)
+
+        joined = ParticlePool.concatenate([pool[pool.columns["released"]], pool[np.array([3, 0])]])
+        self.assertEqual(joined.columns["position_x"].tolist(), [1, 3, 0])
+        self.assertEqual([particle.heat_energy for particle in joined], [INITIAL_HEAT_ENERGY / 2, INITIAL_HEAT_ENERGY, INITIAL_HEAT_ENERGY])
+
+    def test_gradient_field(self):
+        height_map = np.fromfunction(lambda x, y: np.sin(x / 3) * np.cos(y / 4) + x / 10, (20, 15))
+        gradient = GradientField(height_map)
+        for x, y in [(0, 0), (5, 7), (18, 14), (19, 3), (10, 13), (3.7, 0.2), (18.5, 13.9), (7.25, 4.5)]:
+            test_part = Particle(float(x), float(y))
+            expected = test_part.normal_force(height_map)
+            for actual, wanted in zip(test_part.normal_force(height_map, gradient=gradient), expected):
+                self.assertAlmostEqual(actual, wanted)
+            # Height maps given as lists of rows are read cell by cell the same way
+            self.assertEqual(test_part.normal_force(height_map.tolist()), expected)
+
+        # Bilinear between cells, and the same from the array and scalar samplers
+        slope_x, slope_y = gradient.sample(np.array([4.25]), np.array([6.5]))
+        corners = gradient.slope[4:6, 6:8]
+        self.assertAlmostEqual(slope_x[0], 0.375 * corners[0, 0, 0] + 0.125 * corners[1, 0, 0] +
+                                           0.375 * corners[0, 1, 0] + 0.125 * corners[1, 1, 0])
+        self.assertAlmostEqual(gradient.sample_point(4.25, 6.5)[1], slope_y[0])
+
+        # Patched slopes match a fresh field
+        height_map[3:6, 13:15] += 2
+        height_map[19, 0] -= 1
+        gradient.update(3, 13, 6, 15)
+        gradient.update_cells(np.array([19]), np.array([0]))
+        self.assertTrue(np.allclose(gradient.slope, GradientField(height_map).slope))
+
+    def test_distribution_follows_probability(self):
+        # The left half sits at the sea level cutoff, where the probability is zero
+        height_map = np.full((20, 10), 3.0)
+        height_map[:10] = -SEA_LEVEL_PROBABILITY
+        thermals = ThermalParticleDistribution(1000.5, height_map, 5, seed=0)
+        self.assertEqual(len(thermals.particles), 1001)
+        self.assertTrue(all(particle.position_x >= 10 for particle in thermals.particles))
+
+        # Cells with albedo 1 are a third as likely as cells with albedo 0
+        albedo_map = np.zeros((20, 10))
+        albedo_map[:, 5:] = 1
+        thermals = ThermalParticleDistribution(2000, np.full((20, 10), 3.0), 5, albedo_map=albedo_map, seed=0)
+        dark = sum(particle.position_y < 5 for particle in thermals.particles)
+        self.assertAlmostEqual(dark / len(thermals.particles), 0.75, delta=0.03)
 
 if __name__ == "__main__":
     unittest.main() 
-        
@@ -1,4 +1,8 @@
 import numpy as np
+import unittest
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 # Taken from https://github.com/BarlowR/proc-gen/blob/master/noise/perlin_noise.py
 
@@ -64,15 +68,203 @@ def grad(hash, x, y, z):
       else: return first - v
 
           
+def grad_array(hash, x, y, z):
+    """ Vectorized grad: selects the gradient direction for arrays of hashes and coordinates """
+    h = hash & 15                                               # CONVERT LO 4 BITS OF HASH CODE
+    u = np.where(h < 8, x, y)                                   # INTO 12 GRADIENT DIRECTIONS.
+    v = np.where(h < 4, y, np.where((h == 12) | (h == 14), x, z))
+    first = np.where((h & 1) == 0, u, -u)
+    return np.where((h & 2) == 0, first + v, first - v)
+
+class PerlinNoise():
+    """
+    Perlin noise generator that owns its permutation table.
+    With seed = None the classic table above is used, otherwise the table is a shuffle of 0-255 drawn from the seed, so
+    the same seed always gives the same noise. Instances only hold the seed and a numpy table, so they pickle cleanly
+    to worker processes.
+    """
+    def __init__(self, seed = None):
+        self.seed = seed
+        if seed is None:
+            table = np.array(permutation, dtype=np.int64)
+        else:
+            table = np.random.default_rng(seed).permutation(256).astype(np.int64)
+        self.p = np.concatenate([table, table])
+
+    def noise(self, x, y, z, fade = quint_fade):
+        """
+        Vectorized improved_perlin_noise. x, y and z may be arrays (or scalars) that broadcast against each other;
+        every point is evaluated at once with array-indexed permutation lookups. With the classic table, results
+        match the scalar path bit for bit.
+        """
+        p = self.p
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        z = np.asarray(z, dtype=np.float64)
+
+        x_int = np.trunc(x)                                         # int() truncates towards zero
+        y_int = np.trunc(y)
+        z_int = np.trunc(z)
+        X = x_int.astype(np.int64) & 255                            # FIND UNIT CUBE THAT
+        Y = y_int.astype(np.int64) & 255                            # CONTAINS POINT.
+        Z = z_int.astype(np.int64) & 255
+        x = x - x_int                                               # FIND RELATIVE X,Y,Z
+        y = y - y_int                                               # OF POINT IN CUBE.
+        z = z - z_int
+        u = fade(x)                                                 # COMPUTE FADE CURVES
+        v = fade(y)                                                 # FOR EACH OF X,Y,Z.
+        w = fade(z)
+        A = p[X]+Y
+        AA = p[A]+Z
+        AB = p[A+1]+Z
+        B = p[X+1]+Y
+        BA = p[B]+Z                                                 # HASH COORDINATES OF
+        BB = p[B+1]+Z                                               # THE 8 CUBE CORNERS,
+
+        return lerp(w,  lerp(v, lerp(u, grad_array(p[AA  ], x  , y  , z   ),     # AND ADD
+                                        grad_array(p[BA  ], x-1, y  , z   )),    # BLENDED
+                                lerp(u, grad_array(p[AB  ], x  , y-1, z   ),     # RESULTS
+                                        grad_array(p[BB  ], x-1, y-1, z   ))),   # FROM  8
+                        lerp(v, lerp(u, grad_array(p[AA+1], x  , y  , z-1 ),     # CORNERS
+                                        grad_array(p[BA+1], x-1, y  , z-1 )),    # OF CUBE
+                                lerp(u, grad_array(p[AB+1], x  , y-1, z-1 ),
+                                        grad_array(p[BB+1], x-1, y-1, z-1 ))))
+
+    def noise_map(self, x_dim, y_dim, scale_x, scale_y = -1, z_pos = 0, x_offset = 0, y_offset = 0, interp_func = quint_fade):
+        if scale_y == -1: scale_y = scale_x
+
+        # Evaluate the whole grid at once. grid[j, i] is the noise at world position ((j+x_offset)/80 * scale_x, (i+y_offset)/80 * scale_y)
+        x_pos_world = ((np.arange(x_dim) + x_offset)/80 * scale_x)[:, np.newaxis]
+        y_pos_world = ((np.arange(y_dim) + y_offset)/80 * scale_y)[np.newaxis, :]
+        grid = self.noise(x_pos_world, y_pos_world, z_pos, fade=interp_func)
+
+        return np.broadcast_to(grid, (x_dim, y_dim)).copy()
+
+    def layered_noise_map(self, x_dim, y_dim, octaves, x_offset = 0, y_offset = 0, dtype = np.float64, out = None, rows_per_block = 256, interp_func = quint_fade):
+        """
+        Sum several weighted noise maps (fBm style) into a single buffer.
+        octaves is a list of (weight, scale_x, scale_y, z_pos) tuples, with scale_y = -1 meaning scale_y = scale_x as in noise_map.
+        The world coordinates are computed once and every octave is accumulated block by block into out (allocated with the
+        given dtype if not provided), so peak memory stays close to a single map. The result matches summing weighted
+        noise_map calls in octave order.
+        """
+        if out is None:
+            out = np.zeros((x_dim, y_dim), dtype=dtype)
+        else:
+            assert(out.shape == (x_dim, y_dim))
+            out[:] = 0
+
+        x_index = np.arange(x_dim) + x_offset
+        y_index = np.arange(y_dim) + y_offset
+        octave_positions = []
+        for weight, scale_x, scale_y, z_pos in octaves:
+            if scale_y == -1: scale_y = scale_x
+            octave_positions.append((weight, (x_index/80 * scale_x)[:, np.newaxis], (y_index/80 * scale_y)[np.newaxis, :], z_pos))
+
+        for block_start in range(0, x_dim, rows_per_block):
+            block = slice(block_start, min(block_start + rows_per_block, x_dim))
+            for weight, x_pos_world, y_pos_world, z_pos in octave_positions:
+                out[block] += weight * self.noise(x_pos_world[block], y_pos_world, z_pos, fade=interp_func)
+
+        return out
+
+    def tiled_layered_noise_map(self, x_dim, y_dim, octaves, tile_size = 512, workers = None, x_offset = 0, y_offset = 0, dtype = np.float64):
+        """
+        layered_noise_map split into tile_size x tile_size tiles evaluated on a process pool.
+        Each tile is generated at its world space offset and written straight into a shared memory result, so the
+        output is identical to a single process layered_noise_map call. workers = None uses every core and
+        workers = 1 skips the pool entirely.
+        """
+        if workers == 1:
+            return self.layered_noise_map(x_dim, y_dim, octaves, x_offset, y_offset, dtype)
+
+        dtype = np.dtype(dtype)
+        shared = shared_memory.SharedMemory(create=True, size=max(x_dim * y_dim * dtype.itemsize, 1))
+        try:
+            tiles = [(shared.name, (x_dim, y_dim), dtype.str, self, octaves,
+                      x_start, min(x_start + tile_size, x_dim), y_start, min(y_start + tile_size, y_dim), x_offset, y_offset)
+                     for x_start in range(0, x_dim, tile_size)
+                     for y_start in range(0, y_dim, tile_size)]
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for _ in pool.map(_layered_noise_tile, tiles):
+                    pass
+            result = np.ndarray((x_dim, y_dim), dtype=dtype, buffer=shared.buf).copy()
+        finally:
+            shared.close()
+            shared.unlink()
+        return result
+
+def _layered_noise_tile(tile):
+    """ Worker for tiled_layered_noise_map: generate one tile in place in the shared result """
+    shared_name, shape, dtype, noise, octaves, x_start, x_end, y_start, y_end, x_offset, y_offset = tile
+    shared = shared_memory.SharedMemory(name=shared_name)
+    try:
+        result = np.ndarray(shape, dtype=dtype, buffer=shared.buf)
+        noise.layered_noise_map(x_end - x_start, y_end - y_start, octaves, x_offset + x_start, y_offset + y_start,
+                                out=result[x_start:x_end, y_start:y_end])
+        del result
+    finally:
+        shared.close()
+
+# Generator using the classic permutation table, backing the module level functions
+DEFAULT_NOISE = PerlinNoise()
+
+def improved_perlin_noise_array(x, y, z, fade = quint_fade):
+    return DEFAULT_NOISE.noise(x, y, z, fade=fade)
+
 def noise_map(x_dim, y_dim, scale_x, scale_y = -1, z_pos = 0, x_offset = 0, y_offset = 0, interp_func = quint_fade):
-    if scale_y == -1: scale_y = scale_x
-    dimensional_scale = max(x_dim, y_dim)
-    grid = np.zeros((x_dim, y_dim))
-
-    for i in range(y_dim):
-        for j in range(x_dim):
-            x_pos_world = (j+x_offset)/80 * scale_x
-            y_pos_world = (i+y_offset)/80 * scale_y
-            grid[j, i] = improved_perlin_noise(x_pos_world, y_pos_world, z_pos, fade=quint_fade)
-    
-    return grid
+    return DEFAULT_NOISE.noise_map(x_dim, y_dim, scale_x, scale_y, z_pos, x_offset, y_offset, interp_func)
+
+def layered_noise_map(x_dim, y_dim, octaves, x_offset = 0, y_offset = 0, dtype = np.float64, out = None, rows_per_block = 256, interp_func = quint_fade):
+    return DEFAULT_NOISE.layered_noise_map(x_dim, y_dim, octaves, x_offset, y_offset, dtype, out, rows_per_block, interp_func)
+
+class TestNoise(unittest.TestCase):
+
+    def scalar_noise_map(self, x_dim, y_dim, scale_x, scale_y, z_pos, x_offset, y_offset):
+        grid = np.zeros((x_dim, y_dim))
+        for i in range(y_dim):
+            for j in range(x_dim):
+                x_pos_world = (j+x_offset)/80 * scale_x
+                y_pos_world = (i+y_offset)/80 * scale_y
+                grid[j, i] = improved_perlin_noise(x_pos_world, y_pos_world, z_pos)
+        return grid
+
+    def test_matches_scalar(self):
+        for args in [(40, 30, 1, 1, 0, 0, 0),
+                     (35, 50, 5, 2, 3.7, 0, 0),
+                     (20, 20, 20, 20, 9.2, 13, 71),
+                     (25, 15, 15, 5, 1.5, -300, -45)]:
+            expected = self.scalar_noise_map(*args)
+            x_dim, y_dim, scale_x, scale_y, z_pos, x_offset, y_offset = args
+            result = noise_map(x_dim, y_dim, scale_x, scale_y=scale_y, z_pos=z_pos, x_offset=x_offset, y_offset=y_offset)
+            self.assertEqual(result.shape, (x_dim, y_dim))
+            self.assertTrue(np.array_equal(result, expected), f"Vectorized noise differs for {args}")
+
+    def test_layered_matches_sum(self):
+        octaves = [(3, 1, -1, 0.5), (8, 5, 2, 7.25), (2, 15, 5, 3.0)]
+        expected = np.sum([weight * noise_map(30, 45, scale_x, scale_y=scale_y, z_pos=z_pos, x_offset=4, y_offset=9)
+                           for weight, scale_x, scale_y, z_pos in octaves], axis=0)
+        result = layered_noise_map(30, 45, octaves, x_offset=4, y_offset=9, rows_per_block=7)
+        self.assertTrue(np.array_equal(result, expected))
+
+        result_32 = layered_noise_map(30, 45, octaves, x_offset=4, y_offset=9, dtype=np.float32)
+        self.assertEqual(result_32.dtype, np.float32)
+        self.assertTrue(np.allclose(result_32, expected, atol=1e-5))
+
+    def test_seeded_generator(self):
+        first = PerlinNoise(42).noise_map(20, 30, 5, z_pos=1.5)
+        self.assertTrue(np.array_equal(first, PerlinNoise(42).noise_map(20, 30, 5, z_pos=1.5)))
+        self.assertFalse(np.array_equal(first, PerlinNoise(43).noise_map(20, 30, 5, z_pos=1.5)))
+
+        restored = pickle.loads(pickle.dumps(PerlinNoise(42)))
+        self.assertTrue(np.array_equal(first, restored.noise_map(20, 30, 5, z_pos=1.5)))
+
+    def test_tiled_matches_single_process(self):
+        noise = PerlinNoise(5)
+        octaves = [(3, 1, -1, 0.5), (8, 5, 2, 7.25)]
+        expected = noise.layered_noise_map(70, 45, octaves, x_offset=3)
+        result = noise.tiled_layered_noise_map(70, 45, octaves, tile_size=16, workers=2, x_offset=3)
+        self.assertTrue(np.array_equal(result, expected))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+from concurrent.futures import ThreadPoolExecutor
+import unittest
+import tempfile
+import asyncio
+import sqlite3
+import bisect
+import json
+import os
+
+# Best score per pilot name, kept sorted in memory and persisted to SQLite.
+# Scores are recorded in memory straight away and written to the database in batches on a single writer thread,
+# so a flight ending never waits on the disk. The database runs in WAL mode, so the worker processes can all write
+# to the same file while readers carry on.
+
+DATABASE_PATH = "server/high_scores.sqlite"
+JSON_PATH = "server/high_scores.json"
+FLUSH_INTERVAL_S = 1.0
+
+class Leaderboard:
+    """
+    best maps name -> best score, ranking holds (-score, name) in sorted order so the top k are its first k entries.
+    Finding an entry is a bisection; the list shift on insert is a memmove, which stays well under a microsecond per
+    thousand entries, far below a scan and rewrite of the whole table.
+    """
+    def __init__(self, database_path = DATABASE_PATH, import_paths = ()):
+        self.database_path = database_path
+        self.best = {}
+        self.ranking = []
+        self.pending = {}
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        # Only the writer thread touches the connection once the leaderboard is up
+        self.connection = sqlite3.connect(database_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA busy_timeout=5000")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS scores (name TEXT PRIMARY KEY, score INTEGER NOT NULL)")
+        self.connection.commit()
+        self.merge(self.connection.execute("SELECT name, score FROM scores"))
+
+        for path in import_paths:
+            if os.path.exists(path):
+                self.import_json(path)
+        self.write(self.take_pending())
+
+    def import_json(self, path):
+        """ Record the [[name, score], ...] table the server used to keep in a JSON file """
+        with open(path, "r") as f:
+            for name, score in json.load(f):
+                self.record(name, score)
+
+    def upsert(self, name, score):
+        """ Keep score as name's best if it beats the one held. Returns whether it did """
+        existing = self.best.get(name)
+        if existing is not None:
+            if score <= existing:
+                return False
+            del self.ranking[bisect.bisect_left(self.ranking, (-existing, name))]
+        self.best[name] = score
+        bisect.insort(self.ranking, (-score, name))
+        return True
+
+    def record(self, name, score):
+        """ Upsert and queue the new best for the next flush """
+        score = int(score)
+        if self.upsert(name, score):
+            self.pending[name] = score
+
+    def merge(self, rows):
+        """ Upsert scores read back from the database, e.g. written by other workers """
+        for name, score in rows:
+            self.upsert(name, score)
+
+    def top(self, k):
+        """ The best k as [name, score] pairs, lowest first like the JSON table """
+        return [[name, -negative_score] for negative_score, name in reversed(self.ranking[:k])]
+
+    def take_pending(self):
+        pending, self.pending = self.pending, {}
+        return list(pending.items())
+
+    def write(self, rows, k = None):
+        """ Write a batch of best scores in one transaction, and read back the top k (runs on the writer thread) """
+        with self.connection:
+            self.connection.executemany("INSERT INTO scores (name, score) VALUES (?, ?) "
+                                        "ON CONFLICT(name) DO UPDATE SET score = excluded.score "
+                                        "WHERE excluded.score > scores.score", rows)
+        if k is None:
+            return []
+        return self.connection.execute("SELECT name, score FROM scores ORDER BY score DESC LIMIT ?", (k,)).fetchall()
+
+    async def flush(self, k = None):
+        """ Write the queued scores on the writer thread, then merge in the top k from the database """
+        rows = self.take_pending()
+        loop = asyncio.get_running_loop()
+        self.merge(await loop.run_in_executor(self.executor, self.write, rows, k))
+
+    async def run(self, k, interval = FLUSH_INTERVAL_S):
+        """ Flush every interval seconds, picking up the top k other workers have written """
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                await self.flush(k)
+        finally:
+            self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.write(self.take_pending())
+        self.connection.close()
+
+
+class TestLeaderboard(unittest.TestCase):
+
+    def test_best_score_per_name(self):
+        with tempfile.TemporaryDirectory() as folder:
+            json_path = os.path.join(folder, "high_scores.json")
+            with open(json_path, "w") as f:
+                json.dump([["carol", 50], ["alice", 300]], f)
+            database_path = os.path.join(folder, "high_scores.sqlite")
+
+            leaderboard = Leaderboard(database_path, [json_path])
+            leaderboard.record("bob", 120.7)
+            leaderboard.record("alice", 200)
+            leaderboard.record("carol", 400)
+            self.assertEqual(leaderboard.top(2), [["alice", 300], ["carol", 400]])
+            self.assertEqual(leaderboard.top(5), [["bob", 120], ["alice", 300], ["carol", 400]])
+            self.assertEqual(leaderboard.pending, {"bob": 120, "carol": 400})
+
+            # Another worker writing to the same database
+            other = Leaderboard(database_path)
+            other.record("dave", 500)
+            asyncio.run(other.flush())
+            other.close()
+
+            asyncio.run(leaderboard.flush(5))
+            self.assertEqual(leaderboard.top(1), [["dave", 500]])
+            leaderboard.close()
+
+            reopened = Leaderboard(database_path, [json_path])
+            self.assertEqual(reopened.top(5), [["bob", 120], ["alice", 300], ["carol", 400], ["dave", 500]])
+            reopened.close()
+
+if __name__ == "__main__":
+    unittest.main()
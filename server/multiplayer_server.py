@@ -2,74 +2,88 @@
 import asyncio
 import websockets
 from websockets.asyncio.server import broadcast, serve
+from websockets.asyncio.client import connect
 import json
 from enum import IntEnum
 import ssl
 import random
-import bisect 
+import struct
+import zlib
+import argparse
+import multiprocessing
+import wire_protocol
+import tick_scheduler
+import leaderboard
 
 
+# Simulation tick, and how often clients are sent the state (at most once a tick)
 UPDATE_TIME_MS = 10
+BROADCAST_TIME_MS = 10
+# A full report goes out at least this often, and on the tick after a player joins
+KEYFRAME_INTERVAL_MS = 1000
 WAIT_TIME_MS = 10 * 1000
 FLIGHT_LENGTH = 120 * 1000
 
+PORT = 8080
+# Worker processes relay players to each other on RELAY_PORT_BASE + worker index
+RELAY_PORT_BASE = 9080
+MAX_ROOM_PLAYERS = 16
+AUTO_ROOM_PREFIX = "auto-"
+HIGH_SCORES_SHOWN = 5
+
 class GameStates(IntEnum):
     WAITING_FOR_START = 0
     RUNNING = 1
     COMPLETED = 2
 
 
-def load_high_scores():
-    high_scores = {}
-    with open("server/high_scores.json", "r") as f:
-        high_scores = json.load(f)
-    return high_scores
-
-def save_score(name, score):
-    print(f"Saving score for {name}: {score}")
-    high_scores = load_high_scores()
-    # insert new score into sorted score table
-    index_to_pop = -1
-    found_name = False
-    for index in range(len(high_scores)):
-        existing_name, existing_score = high_scores[index]
-        if (name == existing_name):
-            found_name = True
-            if score > existing_score:
-                # Set the index if the name matches and the new score is higher than the existing score
-                index_to_pop = index
-                break
-
-    # Remove and insort the new entry if the index has been set
-    if (index_to_pop >= 0):
-        high_scores.pop(index_to_pop)
-    if ((index_to_pop >= 0) or not found_name):
-        bisect.insort(high_scores, [name, int(score)], key=lambda x: x[1])
-        with open("server/high_scores.json", "w") as f:
-            json.dump(high_scores, f, indent=2)
-
 class SoaringGameState:
-    gliders = {}
-    map = None
-    game_state = GameStates.WAITING_FOR_START
-    starting_position = {"x": 300, "y": 300, "z": 3}
-    high_scores = load_high_scores()
-    world_time = WAIT_TIME_MS
-    def __init__(self, period):
+    def __init__(self, period, leaderboard = None, broadcast_period = None):
         self.period = period
+        self.broadcast_period = broadcast_period or period
+        self.leaderboard = leaderboard
+        self.gliders = {}
+        self.map = None
+        self.game_state = GameStates.WAITING_FOR_START
+        self.starting_position = {"x": 300, "y": 300, "z": 3}
+        self.high_scores = leaderboard.top(HIGH_SCORES_SHOWN) if leaderboard is not None else []
+        self.world_time = WAIT_TIME_MS
+
+        # Delta reports: what each client was last sent, and what changed since
+        self.sent_gliders = {}
+        self.sent_starting_position = None
+        self.sent_high_scores = None
+        self.dirty_gliders = set()
+        self.added_gliders = set()
+        self.removed_gliders = set()
+        self.ticks_since_keyframe = 0
+        self.keyframe_requested = True
+        # Small integer ids for the binary protocol
+        self.next_glider_index = 0
 
     def register_new_glider(self, id, name, color):
+        index = self.next_glider_index
+        self.next_glider_index = (self.next_glider_index + 1) % 65536
         self.gliders[id] = {"color": color,
                               "name": name,
+                              "index": index,
                               "score": 0,
                               "dynamics": {"airspeed": 0,
                                            "direction" : 0,
                                             "thermalling" : False,
                                             "velocity" : {"x": 0, "y": 0, "z": 0},
                                             "position" : {"x": 0, "y": 0, "z": 0}}}
+        self.added_gliders.add(id)
+        self.removed_gliders.discard(id)
     
     def remove_glider(self, name):
-        self.gliders.pop(name, None)
+        if self.gliders.pop(name, None) is not None:
+            self.removed_gliders.add(name)
+            self.added_gliders.discard(name)
+
+    def request_keyframe(self):
+        """ Send a full report on the next tick, e.g. so a new player gets the whole state """
+        self.keyframe_requested = True
 
     def score_glider(self, glider_id):
         if glider_id not in self.gliders.keys():
@@ -85,9 +99,10 @@ class SoaringGameState:
         if glider_id in self.gliders.keys():
             self.gliders[glider_id]["dynamics"] = dynamics
             self.score_glider(glider_id)
+            self.dirty_gliders.add(glider_id)
 
-    def wait_for_start(self):
-        self.world_time -= self.period
+    def wait_for_start(self, elapsed):
+        self.world_time -= elapsed
         if (self.world_time <= 0):
                 self.starting_position["x"] = random.randint(250, 750)
                 self.starting_position["y"] = random.randint(250, 750)
@@ -99,8 +114,8 @@ class SoaringGameState:
         self.world_time = FLIGHT_LENGTH
         self.game_state = GameStates.RUNNING
 
-    def run_flight(self):
-        self.world_time -= self.period   
+    def run_flight(self, elapsed):
+        self.world_time -= elapsed
         if (self.check_finished()):
             self.end_flight()
         return
@@ -109,30 +124,35 @@ class SoaringGameState:
         print("End")
         self.world_time = WAIT_TIME_MS
         self.game_state = GameStates.COMPLETED
-        for glider in self.gliders.values():
-            save_score(glider["name"], glider["score"])
-        self.high_scores = load_high_scores()
+        if self.leaderboard is not None:
+            # Recorded in memory, the leaderboard writes them to disk in the background
+            for glider in self.gliders.values():
+                self.leaderboard.record(glider["name"], glider["score"])
+            self.high_scores = self.leaderboard.top(HIGH_SCORES_SHOWN)
 
 
-    def teardown(self):
-        self.world_time -= self.period
+    def teardown(self, elapsed):
+        self.world_time -= elapsed
         if (self.world_time <= 0):
             self.game_state = GameStates.WAITING_FOR_START
             self.world_time = WAIT_TIME_MS
             print("Lobby")
 
-    def update(self):
+    def update(self, elapsed = None):
+        """ Advance the game by elapsed ms, a period by default """
+        if elapsed is None:
+            elapsed = self.period
         if (len(self.gliders) == 0):
             self.game_state = GameStates.WAITING_FOR_START
             self.world_time = WAIT_TIME_MS
             return
 
         if (self.game_state == GameStates.WAITING_FOR_START):
-            self.wait_for_start()
+            self.wait_for_start(elapsed)
         elif (self.game_state == GameStates.RUNNING):
-            self.run_flight()    
+            self.run_flight(elapsed)
         elif (self.game_state == GameStates.COMPLETED):
-            self.teardown()   
+            self.teardown(elapsed)   
 
     def generate_glider_position_report(self):
         return json.dumps({"type" : "report",
@@ -140,22 +160,202 @@ class SoaringGameState:
                                         "game_state" : int(self.game_state),
                                         "starting_position" : self.starting_position,
                                         "gliders" : self.gliders, 
-                                        "high_scores" : self.high_scores[0-5:]}})
+                                        "high_scores" : self.high_scores}})
+
+    def generate_roster_report(self):
+        """ The rarely changing part of a full report, sent as JSON alongside binary keyframes """
+        return json.dumps({"type" : "roster",
+                            "roster" : {"starting_position" : self.starting_position,
+                                        "high_scores" : self.high_scores,
+                                        "gliders" : {id: {"index": glider["index"], "name": glider["name"], "color": glider["color"]}
+                                                     for id, glider in self.gliders.items()}}})
+
+    def glider_records(self, ids):
+        return [(self.gliders[id]["index"], self.gliders[id]["score"], self.gliders[id]["dynamics"]) for id in ids]
+
+    def generate_reports(self, protocols):
+        """
+        The messages for this tick for each protocol in protocols, each serialized once for all clients using it:
+        a full report (keyframe) every KEYFRAME_INTERVAL_MS or when one was requested, otherwise a delta against the
+        previous tick.
+        A JSON delta always carries the clock and game state. It holds gliders that joined or left, and the score and
+        dynamics fields that changed for the others. Starting position and high scores are only sent when they change.
+        Binary clients get the gliders as fixed size records (wire_protocol), plus the other delta fields as JSON on
+        the ticks they change.
+        """
+        reports = {}
+        self.ticks_since_keyframe += 1
+        if self.keyframe_requested or self.ticks_since_keyframe * self.broadcast_period >= KEYFRAME_INTERVAL_MS:
+            if wire_protocol.PROTOCOL_JSON in protocols:
+                reports[wire_protocol.PROTOCOL_JSON] = [self.generate_glider_position_report()]
+            if wire_protocol.PROTOCOL_BINARY in protocols:
+                reports[wire_protocol.PROTOCOL_BINARY] = [self.generate_roster_report(),
+                                                          wire_protocol.encode_tick(True, self.world_time, self.game_state,
+                                                                                    self.glider_records(self.gliders))]
+            self.mark_sent()
+            return reports
+
+        delta = {"world_time" : self.world_time,
+                 "game_state" : int(self.game_state)}
+        if self.starting_position != self.sent_starting_position:
+            delta["starting_position"] = self.starting_position
+        if self.high_scores != self.sent_high_scores:
+            delta["high_scores"] = self.high_scores
+        if self.added_gliders:
+            delta["added"] = {id: self.gliders[id] for id in self.added_gliders}
+        if self.removed_gliders:
+            delta["removed"] = list(self.removed_gliders)
+
+        changed_gliders = {}
+        for id in self.dirty_gliders - self.added_gliders:
+            if id not in self.gliders:
+                continue
+            glider = self.gliders[id]
+            sent = self.sent_gliders[id]
+            changes = {}
+            if glider["score"] != sent["score"]:
+                changes["score"] = glider["score"]
+            dynamics = {field: value for field, value in glider["dynamics"].items() if sent["dynamics"].get(field) != value}
+            if dynamics:
+                changes["dynamics"] = dynamics
+            if changes:
+                changed_gliders[id] = changes
+
+        if wire_protocol.PROTOCOL_BINARY in protocols:
+            reports[wire_protocol.PROTOCOL_BINARY] = []
+            if len(delta) > 2:
+                reports[wire_protocol.PROTOCOL_BINARY].append(json.dumps({"type" : "delta", "delta" : delta}))
+            reports[wire_protocol.PROTOCOL_BINARY].append(
+                wire_protocol.encode_tick(False, self.world_time, self.game_state, self.glider_records(changed_gliders)))
+        if wire_protocol.PROTOCOL_JSON in protocols:
+            if changed_gliders:
+                delta["gliders"] = changed_gliders
+            reports[wire_protocol.PROTOCOL_JSON] = [json.dumps({"type" : "delta", "delta" : delta})]
+        self.mark_sent(self.dirty_gliders | self.added_gliders)
+        return reports
+
+    def generate_report(self):
+        """ This tick's message for JSON clients """
+        return self.generate_reports({wire_protocol.PROTOCOL_JSON})[wire_protocol.PROTOCOL_JSON][0]
+
+    def mark_sent(self, ids = None):
+        """ Remember the state sent for gliders ids (all of them by default) and clear the change tracking """
+        if ids is None:
+            self.sent_gliders = {}
+            self.ticks_since_keyframe = 0
+            self.keyframe_requested = False
+            ids = self.gliders.keys()
+        for id in ids:
+            if id in self.gliders:
+                glider = self.gliders[id]
+                self.sent_gliders[id] = {"score": glider["score"], "dynamics": dict(glider["dynamics"])}
+        for id in self.removed_gliders:
+            self.sent_gliders.pop(id, None)
+        self.sent_starting_position = dict(self.starting_position)
+        self.sent_high_scores = list(self.high_scores)
+        self.dirty_gliders.clear()
+        self.added_gliders.clear()
+        self.removed_gliders.clear()
     
     def check_finished(self):
         return self.world_time <= 0
 
-CONNECTED_PLAYERS = set()
-GAME_INSTANCE = SoaringGameState(UPDATE_TIME_MS)
-
-async def run_game(connected, game_state):
-    while not game_state.check_finished():
-        GAME_INSTANCE.update()
-        await update_connected(connected, game_state)
-        await asyncio.sleep(UPDATE_TIME_MS/1000)
+class GameRoom:
+    """ One game: its own state machine, connected players (websocket -> wire protocol) and tick loop """
+    def __init__(self, name):
+        self.name = name
+        self.game_state = SoaringGameState(UPDATE_PERIOD_MS, LEADERBOARD, BROADCAST_PERIOD_MS)
+        self.connected = {}
+        self.scheduler = tick_scheduler.TickScheduler(UPDATE_PERIOD_MS, BROADCAST_PERIOD_MS)
+        self.task = asyncio.create_task(run_game(self.connected, self.game_state, self.scheduler))
+
+    def is_full(self):
+        return len(self.connected) >= MAX_ROOM_PLAYERS
+
+    def close(self):
+        self.task.cancel()
+        stats = self.scheduler.stats
+        print(f"Room {self.name}: {stats.ticks} ticks, {stats.broadcasts} broadcasts, {stats.overruns} overruns, "
+              f"{stats.late_ticks} late and {stats.skipped_ticks} skipped ticks, "
+              f"update {stats.update.summary()['mean_ms']:.3f}ms, serialize {stats.serialize.summary()['mean_ms']:.3f}ms, "
+              f"broadcast {stats.broadcast.summary()['mean_ms']:.3f}ms on average")
+
+# Rooms hosted by this process, by name
+ROOMS = {}
+# Position of this process among the workers sharing the public port, see serve_rooms
+WORKER_INDEX = 0
+WORKERS = 1
+# Best scores, shared by the rooms of this process
+LEADERBOARD = None
+# Tick and broadcast periods of new rooms, see serve_rooms
+UPDATE_PERIOD_MS = UPDATE_TIME_MS
+BROADCAST_PERIOD_MS = BROADCAST_TIME_MS
+# With several workers, a multiprocessing.Array shared by all of them: the worker whose auto assigned room is filling
+# and how many players have been sent to it
+FILLING_WORKER = None
+
+def room_owner(name):
+    """
+    Index of the worker process that hosts room name. Auto assigned rooms carry it in their name, any other name,
+    including one that only looks auto assigned, is placed by its hash
+    """
+    parts = name.split("-")
+    if name.startswith(AUTO_ROOM_PREFIX) and len(parts) == 3 and parts[1].isdecimal() and parts[2].isdecimal():
+        return int(parts[1]) % WORKERS
+    return zlib.crc32(name.encode()) % WORKERS
+
+def auto_room_owner():
+    """
+    The worker that places a player who didn't name a room, the same whichever worker asks so they end up together.
+    It's counted when routed rather than when joined, so joins still on their way don't overfill the room; once a
+    room's worth has been sent the next worker takes over. Players leaving aren't counted back, the worker just fills
+    the space the next time round
+    """
+    if FILLING_WORKER is None:
+        return WORKER_INDEX
+    with FILLING_WORKER.get_lock():
+        worker, routed = FILLING_WORKER
+        if routed >= MAX_ROOM_PLAYERS:
+            worker, routed = (worker + 1) % WORKERS, 0
+        FILLING_WORKER[:] = [worker, routed + 1]
+    return worker
+
+def assign_room(name = None):
+    """
+    The named room, created if needed, or else the first open auto assigned room of this worker. Joins without a room
+    are only placed here on the filling worker (see auto_room_owner), so players don't scatter over the workers' rooms
+    """
+    if name is None:
+        for room in ROOMS.values():
+            if room.name.startswith(AUTO_ROOM_PREFIX) and not room.is_full():
+                return room
+        number = 0
+        while f"{AUTO_ROOM_PREFIX}{WORKER_INDEX}-{number}" in ROOMS:
+            number += 1
+        name = f"{AUTO_ROOM_PREFIX}{WORKER_INDEX}-{number}"
+    if name not in ROOMS:
+        print(f"Opening room {name}")
+        ROOMS[name] = GameRoom(name)
+    return ROOMS[name]
+
+async def run_game(connected, game_state, scheduler):
+    """ Tick game_state and send it to the connected players at the scheduler's rates """
+    def serialize():
+        return game_state.generate_reports(set(connected.values()))
+
+    await scheduler.run(game_state.update, serialize, lambda reports: broadcast_reports(connected, reports),
+                        lambda: not game_state.check_finished())
     
 async def listen_client(websocket, id, game_state):
     async for message in websocket:
+        # Binary clients send bare dynamics records
+        if isinstance(message, bytes):
+            try:
+                game_state.update_dynamics(id, wire_protocol.decode_dynamics(message))
+            except (ValueError, struct.error) as exc:
+                print(exc)
+            continue
+
         # Load the message
         event = json.loads(message)
 
@@ -172,24 +372,53 @@ async def listen_client(websocket, id, game_state):
             print(exc)
             continue
 
-async def join(websocket, id, name, color):
+async def join(websocket, id, name, color, protocol = wire_protocol.PROTOCOL_JSON, room_name = None):
     # Register to receive moves from this game.
-    CONNECTED_PLAYERS.add(websocket)
-    print(f"Adding Player: {id}")
-
-    GAME_INSTANCE.register_new_glider(id, name, color)
+    room = assign_room(room_name)
     try:
+        # Registered inside the try, so a player who drops during the welcome still leaves the room
+        room.connected[websocket] = protocol
+        print(f"Adding Player: {id} ({protocol}) to room {room.name}")
+        await websocket.send(json.dumps({"type": "welcome", "protocol": protocol, "room": room.name}))
+
+        room.game_state.register_new_glider(id, name, color)
+        room.game_state.request_keyframe()
         # Send the first move, in case the first player already played it.
-        await listen_client(websocket, id, GAME_INSTANCE)
+        await listen_client(websocket, id, room.game_state)
     finally:
         print(f"Player {id} Left")
-        GAME_INSTANCE.remove_glider(id)
-        CONNECTED_PLAYERS.remove(websocket)
-
-async def update_connected(connected, game_state):
-    broadcast(connected, game_state.generate_glider_position_report())
-
-async def handler(websocket):
+        room.game_state.remove_glider(id)
+        room.connected.pop(websocket, None)
+        if not room.connected:
+            print(f"Closing room {room.name}")
+            room.close()
+            ROOMS.pop(room.name, None)
+
+async def relay(websocket, worker_index, join_message):
+    """ Pass a player's connection through to the worker hosting their room """
+    async with connect(f"ws://127.0.0.1:{RELAY_PORT_BASE + worker_index}") as worker:
+        await worker.send(join_message)
+        async def forward(source, destination):
+            try:
+                async for message in source:
+                    await destination.send(message)
+            except websockets.ConnectionClosed:
+                pass
+        to_worker = asyncio.create_task(forward(websocket, worker))
+        to_player = asyncio.create_task(forward(worker, websocket))
+        try:
+            await asyncio.wait([to_worker, to_player], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            to_worker.cancel()
+            to_player.cancel()
+
+def broadcast_reports(connected, reports):
+    for protocol, messages in reports.items():
+        sockets = [websocket for websocket, websocket_protocol in connected.items() if websocket_protocol == protocol]
+        for message in messages:
+            broadcast(sockets, message)
+
+async def handler(websocket, route = True):
     # Receive and parse the "init" event from the UI.
     try: 
         message = await websocket.recv()
@@ -200,34 +429,86 @@ async def handler(websocket):
         assert "type" in event.keys()
     except:
         print("Could not load message: ", message)
+        return
 
     if event["type"] == "join":
-        # Second player joins an existing game.
+        # Players name a room to fly together, or are put in the auto assigned room that is filling
+        room_name = event.get("room")
+        if room_name is not None and not isinstance(room_name, str):
+            print("Bad room name: ", room_name)
+            return
+        # Joins relayed from another worker have already been routed here
+        if route:
+            owner = auto_room_owner() if room_name is None else room_owner(room_name)
+            if owner != WORKER_INDEX:
+                await relay(websocket, owner, message)
+                return
         print("Joining...")
-        await join(websocket, event["id"], event["name"], event["color"])
-
-async def main():
+        await join(websocket, event["id"], event["name"], event["color"], wire_protocol.choose_protocol(event), room_name)
 
+def load_ssl_context():
     config = {}
     ssl_context = None
     with open("server/config.json") as f:
         config = json.load(f)
         print("Loaded config")
 
-    
-
-
     if (config["use_secure_websocket"]):
         # SSL Context setup
         print("Setting up secure websocket")
         ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
         ssl_context.load_cert_chain(certfile=config["certfile"], 
                                     keyfile=config["keyfile"])
-
-
-    async with serve(handler, "0.0.0.0", 8080, ssl=ssl_context):
-        await run_game(CONNECTED_PLAYERS, GAME_INSTANCE)
+    return ssl_context
+
+async def serve_rooms(port = PORT, worker_index = 0, workers = 1, update_period = UPDATE_TIME_MS,
+                      broadcast_period = BROADCAST_TIME_MS, filling_worker = None):
+    """
+    Serve players on port. With several workers every worker process listens on the same port (SO_REUSEPORT), so
+    the kernel spreads connections across them, and each hosts its own rooms. A player joining a room hosted by
+    another worker is relayed to it over that worker's local relay port, and so is a player who named no room when
+    another worker is filling the auto assigned rooms (filling_worker, a multiprocessing.Array("i", 2) shared by the
+    workers, see auto_room_owner).
+    Rooms simulate every update_period ms and send their state every broadcast_period ms.
+    """
+    global WORKER_INDEX, WORKERS, FILLING_WORKER, LEADERBOARD, UPDATE_PERIOD_MS, BROADCAST_PERIOD_MS
+    WORKER_INDEX, WORKERS, FILLING_WORKER = worker_index, workers, filling_worker
+    UPDATE_PERIOD_MS, BROADCAST_PERIOD_MS = update_period, max(broadcast_period, update_period)
+    ssl_context = load_ssl_context()
+    # Every worker imports the old JSON table, upserts only keep a score that beats the stored one
+    LEADERBOARD = leaderboard.Leaderboard(import_paths=[leaderboard.JSON_PATH])
+    flush_task = asyncio.create_task(LEADERBOARD.run(HIGH_SCORES_SHOWN))
+    async with serve(handler, "0.0.0.0", port, ssl=ssl_context, reuse_port=workers > 1):
+        if workers > 1:
+            relayed = lambda websocket: handler(websocket, route=False)
+            async with serve(relayed, "127.0.0.1", RELAY_PORT_BASE + worker_index):
+                await asyncio.get_running_loop().create_future()  # run forever
         await asyncio.get_running_loop().create_future()  # run forever
 
+def run_worker(worker_index, workers, port, update_period, broadcast_period, filling_worker):
+    asyncio.run(serve_rooms(port, worker_index, workers, update_period, broadcast_period, filling_worker))
+
+def main():
+    parser = argparse.ArgumentParser(description="Multiplayer soaring server")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=1, help="Processes sharing the port, each hosting its own rooms")
+    parser.add_argument("--tick_rate", type=float, default=1000 / UPDATE_TIME_MS, help="Simulation ticks per second")
+    parser.add_argument("--broadcast_rate", type=float, default=1000 / BROADCAST_TIME_MS,
+                        help="State updates sent to players per second, at most the tick rate")
+
+    args = parser.parse_args()
+    update_period, broadcast_period = 1000 / args.tick_rate, 1000 / args.broadcast_rate
+    if args.workers == 1:
+        asyncio.run(serve_rooms(args.port, update_period=update_period, broadcast_period=broadcast_period))
+        return
+    filling_worker = multiprocessing.Array("i", 2)
+    processes = [multiprocessing.Process(target=run_worker, args=(worker_index, args.workers, args.port, update_period,
+                                                                  broadcast_period, filling_worker))
+                 for worker_index in range(args.workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
@@ -0,0 +1,193 @@
+import unittest
+import asyncio
+import time
+
+# Fixed timestep loop for a game room.
+# Ticks are due at absolute deadlines start + n * period, so time spent working doesn't stretch the period. A loop that
+# falls behind runs the missed ticks back to back, up to max_catch_up_ticks; beyond that the rest are skipped and
+# their time is handed to the next update in one go, so the game clock keeps following the wall clock.
+# Broadcasts have their own, usually longer, period and are never caught up: a late broadcast sends the current state.
+
+MAX_CATCH_UP_TICKS = 5
+
+class PhaseTiming:
+    """ Durations of one phase of the loop in milliseconds: the last one, the running mean and the worst """
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.last_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, duration_ms):
+        self.count += 1
+        self.total_ms += duration_ms
+        self.last_ms = duration_ms
+        self.max_ms = max(self.max_ms, duration_ms)
+
+    def summary(self):
+        mean_ms = self.total_ms / self.count if self.count else 0.0
+        return {"last_ms": self.last_ms, "mean_ms": mean_ms, "max_ms": self.max_ms}
+
+class TickStats:
+    """
+    ticks, broadcasts: run so far
+    late_ticks: ticks run more than a period after their deadline, i.e. caught up
+    skipped_ticks: ticks dropped past the catch up limit
+    skipped_broadcasts: broadcast deadlines missed entirely
+    overruns: ticks whose update, plus the broadcast that followed it if any, alone took longer than the period.
+    Counted per tick, so each of several consecutive slow ticks run back to back counts
+    """
+    def __init__(self):
+        self.ticks = 0
+        self.broadcasts = 0
+        self.late_ticks = 0
+        self.skipped_ticks = 0
+        self.skipped_broadcasts = 0
+        self.overruns = 0
+        self.update = PhaseTiming()
+        self.serialize = PhaseTiming()
+        self.broadcast = PhaseTiming()
+
+    def summary(self):
+        return {"ticks": self.ticks, "broadcasts": self.broadcasts, "late_ticks": self.late_ticks,
+                "skipped_ticks": self.skipped_ticks, "skipped_broadcasts": self.skipped_broadcasts,
+                "overruns": self.overruns, "update": self.update.summary(),
+                "serialize": self.serialize.summary(), "broadcast": self.broadcast.summary()}
+
+def deadlines_passed(start, period, now):
+    """ How many of the deadlines start, start + period, start + 2 * period, ... are at or before now """
+    count = max(int((now - start) / period) + 1, 0)
+    # The division can land either side of a deadline the sleep was computed from, settle it with the same sum
+    while start + count * period <= now:
+        count += 1
+    while count > 0 and start + (count - 1) * period > now:
+        count -= 1
+    return count
+
+class TickScheduler:
+    def __init__(self, period_ms, broadcast_period_ms = None, max_catch_up_ticks = MAX_CATCH_UP_TICKS,
+                 clock = time.monotonic, sleep = asyncio.sleep):
+        assert(period_ms > 0)
+        self.period = period_ms / 1000
+        self.broadcast_period = (broadcast_period_ms or period_ms) / 1000
+        assert(self.broadcast_period >= self.period)
+        assert(max_catch_up_ticks >= 1)
+        self.max_catch_up_ticks = max_catch_up_ticks
+        self.clock = clock
+        self.sleep = sleep
+        self.stats = TickStats()
+
+    def timed(self, timing, function, *args):
+        start = self.clock()
+        result = function(*args)
+        timing.record((self.clock() - start) * 1000)
+        return result
+
+    def count_overrun(self, duration):
+        if duration > self.period:
+            self.stats.overruns += 1
+
+    async def run(self, update, serialize, broadcast, running = lambda: True):
+        """
+        Call update(elapsed_ms) every period and broadcast(serialize()) every broadcast period while running().
+        elapsed_ms is the game time the update covers, the period unless ticks were skipped before it.
+        """
+        start = self.clock()
+        # Deadlines are start + number * period, counted rather than summed so they don't drift
+        tick_number = 0
+        broadcast_number = 0
+        while running():
+            now = self.clock()
+            due = deadlines_passed(start, self.period, now) - tick_number
+            # The last tick's duration waits for the broadcast that follows it
+            last_tick = 0.0
+            if due > 0:
+                if due > 1:
+                    self.stats.late_ticks += min(due, self.max_catch_up_ticks) - 1
+                skipped = max(due - self.max_catch_up_ticks, 0)
+                self.stats.skipped_ticks += skipped
+                for tick in range(due - skipped):
+                    if tick > 0:
+                        self.count_overrun(last_tick)
+                    elapsed_ms = self.period * 1000 * (1 + (skipped if tick == 0 else 0))
+                    tick_start = self.clock()
+                    self.timed(self.stats.update, update, elapsed_ms)
+                    last_tick = self.clock() - tick_start
+                    self.stats.ticks += 1
+                tick_number += due
+
+            broadcasts_due = deadlines_passed(start, self.broadcast_period, now) - broadcast_number
+            if broadcasts_due > 0:
+                broadcast_start = self.clock()
+                messages = self.timed(self.stats.serialize, serialize)
+                self.timed(self.stats.broadcast, broadcast, messages)
+                last_tick += self.clock() - broadcast_start
+                self.stats.broadcasts += 1
+                self.stats.skipped_broadcasts += broadcasts_due - 1
+                broadcast_number += broadcasts_due
+
+            if due > 0:
+                self.count_overrun(last_tick)
+            next_deadline = start + min(tick_number * self.period, broadcast_number * self.broadcast_period)
+            await self.sleep(max(next_deadline - self.clock(), 0))
+
+class FakeClock:
+    """ Time that only moves when the loop sleeps or the test says a call took a while """
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.now += seconds
+
+class TestTickScheduler(unittest.TestCase):
+
+    def run_for(self, scheduler, clock, seconds, update_cost = lambda: 0.0):
+        updates = []
+        broadcasts = []
+        def update(elapsed_ms):
+            updates.append(elapsed_ms)
+            clock.now += update_cost()
+        asyncio.run(scheduler.run(update, lambda: len(updates), broadcasts.append, lambda: clock.now < seconds))
+        return updates, broadcasts
+
+    def test_fixed_rates(self):
+        clock = FakeClock()
+        scheduler = TickScheduler(10, 50, clock=clock, sleep=clock.sleep)
+        updates, broadcasts = self.run_for(scheduler, clock, 1.0)
+        # Game time follows the clock and the broadcast rate is independent of the tick rate
+        self.assertAlmostEqual(sum(updates), 1000, delta=10)
+        self.assertEqual(len(broadcasts), 20)
+        self.assertEqual(scheduler.stats.late_ticks + scheduler.stats.skipped_ticks + scheduler.stats.overruns, 0)
+
+    def test_catch_up_and_skip(self):
+        clock = FakeClock()
+        scheduler = TickScheduler(10, 50, max_catch_up_ticks=3, clock=clock, sleep=clock.sleep)
+        # An 85ms update leaves 8 ticks due at once: 3 run back to back, the first covering the 5 skipped ones
+        costs = iter([0.0] * 10 + [0.085])
+        updates, broadcasts = self.run_for(scheduler, clock, 1.0, lambda: next(costs, 0.0))
+        stats = scheduler.stats
+        self.assertEqual(stats.overruns, 1)
+        self.assertEqual(stats.skipped_ticks, 5)
+        self.assertEqual(stats.late_ticks, 2)
+        self.assertIn(60.0, updates)
+        self.assertAlmostEqual(sum(updates), 1000, delta=10)
+        self.assertEqual(stats.skipped_broadcasts, 0)
+        self.assertAlmostEqual(stats.update.max_ms, 85)
+
+    def test_consecutive_overruns(self):
+        clock = FakeClock()
+        scheduler = TickScheduler(10, 50, clock=clock, sleep=clock.sleep)
+        # Three 25ms updates in a row: the later ones run as catch up ticks, each is still an overrun of its own
+        costs = iter([0.0] * 10 + [0.025] * 3)
+        updates, broadcasts = self.run_for(scheduler, clock, 1.0, lambda: next(costs, 0.0))
+        stats = scheduler.stats
+        self.assertEqual(stats.overruns, 3)
+        self.assertGreater(stats.late_ticks, 0)
+        self.assertEqual(stats.skipped_ticks, 0)
+        self.assertAlmostEqual(sum(updates), 1000, delta=10)
+
+if __name__ == "__main__":
+    unittest.main()
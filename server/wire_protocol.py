@@ -0,0 +1,156 @@
+import argparse
+import unittest
+import struct
+import json
+import time
+
+# Binary wire protocol, negotiated in the join handshake with JSON as the fallback.
+# Everything is little endian.
+#
+# Client to server, update_dynamics (36 bytes):
+#   type u8 (DYNAMICS), flags u8 (bit 0 thermalling), 2 pad bytes,
+#   airspeed, direction, velocity x y z, position x y z as f32
+#
+# Server to client, one tick (8 byte header followed by count 40 byte glider records):
+#   type u8 (KEYFRAME or DELTA), game_state u8, count u16, world_time i32
+#   record: glider index u16, flags u8, pad byte, score f32, then the 8 dynamics f32 as above
+# A keyframe holds every glider, a delta only the gliders whose dynamics or score changed.
+# Glider names, colours and indices, the starting position and high scores change rarely and stay JSON messages.
+# The client side is soaring-game/components/wire_protocol.js
+
+PROTOCOL_BINARY = "binary"
+PROTOCOL_JSON = "json"
+
+DYNAMICS = 1
+KEYFRAME = 2
+DELTA = 3
+
+THERMALLING = 1
+
+DYNAMICS_MESSAGE = struct.Struct("<BBxx8f")
+TICK_HEADER = struct.Struct("<BBHi")
+GLIDER_RECORD = struct.Struct("<HBxf8f")
+
+def choose_protocol(join_event):
+    """ Binary if the client offered it in its join message, JSON otherwise (older clients offer nothing) """
+    return PROTOCOL_BINARY if PROTOCOL_BINARY in join_event.get("protocols", []) else PROTOCOL_JSON
+
+def dynamics_values(dynamics):
+    velocity = dynamics["velocity"]
+    position = dynamics["position"]
+    return (dynamics["airspeed"], dynamics["direction"],
+            velocity["x"], velocity["y"], velocity["z"], position["x"], position["y"], position["z"])
+
+def dynamics_dict(flags, values):
+    airspeed, direction, velocity_x, velocity_y, velocity_z, position_x, position_y, position_z = values
+    return {"airspeed": airspeed,
+            "direction": direction,
+            "thermalling": bool(flags & THERMALLING),
+            "velocity": {"x": velocity_x, "y": velocity_y, "z": velocity_z},
+            "position": {"x": position_x, "y": position_y, "z": position_z}}
+
+def encode_dynamics(dynamics):
+    return DYNAMICS_MESSAGE.pack(DYNAMICS, THERMALLING if dynamics["thermalling"] else 0, *dynamics_values(dynamics))
+
+def decode_dynamics(message):
+    """ An update_dynamics message back to the dynamics dict the JSON path carries """
+    message_type, flags, *values = DYNAMICS_MESSAGE.unpack(message)
+    if message_type != DYNAMICS:
+        raise ValueError(f"Not a dynamics message: type {message_type}")
+    return dynamics_dict(flags, values)
+
+def encode_tick(keyframe, world_time, game_state, gliders):
+    """ gliders is a list of (index, score, dynamics) """
+    message = bytearray(TICK_HEADER.size + GLIDER_RECORD.size * len(gliders))
+    TICK_HEADER.pack_into(message, 0, KEYFRAME if keyframe else DELTA, int(game_state), len(gliders), int(world_time))
+    offset = TICK_HEADER.size
+    for index, score, dynamics in gliders:
+        GLIDER_RECORD.pack_into(message, offset, index, THERMALLING if dynamics["thermalling"] else 0, score,
+                                *dynamics_values(dynamics))
+        offset += GLIDER_RECORD.size
+    return bytes(message)
+
+def decode_tick(message):
+    message_type, game_state, count, world_time = TICK_HEADER.unpack_from(message, 0)
+    if message_type not in (KEYFRAME, DELTA):
+        raise ValueError(f"Not a tick message: type {message_type}")
+    gliders = []
+    for index, flags, score, *values in GLIDER_RECORD.iter_unpack(message[TICK_HEADER.size:TICK_HEADER.size + count * GLIDER_RECORD.size]):
+        gliders.append((index, score, dynamics_dict(flags, values)))
+    return {"keyframe": message_type == KEYFRAME, "world_time": world_time, "game_state": game_state, "gliders": gliders}
+
+
+def example_gliders(count):
+    """ count gliders in the shape SoaringGameState keeps them """
+    gliders = {}
+    for index in range(count):
+        gliders[f"{index:06x}"] = {"color": "#ff8800", "name": f"pilot {index}", "index": index, "score": 100.5 + index,
+                                   "dynamics": {"airspeed": 30.25, "direction": 1.5, "thermalling": index % 2 == 0,
+                                                "velocity": {"x": 12.5, "y": -3.25, "z": 1.125},
+                                                "position": {"x": 300.5 + index, "y": 410.25, "z": 2.75}}}
+    return gliders
+
+def benchmark(count, ticks):
+    """ Encode/decode time and bytes per tick of a full tick of count gliders, JSON against binary """
+    gliders = example_gliders(count)
+    records = [(glider["index"], glider["score"], glider["dynamics"]) for glider in gliders.values()]
+    report = {"type": "report", "report": {"world_time": 5000, "game_state": 1, "gliders": gliders}}
+
+    start_time = time.perf_counter()
+    for _ in range(ticks):
+        json_message = json.dumps(report)
+    json_encode = (time.perf_counter() - start_time) / ticks
+    start_time = time.perf_counter()
+    for _ in range(ticks):
+        json.loads(json_message)
+    json_decode = (time.perf_counter() - start_time) / ticks
+
+    start_time = time.perf_counter()
+    for _ in range(ticks):
+        binary_message = encode_tick(True, 5000, 1, records)
+    binary_encode = (time.perf_counter() - start_time) / ticks
+    start_time = time.perf_counter()
+    for _ in range(ticks):
+        decode_tick(binary_message)
+    binary_decode = (time.perf_counter() - start_time) / ticks
+
+    dynamics = gliders["000000"]["dynamics"]
+    json_dynamics = json.dumps({"type": "update_dynamics", "dynamics": dynamics})
+    print(f"{count} gliders, full tick:")
+    print(f"  JSON   {len(json_message):6d} bytes, encode {json_encode * 1e6:8.1f}us, decode {json_decode * 1e6:8.1f}us")
+    print(f"  binary {len(binary_message):6d} bytes, encode {binary_encode * 1e6:8.1f}us, decode {binary_decode * 1e6:8.1f}us")
+    print(f"update_dynamics: JSON {len(json_dynamics)} bytes, binary {len(encode_dynamics(dynamics))} bytes")
+
+
+class TestWireProtocol(unittest.TestCase):
+
+    def test_dynamics_round_trip(self):
+        dynamics = example_gliders(1)["000000"]["dynamics"]
+        message = encode_dynamics(dynamics)
+        self.assertEqual(len(message), 36)
+        # The example values are exact in float32
+        self.assertEqual(decode_dynamics(message), dynamics)
+        with self.assertRaises(ValueError):
+            decode_dynamics(encode_tick(True, 0, 0, [])[:8] + bytes(28))
+
+    def test_tick_round_trip(self):
+        gliders = example_gliders(3)
+        records = [(glider["index"], glider["score"], glider["dynamics"]) for glider in gliders.values()]
+        message = encode_tick(False, 61234, 1, records)
+        self.assertEqual(len(message), 8 + 3 * 40)
+        tick = decode_tick(message)
+        self.assertEqual(tick, {"keyframe": False, "world_time": 61234, "game_state": 1, "gliders": records})
+        self.assertTrue(decode_tick(encode_tick(True, -5, 2, []))["keyframe"])
+
+    def test_negotiation(self):
+        self.assertEqual(choose_protocol({"type": "join", "protocols": ["binary", "json"]}), PROTOCOL_BINARY)
+        self.assertEqual(choose_protocol({"type": "join"}), PROTOCOL_JSON)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the JSON and binary wire protocols")
+    parser.add_argument("--gliders", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--ticks", type=int, default=2000)
+
+    args = parser.parse_args()
+    for count in args.gliders:
+        benchmark(count, args.ticks)
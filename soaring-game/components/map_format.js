@@ -0,0 +1,54 @@
+// Loader for the binary map layers written by map_format.py
+// Header is 24 bytes little endian: magic "SGMP", version u8, dtype u8, reserved u16,
+// dim_x u32, dim_y u32, scale f32, offset f32, followed by dim_x * dim_y quantized values.
+
+const MAP_MAGIC = "SGMP"
+const MAP_VERSION = 1
+const HEADER_SIZE = 24
+const DTYPE_ARRAYS = {1: Uint8Array, 2: Uint16Array, 3: Float32Array}
+
+async function decompress_if_needed(buffer) {
+    // Static hosts serve the .gz file as is, otherwise the browser has already decoded it
+    const bytes = new Uint8Array(buffer, 0, 2)
+    if (bytes[0] != 0x1f || bytes[1] != 0x8b) {
+        return buffer
+    }
+    const stream = new Blob([buffer]).stream().pipeThrough(new DecompressionStream("gzip"))
+    return await new Response(stream).arrayBuffer()
+}
+
+function parse_map_layer(buffer) {
+    const header = new DataView(buffer, 0, HEADER_SIZE)
+    const magic = String.fromCharCode(header.getUint8(0), header.getUint8(1), header.getUint8(2), header.getUint8(3))
+    if (magic != MAP_MAGIC || header.getUint8(4) != MAP_VERSION) {
+        throw new Error("Not a binary map layer")
+    }
+    const dim_x = header.getUint32(8, true)
+    const dim_y = header.getUint32(12, true)
+    const scale = header.getFloat32(16, true)
+    const offset = header.getFloat32(20, true)
+    const stored = new DTYPE_ARRAYS[header.getUint8(5)](buffer, HEADER_SIZE, dim_x * dim_y)
+
+    const values = new Float32Array(dim_x * dim_y)
+    for (var index = 0; index < values.length; index++) {
+        values[index] = offset + stored[index] * scale
+    }
+
+    // Rows are views into the one Float32Array, so layer[x][y] indexing keeps working without copying
+    const layer = []
+    for (var x = 0; x < dim_x; x++) {
+        layer.push(values.subarray(x * dim_y, (x + 1) * dim_y))
+    }
+    return layer
+}
+
+async function fetch_map_layer(url) {
+    const response = await fetch(url)
+    if (!response.ok) {
+        throw new Error("Could not fetch " + url)
+    }
+    const buffer = await decompress_if_needed(await response.arrayBuffer())
+    return parse_map_layer(buffer)
+}
+
+export { fetch_map_layer, parse_map_layer }
@@ -1,6 +1,7 @@
 import { cameraNear, Float16BufferAttribute } from "three/webgpu"
 import { create_jS3 } from "./glider_models/js3.js"
 import { GliderDynamics } from "./glider.js"
+import { PROTOCOL_BINARY, PROTOCOL_JSON, encode_dynamics, decode_tick } from "./wire_protocol.js"
 
 class MultiplayerGliders {
     constructor() {
@@ -10,9 +11,15 @@ class MultiplayerGliders {
         this.server_time
         this.starting_position
         this.high_scores = []
+        // Glider index (binary protocol) -> glider id
+        this.glider_ids = {}
     }
-    register_glider = (id, name, color) => {
+    register_glider = (id, name, color, index) => {
+        if (index !== undefined) {
+            this.glider_ids[index] = id
+        }
         this.gliders[id] = {
+            index: index,
             model: create_jS3(color),
             name: name,
             color: color,
@@ -33,8 +40,18 @@ class MultiplayerGliders {
         this.starting_position = report.starting_position
         this.high_scores = report.high_scores
     }
+    update_glider_fields = (id, changes) => {
+        // Deltas only carry the dynamics fields that changed
+        if ("dynamics" in changes) {
+            this.gliders[id].dynamics = {...this.gliders[id].dynamics, ...changes.dynamics}
+        }
+        if ("score" in changes) {
+            this.gliders[id].score = changes.score
+        }
+    }
     remove_glider = (name) => {
         if (this.gliders[name]){
+            delete this.glider_ids[this.gliders[name].index]
             delete this.gliders[name]
             console.log("Removed ", name)
             return true;
@@ -51,6 +68,9 @@ class MultiplayerClient {
         this.server_websocket;
         this.multiplayer_gliders = new MultiplayerGliders()
         this.id
+        // The server confirms the protocol in its welcome message, until then everything is JSON
+        this.protocol = PROTOCOL_JSON
+        this.room
     }
 
     open_connection = (host = "localhost", port = 8080, secure = false) => {
@@ -68,6 +88,7 @@ class MultiplayerClient {
             console.log(err)
         }
 
+        this.server_websocket.binaryType = "arraybuffer"
         this.server_websocket.onerror = (error) => { 
             console.log("WS can't connect"); 
             this.server_connected = false;
@@ -88,18 +109,28 @@ class MultiplayerClient {
         this.server_websocket.close()
     }
 
-    send_join_message = (name, color) => {
+    send_join_message = (name, color, room = null) => {
         this.id = Math.random().toString(16).slice(10)
         const join_message = {
             type: "join", 
             id: this.id,
             name: name,
-            color: color
+            color: color,
+            protocols: [PROTOCOL_BINARY, PROTOCOL_JSON]
+        }
+        // Without a room the server puts us in any room with space
+        if (room) {
+            join_message.room = room
         }
+        this.protocol = PROTOCOL_JSON
         this.send_message(JSON.stringify(join_message));
     }
 
     send_dynamics_message = (dynamics) => {
+        if (this.protocol == PROTOCOL_BINARY) {
+            this.send_message(encode_dynamics(dynamics))
+            return
+        }
         const dynamics_message = {
             type: "update_dynamics", 
             dynamics: dynamics,
@@ -116,17 +147,94 @@ class MultiplayerClient {
     }
 
     receive_message = (message) => {
+        if (message["data"] instanceof ArrayBuffer) {
+            try {
+                var tick = decode_tick(message["data"])
+            } catch (error) {
+                return
+            }
+            this.handle_tick(tick)
+            return
+        }
         try{
             var data = JSON.parse(message["data"])
         } catch (error){
             return
         }
-        if (!("type" in data) || data.type != "report") {
+        if (!("type" in data) || !(["report", "delta", "roster", "welcome"].includes(data.type))) {
             console.log("Unknown Message")
         }
         
         if (data.type == "report") {
             this.handle_report(data.report)
+        } else if (data.type == "delta") {
+            this.handle_delta(data.delta)
+        } else if (data.type == "roster") {
+            this.handle_roster(data.roster)
+        } else if (data.type == "welcome") {
+            this.protocol = data.protocol
+            this.room = data.room
+        }
+    }
+
+    handle_roster = (roster) => {
+        // Sent with binary keyframes: who is flying, and the fields that rarely change
+        const gliders = this.multiplayer_gliders
+        gliders.starting_position = roster.starting_position
+        gliders.high_scores = roster.high_scores
+        for (const [glider_id, glider_info] of Object.entries(roster.gliders)) {
+            if (!(glider_id in gliders.gliders)) {
+                console.log("Registering New Glider: ", glider_id)
+                gliders.register_glider(glider_id, glider_info.name, glider_info.color, glider_info.index)
+            }
+        }
+        for (const glider_id of Object.keys(gliders.gliders)) {
+            if (!(glider_id in roster.gliders)) {
+                console.log("Removing ", glider_id)
+                gliders.remove_glider(glider_id)
+            }
+        }
+    }
+
+    handle_tick = (tick) => {
+        const gliders = this.multiplayer_gliders
+        gliders.server_time = tick.world_time
+        gliders.game_state = tick.game_state
+        for (const record of tick.gliders) {
+            const glider_id = gliders.glider_ids[record.index]
+            if (glider_id in gliders.gliders) {
+                gliders.update_glider(glider_id, record.dynamics, record.score)
+            }
+        }
+    }
+
+    handle_delta = (delta) => {
+        // Changes since the previous message. Static fields are only present when they changed
+        const gliders = this.multiplayer_gliders
+        gliders.server_time = delta.world_time
+        gliders.game_state = delta.game_state
+        if ("starting_position" in delta) {
+            gliders.starting_position = delta.starting_position
+        }
+        if ("high_scores" in delta) {
+            gliders.high_scores = delta.high_scores
+        }
+        for (const [glider_id, glider_info] of Object.entries(delta.added ?? {})) {
+            if (!(glider_id in gliders.gliders)) {
+                console.log("Registering New Glider: ", glider_id)
+                gliders.register_glider(glider_id, glider_info.name, glider_info.color, glider_info.index)
+            }
+            gliders.update_glider(glider_id, glider_info.dynamics, glider_info.score)
+        }
+        for (const glider_id of delta.removed ?? []) {
+            console.log("Removing ", glider_id)
+            gliders.remove_glider(glider_id)
+        }
+        for (const [glider_id, changes] of Object.entries(delta.gliders ?? {})) {
+            // A glider we haven't heard of yet will arrive with the next keyframe
+            if (glider_id in gliders.gliders) {
+                gliders.update_glider_fields(glider_id, changes)
+            }
         }
     }
 
@@ -143,7 +251,7 @@ class MultiplayerClient {
             } else {
                 // Register a new glider if it doesn't already exist
                 console.log("Registering New Glider: ", glider_id)
-                this.multiplayer_gliders.register_glider(glider_id, glider_info.name, glider_info.color)
+                this.multiplayer_gliders.register_glider(glider_id, glider_info.name, glider_info.color, glider_info.index)
             }
             if (existing_gliders.has(glider_id)){
                 // Remove the glider from the list of current gliders.
@@ -1,6 +1,7 @@
 import { create_jS3 } from "./glider_models/js3"
 import { height_map_to_color_map } from "./terrain_tools.js"
 import { create_terrain_mesh } from "./terrain_tools.js"
+import { fetch_map_layer } from "./map_format.js"
 
 const CONFIG_NOT_LOADED = -1
 const USE_ONLINE_SERVER = 0
@@ -76,10 +77,11 @@ class SettingsManager {
     }
     load_map = (folder, name) => {
         this.terrain.name = name;
-        fetch(folder + '/height_map.json')
-            .then((response) => response.json())
-            .then((response_json) => {
-                this.set_height_map(response_json)
+        // Prefer the binary map layers, falling back to JSON for maps that haven't been converted
+        fetch_map_layer(folder + '/height_map.bin.gz')
+            .catch((e) => fetch(folder + '/height_map.json').then((response) => response.json()))
+            .then((height_map) => {
+                this.set_height_map(height_map)
                 console.log("Loaded Height Map from " + folder);
                 // Wait to fetch the color map until we have a height map,
                 // incase we need to generate the color map from the height map
@@ -87,10 +89,10 @@ class SettingsManager {
                 // Once we have the height map we can geenrate the terrain mesh
                 this.generate_mesh();
             });
-        fetch(folder + '/thermal_map.json')
-            .then((response) => response.json())
-            .then((response_json) => {
-                this.set_thermal_map(response_json)
+        fetch_map_layer(folder + '/thermal_map.bin.gz')
+            .catch((e) => fetch(folder + '/thermal_map.json').then((response) => response.json()))
+            .then((thermal_map) => {
+                this.set_thermal_map(thermal_map)
                 console.log("Loaded Thermal Map from " + folder);
             });            
     }
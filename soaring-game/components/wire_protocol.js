@@ -0,0 +1,67 @@
+// Client side of the binary wire protocol in server/wire_protocol.py, little endian throughout.
+// update_dynamics (36 bytes): type u8, flags u8 (bit 0 thermalling), 2 pad bytes,
+//     airspeed, direction, velocity x y z, position x y z as f32
+// tick: type u8, game_state u8, count u16, world_time i32, then count 40 byte glider records of
+//     glider index u16, flags u8, pad byte, score f32 and the 8 dynamics f32
+
+const PROTOCOL_BINARY = "binary"
+const PROTOCOL_JSON = "json"
+
+const DYNAMICS = 1
+const KEYFRAME = 2
+const DELTA = 3
+
+const THERMALLING = 1
+
+const DYNAMICS_SIZE = 36
+const TICK_HEADER_SIZE = 8
+const GLIDER_RECORD_SIZE = 40
+
+function write_dynamics(view, offset, dynamics) {
+    const values = [dynamics.airspeed, dynamics.direction,
+                    dynamics.velocity.x, dynamics.velocity.y, dynamics.velocity.z,
+                    dynamics.position.x, dynamics.position.y, dynamics.position.z]
+    for (var index = 0; index < values.length; index++) {
+        view.setFloat32(offset + 4 * index, values[index], true)
+    }
+}
+
+function read_dynamics(view, offset, flags) {
+    const value = (index) => view.getFloat32(offset + 4 * index, true)
+    return {airspeed: value(0),
+            direction: value(1),
+            thermalling: (flags & THERMALLING) != 0,
+            velocity: {x: value(2), y: value(3), z: value(4)},
+            position: {x: value(5), y: value(6), z: value(7)}}
+}
+
+function encode_dynamics(dynamics) {
+    const buffer = new ArrayBuffer(DYNAMICS_SIZE)
+    const view = new DataView(buffer)
+    view.setUint8(0, DYNAMICS)
+    view.setUint8(1, dynamics.thermalling ? THERMALLING : 0)
+    write_dynamics(view, 4, dynamics)
+    return buffer
+}
+
+function decode_tick(buffer) {
+    const view = new DataView(buffer)
+    const type = view.getUint8(0)
+    if (type != KEYFRAME && type != DELTA) {
+        throw new Error("Not a tick message")
+    }
+    const count = view.getUint16(2, true)
+    const gliders = []
+    for (var record = 0; record < count; record++) {
+        const offset = TICK_HEADER_SIZE + record * GLIDER_RECORD_SIZE
+        gliders.push({index: view.getUint16(offset, true),
+                      score: view.getFloat32(offset + 4, true),
+                      dynamics: read_dynamics(view, offset + 8, view.getUint8(offset + 2))})
+    }
+    return {keyframe: type == KEYFRAME,
+            game_state: view.getUint8(1),
+            world_time: view.getInt32(4, true),
+            gliders: gliders}
+}
+
+export { PROTOCOL_BINARY, PROTOCOL_JSON, encode_dynamics, decode_tick }
@@ -0,0 +1,183 @@
+from dataclasses import dataclass
+from collections import OrderedDict
+from particle import ThermalParticleDistribution
+import generate_terrain
+import numpy as np
+import unittest
+import hashlib
+
+# Thermal strength used for each recipe, generate_map's. generate_map has no lengthwise_ranges maps, so that recipe
+# reuses the big_ranges strength rather than an untested value of its own
+RECIPE_THERMAL_STRENGTH = dict(generate_terrain.RECIPE_THERMAL_STRENGTH,
+                               lengthwise_ranges=generate_terrain.RECIPE_THERMAL_STRENGTH["big_ranges"])
+
+@dataclass
+class TerrainChunk():
+    chunk_x: int
+    chunk_y: int
+    # height_map[x][y] and thermal_map[x][y] for the cells of this chunk
+    height_map: np.ndarray
+    thermal_map: np.ndarray
+
+class TerrainChunkProvider():
+    """
+    Generate fixed size height and thermal chunks on demand from (seed, recipe, chunk_x, chunk_y).
+    Chunk (i, j) covers world cells [i*chunk_size, (i+1)*chunk_size) x [j*chunk_size, (j+1)*chunk_size), so the world
+    is unbounded and only the chunks that are asked for are ever built. Heights are normalized against the noise maximum
+    sampled over a region at the origin (generate_terrain.noise_bound) rather than each chunk's own maximum, which keeps
+    chunk borders seamless while matching the height range of generate_recipe maps.
+    Thermals are simulated on the chunk plus a margin of thermal_margin cells on every side so particles can climb in
+    from neighbouring terrain, then cropped to the chunk. Every chunk draws the particles that start on it, and the
+    margin takes in its neighbours' particles, so both sides of a border see the same particles. Like heights, thermals
+    are normalized against a world level bound (thermal_bound) rather than each chunk's strongest thermal.
+    Recently used chunks are kept in an LRU cache of at most max_chunks entries.
+    """
+    def __init__(self, recipe, seed = None, chunk_size = 64, max_chunks = 256, thermal_margin = 16, max_thermal = None, wind = (0, 0)):
+        noise, rng = generate_terrain.seeded_generators(seed)
+        octaves_function, pipeline_function = generate_terrain.RECIPES[recipe]
+
+        self.recipe = recipe
+        self.seed = seed
+        # Neighbouring chunks redraw each other's particles, so even an unseeded world needs fixed chunk seeds
+        self.world_seed = seed if seed is not None else np.random.SeedSequence().entropy
+        self.noise = noise
+        self.octaves = octaves_function(rng)
+        self.bound = generate_terrain.noise_bound(noise, self.octaves)
+        self.pipeline = pipeline_function(self.bound)
+        self.chunk_size = chunk_size
+        self.thermal_margin = thermal_margin
+        self.max_thermal = RECIPE_THERMAL_STRENGTH[recipe] if max_thermal is None else max_thermal
+        self.wind = wind
+        self.heat_bound = self.thermal_bound()
+
+        self.max_chunks = max_chunks
+        self.chunks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def height_region(self, x_start, y_start, dim_x, dim_y):
+        """ Height map for an arbitrary world region """
+        map_layer = self.noise.layered_noise_map(dim_x, dim_y, self.octaves, x_offset=x_start, y_offset=y_start)
+        return self.pipeline.run(map_layer)
+
+    def chunk_seed(self, chunk_x, chunk_y):
+        digest = hashlib.sha256(f"{self.world_seed}:{chunk_x}:{chunk_y}".encode()).digest()
+        return int.from_bytes(digest[:8], "little")
+
+    def thermal_bound(self, extent_chunks = 4):
+        """
+        Strongest spread particle heat over a region of extent_chunks x extent_chunks chunks at the origin, simulated at
+        the particle density of a chunk. Stronger spots elsewhere just saturate, as thermal_distribution caps them
+        anyway
+        """
+        size = extent_chunks * self.chunk_size
+        thermals = ThermalParticleDistribution((size * size)/10, self.height_region(0, 0, size, size), self.max_thermal,
+                                               seed=self.chunk_seed(0, 0))
+        thermals.simulate_particles(self.wind)
+        return thermals.max_value
+
+    def build_chunk(self, chunk_x, chunk_y):
+        size = self.chunk_size
+        margin = self.thermal_margin
+        padded_size = size + 2 * margin
+        # Heights for every chunk the margin reaches into, each of which draws its own particles
+        reach = -(-margin // size)
+        block_size = (2 * reach + 1) * size
+        block_height = self.height_region((chunk_x - reach) * size, (chunk_y - reach) * size, block_size, block_size)
+        start_x, start_y = [], []
+        for offset_x in range(2 * reach + 1):
+            for offset_y in range(2 * reach + 1):
+                cells = block_height[offset_x * size:(offset_x + 1) * size, offset_y * size:(offset_y + 1) * size]
+                seed = self.chunk_seed(chunk_x - reach + offset_x, chunk_y - reach + offset_y)
+                drawn = ThermalParticleDistribution((size * size)/10, cells, self.max_thermal, seed=seed)
+                start_x.append(drawn.particles.columns["position_x"] + offset_x * size)
+                start_y.append(drawn.particles.columns["position_y"] + offset_y * size)
+        start_x, start_y = np.concatenate(start_x), np.concatenate(start_y)
+
+        padded_start = reach * size - margin
+        padded = slice(padded_start, padded_start + padded_size)
+        inside = ((start_x >= padded.start) & (start_x < padded.stop) &
+                  (start_y >= padded.start) & (start_y < padded.stop))
+        padded_height = block_height[padded, padded]
+        thermals = ThermalParticleDistribution(0, padded_height, self.max_thermal, heat_bound=self.heat_bound)
+        thermals.place_particles(start_x[inside] - padded_start, start_y[inside] - padded_start)
+        thermals.simulate_particles(self.wind)
+
+        inner = slice(margin, margin + size)
+        return TerrainChunk(chunk_x, chunk_y,
+                            padded_height[inner, inner].copy(),
+                            np.array(thermals.thermal_map)[inner, inner])
+
+    def get_chunk(self, chunk_x, chunk_y):
+        key = (chunk_x, chunk_y)
+        if key in self.chunks:
+            self.hits += 1
+            self.chunks.move_to_end(key)
+            return self.chunks[key]
+
+        self.misses += 1
+        chunk = self.build_chunk(chunk_x, chunk_y)
+        self.chunks[key] = chunk
+        if len(self.chunks) > self.max_chunks:
+            self.chunks.popitem(last=False)
+        return chunk
+
+    def chunk_index(self, x, y):
+        """ Chunk containing world position (x, y) """
+        return (int(np.floor(x / self.chunk_size)), int(np.floor(y / self.chunk_size)))
+
+    def chunks_around(self, position, radius = 1):
+        """
+        Return the chunks within radius chunks of a world position, e.g. SoaringGameState.starting_position,
+        building any that are missing. This is all that needs to exist before a flight begins.
+        """
+        center_x, center_y = self.chunk_index(position["x"], position["y"])
+        return [self.get_chunk(chunk_x, chunk_y)
+                for chunk_x in range(center_x - radius, center_x + radius + 1)
+                for chunk_y in range(center_y - radius, center_y + radius + 1)]
+
+    def cache_info(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.chunks), "max_chunks": self.max_chunks}
+
+
+class TestTerrainChunks(unittest.TestCase):
+
+    def test_chunks_are_seamless(self):
+        provider = TerrainChunkProvider("little_ranges", seed=3, chunk_size=16, thermal_margin=4)
+        region = provider.height_region(-16, 0, 32, 16)
+        self.assertTrue(np.array_equal(provider.get_chunk(-1, 0).height_map, region[:16]))
+        self.assertTrue(np.array_equal(provider.get_chunk(0, 0).height_map, region[16:]))
+        self.assertEqual(provider.get_chunk(0, 0).thermal_map.shape, (16, 16))
+
+    def test_thermals_are_seamless(self):
+        for recipe in ["big_ranges", "little_ranges"]:
+            provider = TerrainChunkProvider(recipe, seed=3, chunk_size=32, thermal_margin=8)
+            thermal_row = np.concatenate([provider.get_chunk(chunk_x, 0).thermal_map for chunk_x in range(6)])
+            # Thermal strength changes no more from one chunk to the next than between cells inside a chunk
+            change = np.abs(np.diff(thermal_row, axis=0)).mean(axis=1)
+            seams = [32 * chunk_x - 1 for chunk_x in range(1, 6)]
+            self.assertLess(change[seams].mean(), 1.15 * np.delete(change, seams).mean(), msg=recipe)
+
+    def test_lru_cache(self):
+        provider = TerrainChunkProvider("big_ranges", seed=1, chunk_size=8, max_chunks=2, thermal_margin=2)
+        first = provider.get_chunk(0, 0)
+        self.assertIs(provider.get_chunk(0, 0), first)
+        provider.get_chunk(1, 0)
+        provider.get_chunk(2, 0)
+        self.assertEqual(provider.cache_info(), {"hits": 1, "misses": 3, "size": 2, "max_chunks": 2})
+        self.assertNotIn((0, 0), provider.chunks)
+
+        chunks = provider.chunks_around({"x": 20, "y": 3, "z": 3}, radius=0)
+        self.assertEqual((chunks[0].chunk_x, chunks[0].chunk_y), (2, 0))
+        self.assertEqual(provider.hits, 2)
+
+    def test_height_range_matches_recipe(self):
+        for recipe in ["big_ranges", "little_ranges", "lengthwise_ranges"]:
+            provider = TerrainChunkProvider(recipe, seed=2)
+            chunked = provider.height_region(0, 0, 256, 256)
+            whole = generate_terrain.generate_recipe(recipe, 256, 256, seed=2)
+            self.assertAlmostEqual(np.max(chunked) / np.max(whole), 1, delta=0.15, msg=recipe)
+            self.assertAlmostEqual(np.mean(chunked) / np.mean(whole), 1, delta=0.15, msg=recipe)
+
+if __name__ == "__main__":
+    unittest.main()
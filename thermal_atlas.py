@@ -0,0 +1,155 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from particle import ThermalParticleDistribution, SimulationMode
+import generate_terrain
+import numpy as np
+import unittest
+import argparse
+import tempfile
+import os
+
+class ThermalAtlas():
+    """
+    Thermal maps for one height map simulated over a grid of wind directions (degrees) and speeds.
+    thermal_maps[speed_index, direction_index] is the thermal map for that wind. thermal_map(wind) interpolates
+    bilinearly between the surrounding speeds and directions, so any wind can be looked up at runtime.
+    """
+    def __init__(self, directions, speeds, thermal_maps):
+        self.directions = np.asarray(directions, dtype=np.float64)
+        self.speeds = np.asarray(speeds, dtype=np.float64)
+        self.thermal_maps = thermal_maps
+
+    def save(self, path):
+        np.savez(path, directions=self.directions, speeds=self.speeds, thermal_maps=self.thermal_maps)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as atlas:
+            return cls(atlas["directions"], atlas["speeds"], atlas["thermal_maps"])
+
+    def thermal_map(self, wind):
+        speed = np.hypot(wind[0], wind[1])
+        direction = np.degrees(np.arctan2(wind[1], wind[0])) % 360
+
+        # Speeds are clamped to the simulated range
+        speed = np.clip(speed, self.speeds[0], self.speeds[-1])
+        upper_speed = min(int(np.searchsorted(self.speeds, speed, side="right")), len(self.speeds) - 1)
+        lower_speed = max(upper_speed - 1, 0)
+        speed_span = self.speeds[upper_speed] - self.speeds[lower_speed]
+        speed_weight = 0 if speed_span == 0 else (speed - self.speeds[lower_speed]) / speed_span
+
+        # Directions wrap around, so the last direction is followed by the first one
+        upper_direction = int(np.searchsorted(self.directions, direction, side="right")) % len(self.directions)
+        lower_direction = (upper_direction - 1) % len(self.directions)
+        direction_span = (self.directions[upper_direction] - self.directions[lower_direction]) % 360
+        direction_weight = 0 if direction_span == 0 else ((direction - self.directions[lower_direction]) % 360) / direction_span
+
+        maps = self.thermal_maps
+        lower = (1 - direction_weight) * maps[lower_speed, lower_direction] + direction_weight * maps[lower_speed, upper_direction]
+        upper = (1 - direction_weight) * maps[upper_speed, lower_direction] + direction_weight * maps[upper_speed, upper_direction]
+        return (1 - speed_weight) * lower + speed_weight * upper
+
+def _simulate_wind(task):
+    """ Worker for build_thermal_atlas: simulate one wind on the shared height map into the shared atlas """
+    (height_name, atlas_name, map_shape, atlas_shape, speed_index, direction_index, wind,
+     number_of_particles, max_thermal, seed, mode) = task
+    height_memory = shared_memory.SharedMemory(name=height_name)
+    atlas_memory = shared_memory.SharedMemory(name=atlas_name)
+    try:
+        height_map = np.ndarray(map_shape, dtype=np.float64, buffer=height_memory.buf)
+        thermal_maps = np.ndarray(atlas_shape, dtype=np.float32, buffer=atlas_memory.buf)
+        thermals = ThermalParticleDistribution(number_of_particles, height_map, max_thermal, seed=seed)
+        thermals.simulate_particles(wind, mode=mode)
+        thermal_maps[speed_index, direction_index] = thermals.thermal_map
+        del height_map, thermal_maps, thermals
+    finally:
+        height_memory.close()
+        atlas_memory.close()
+
+def build_thermal_atlas(height_map, max_thermal, directions = 8, speeds = (0, 5, 10), number_of_particles = None,
+                        seed = 0, workers = None, mode = SimulationMode.BATCH):
+    """
+    Simulate thermals for directions evenly spaced wind directions at each of speeds on a process pool.
+    The height map and the resulting stack live in shared memory, and every wind uses the same particle seed so
+    the maps only differ by the wind. A speed of 0 is simulated once and shared by all directions.
+    """
+    height_map = np.asarray(height_map, dtype=np.float64)
+    map_shape = height_map.shape
+    if number_of_particles is None:
+        number_of_particles = (map_shape[0] * map_shape[1])/10
+    direction_degrees = np.arange(directions) * 360 / directions
+    speeds = sorted(speeds)
+    atlas_shape = (len(speeds), directions) + map_shape
+
+    height_memory = shared_memory.SharedMemory(create=True, size=height_map.nbytes)
+    atlas_memory = shared_memory.SharedMemory(create=True, size=int(np.prod(atlas_shape)) * 4)
+    try:
+        np.ndarray(map_shape, dtype=np.float64, buffer=height_memory.buf)[:] = height_map
+        tasks = []
+        for speed_index, speed in enumerate(speeds):
+            for direction_index, direction in enumerate(direction_degrees):
+                if speed == 0 and direction_index > 0:
+                    continue
+                wind = (speed * np.cos(np.radians(direction)), speed * np.sin(np.radians(direction)))
+                tasks.append((height_memory.name, atlas_memory.name, map_shape, atlas_shape, speed_index, direction_index,
+                              wind, number_of_particles, max_thermal, seed, mode))
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for _ in pool.map(_simulate_wind, tasks):
+                pass
+
+        thermal_maps = np.ndarray(atlas_shape, dtype=np.float32, buffer=atlas_memory.buf).copy()
+    finally:
+        height_memory.close()
+        height_memory.unlink()
+        atlas_memory.close()
+        atlas_memory.unlink()
+
+    for speed_index, speed in enumerate(speeds):
+        if speed == 0:
+            thermal_maps[speed_index, 1:] = thermal_maps[speed_index, 0]
+    return ThermalAtlas(direction_degrees, speeds, thermal_maps)
+
+
+class TestThermalAtlas(unittest.TestCase):
+
+    def test_build_and_lookup(self):
+        height_map = generate_terrain.generate_little_ranges(40, 30, seed=1)
+        atlas = build_thermal_atlas(height_map, 4, directions=4, speeds=(0, 8), seed=3, workers=2)
+        self.assertEqual(atlas.thermal_maps.shape, (2, 4, 40, 30))
+
+        still = ThermalParticleDistribution(120, height_map, 4, seed=3)
+        still.simulate_particles((0, 0))
+        self.assertTrue(np.allclose(atlas.thermal_map((0, 0)), still.thermal_map, atol=1e-5))
+        self.assertTrue(np.array_equal(atlas.thermal_map((0, 8)), atlas.thermal_maps[1, 1]))
+
+        # Half way between north and west at full speed, and half way to full speed due east
+        self.assertTrue(np.allclose(atlas.thermal_map((-8 / np.sqrt(2), 8 / np.sqrt(2))),
+                                    (atlas.thermal_maps[1, 1] + atlas.thermal_maps[1, 2]) / 2, atol=1e-5))
+        self.assertTrue(np.allclose(atlas.thermal_map((4, 0)),
+                                    (atlas.thermal_maps[0, 0] + atlas.thermal_maps[1, 0]) / 2, atol=1e-5))
+        # Directions just below 360 interpolate towards 0
+        self.assertTrue(np.allclose(atlas.thermal_map((8, -1e-9)), atlas.thermal_maps[1, 0], atol=1e-5))
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "atlas.npz")
+            atlas.save(path)
+            loaded = ThermalAtlas.load(path)
+        self.assertTrue(np.array_equal(loaded.thermal_maps, atlas.thermal_maps))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a wind sweep thermal atlas for a generated map")
+    parser.add_argument("dim_x", type=int)
+    parser.add_argument("dim_y", type=int)
+    parser.add_argument("output")
+    parser.add_argument("--map_type", default="big_ranges")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max_thermal", type=float, default=7)
+    parser.add_argument("--directions", type=int, default=8)
+    parser.add_argument("--speeds", type=float, nargs="+", default=[0, 5, 10])
+    parser.add_argument("--workers", type=int, default=None)
+
+    args = parser.parse_args()
+    height_map = generate_terrain.generate_recipe(args.map_type, args.dim_x, args.dim_y, seed=args.seed)
+    atlas = build_thermal_atlas(height_map, args.max_thermal, args.directions, args.speeds, seed=args.seed, workers=args.workers)
+    atlas.save(args.output)